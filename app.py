@@ -21,6 +21,16 @@ import gc
 import hashlib
 import math
 import unicodedata
+import sqlite3
+import threading
+import collections
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait
+
+try:
+    # 让线程池里的工作线程也能访问当前会话上下文 (st.secrets / st.session_state)
+    from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+except ImportError:
+    add_script_run_ctx = get_script_run_ctx = None
 
 # ==============================================================================
 # 1. 全局配置与 CSS (紧急修复版：恢复原生交互)
@@ -219,39 +229,146 @@ def check_outline_coverage(outline, draft_text):
     return coverage
 
 # --- 🎓 讲义进度管理辅助函数 ---
-def get_lecture_progress(uid, lid):
-    """获取某篇讲义的所有段落状态"""
-    try:
-        # lid 需要转为 int
-        res = supabase.table("lecture_progress").select("*").eq("user_id", uid).eq("lecture_id", int(lid)).execute()
-        progress_map = {}
-        for item in res.data:
-            progress_map[item['segment_index']] = {
-                'read': item.get('is_read', False),
-                'star': item.get('is_star', False)
-            }
-        return progress_map
-    except Exception as e:
-        return {}
+# [性能优化] 段落状态先写进会话内的缓冲区，界面立即生效；攒够一批 / 超过防抖间隔 / 切换页面 /
+# "以上全部已读" 时再一次 upsert 写回。侧边栏的定时片段每隔防抖间隔检查一次，不点按钮、直接关页面也最多丢几秒的标记。需要 lecture_progress 上有 (user_id, lecture_id, segment_index) 唯一约束。
+LECTURE_PROGRESS_CACHE_KEY = '_lecture_progress_cache'  # {lid: {idx: {'read': bool, 'star': bool}}}
+LECTURE_PROGRESS_PENDING_KEY = '_lecture_progress_pending'  # {(lid, idx): 首次变更时间}
+LECTURE_FLUSH_INTERVAL = 5  # 秒
+LECTURE_FLUSH_BATCH = 20
+
+
+def _lecture_progress_rows_to_map(rows):
+    progress_map = {}
+    for item in rows:
+        progress_map[item['segment_index']] = {
+            'read': item.get('is_read', False),
+            'star': item.get('is_star', False)
+        }
+    return progress_map
 
 
-def update_segment_status(uid, lid, idx, status_type, new_val):
-    """更新某一段的状态"""
-    try:
-        lid = int(lid)
-        existing = supabase.table("lecture_progress").select("id").eq("user_id", uid).eq("lecture_id", lid).eq(
-            "segment_index", idx).execute()
+def get_lecture_progress(uid, lid):
+    """获取某篇讲义的所有段落状态 (每个会话只查一次，之后读缓存 + 未写回的本地修改)"""
+    lid = int(lid)  # lid 需要转为 int
+    cache = st.session_state.setdefault(LECTURE_PROGRESS_CACHE_KEY, {})
+    if lid not in cache:
+        try:
+            res = supabase.table("lecture_progress").select("*").eq("user_id", uid).eq("lecture_id", lid).execute()
+            cache[lid] = _lecture_progress_rows_to_map(res.data)
+        except Exception as e:
+            return {}
+    return cache[lid]
 
-        data = {status_type: new_val, "user_id": uid, "lecture_id": lid, "segment_index": idx}
 
+def prefetch_lecture_progress(uid, lids):
+    """[性能优化] 用一次 in_ 查询把多篇讲义中尚未缓存的进度一起取回"""
+    cache = st.session_state.setdefault(LECTURE_PROGRESS_CACHE_KEY, {})
+    missing = [int(l) for l in lids if int(l) not in cache]
+    if not missing: return
+    try:
+        res = supabase.table("lecture_progress").select("*").eq("user_id", uid).in_("lecture_id", missing).execute()
+    except Exception as e:
+        print(f"Progress Prefetch Error: {e}")
+        return
+    by_lesson = collections.defaultdict(list)
+    for item in res.data:
+        by_lesson[item['lecture_id']].append(item)
+    for lid in missing:
+        cache[lid] = _lecture_progress_rows_to_map(by_lesson.get(lid, []))
+
+
+def lecture_progress_summary(uid, lid):
+    """返回 (已读段数, 重点段数)，直接读缓存的进度，不需要先分段"""
+    prog_map = get_lecture_progress(uid, lid)
+    return (sum(1 for v in prog_map.values() if v['read']), sum(1 for v in prog_map.values() if v['star']))
+
+
+def _flush_lecture_progress_legacy(uid, rows):
+    """降级方案：表上没有唯一约束导致 upsert 失败时，逐段 查询 + 更新/插入"""
+    for data in rows:
+        existing = supabase.table("lecture_progress").select("id").eq("user_id", uid).eq(
+            "lecture_id", data['lecture_id']).eq("segment_index", data['segment_index']).execute()
         if existing.data:
-            supabase.table("lecture_progress").update({status_type: new_val}).eq("id", existing.data[0]['id']).execute()
+            supabase.table("lecture_progress").update(
+                {"is_read": data['is_read'], "is_star": data['is_star']}).eq("id", existing.data[0]['id']).execute()
         else:
             supabase.table("lecture_progress").insert(data).execute()
+
+
+def flush_lecture_progress(uid, force=True):
+    """
+    把缓冲区里的段落状态一次 upsert 写回。
+    force=False 时只在攒够一批或最早的修改超过防抖间隔时才写。失败的修改保留在缓冲区，下次再试。
+    """
+    pending = st.session_state.get(LECTURE_PROGRESS_PENDING_KEY)
+    if not pending: return True
+    if not force and len(pending) < LECTURE_FLUSH_BATCH and time.time() - min(pending.values()) < LECTURE_FLUSH_INTERVAL:
         return True
+
+    cache = st.session_state.get(LECTURE_PROGRESS_CACHE_KEY, {})
+    keys = list(pending)
+    rows = []
+    for lid, idx in keys:
+        status = cache.get(lid, {}).get(idx, {})
+        # 每行都带完整的两个状态，避免批量 upsert 把另一列覆盖成默认值
+        rows.append({"user_id": uid, "lecture_id": lid, "segment_index": idx,
+                     "is_read": status.get('read', False), "is_star": status.get('star', False)})
+    try:
+        try:
+            supabase.table("lecture_progress").upsert(rows, on_conflict="user_id,lecture_id,segment_index").execute()
+        except Exception as e:
+            print(f"Progress upsert failed, falling back: {e}")
+            _flush_lecture_progress_legacy(uid, rows)
     except Exception as e:
         print(f"Update Error: {e}")
         return False
+    for k in keys:
+        pending.pop(k, None)
+    return True
+
+
+def _lecture_flush_timer(uid):
+    """定时写回：只重跑这个空片段，不会触发整页重跑"""
+    flush_lecture_progress(uid, force=False)
+
+
+# st.fragment 需要 Streamlit >= 1.37 (1.33-1.36 为 experimental_fragment)；更老的版本只在重跑时写回
+_st_fragment = getattr(st, "fragment", None) or getattr(st, "experimental_fragment", None)
+if _st_fragment:
+    _lecture_flush_timer = _st_fragment(run_every=LECTURE_FLUSH_INTERVAL)(_lecture_flush_timer)
+
+
+def update_segment_status(uid, lid, idx, status_type, new_val):
+    """更新某一段的状态：先改本地缓存 (界面立即生效)，再按批次/防抖写回数据库"""
+    set_segments_status(uid, lid, [idx], status_type, new_val)
+    return flush_lecture_progress(uid, force=False)
+
+
+def set_segments_status(uid, lid, indices, status_type, new_val):
+    """批量修改多段状态，只写缓冲区"""
+    lid = int(lid)
+    prog_map = get_lecture_progress(uid, lid)
+    if lid not in st.session_state.get(LECTURE_PROGRESS_CACHE_KEY, {}): return  # 原状态没读到，不盲写
+    pending = st.session_state.setdefault(LECTURE_PROGRESS_PENDING_KEY, {})
+    key = 'read' if status_type == "is_read" else 'star'
+    now = time.time()
+    for idx in indices:
+        status = prog_map.setdefault(idx, {'read': False, 'star': False})
+        if status[key] == new_val: continue
+        status[key] = new_val
+        pending.setdefault((lid, idx), now)
+
+
+def mark_segments_read_until(uid, lid, indices):
+    """"以上全部已读"：批量标记后立即写回"""
+    set_segments_status(uid, lid, indices, "is_read", True)
+    flush_lecture_progress(uid)
+
+
+@st.cache_data(show_spinner=False, max_entries=64)
+def get_lecture_segments(text, max_chars=1000):
+    """按内容缓存的分段结果 (同一篇讲义在各次重跑间只切一次)"""
+    return smart_lecture_segmentation(text, max_chars=max_chars)
 
 
 def smart_lecture_segmentation(text, max_chars=400):
@@ -326,10 +443,10 @@ def check_and_update_streak(uid):
                 # 如果是更早之前，保持为 1 (重置)
 
             # 更新数据库
-            supabase.table("study_profile").update({
+            update_user_profile(uid, {
                 "last_active_date": today_str,
                 "study_streak": new_streak
-            }).eq("user_id", uid).execute()
+            })
 
             return new_streak
     except Exception as e:
@@ -337,9 +454,6 @@ def check_and_update_streak(uid):
         return 0
 
 
-check_and_update_streak(user_id)
-
-
 # ==============================================================================
 # 3. 核心功能函数 (AI / DB / File)
 # ==============================================================================
@@ -373,25 +487,52 @@ def generate_audio_file(text, voice="zh-CN-XiaoxiaoNeural"):
 
 
 # --- 数据库 Helper 函数 ---
-def get_user_profile(uid):
+def get_user_profile(uid, refresh=False):
+    """
+    [性能优化] 会话级读穿缓存：每个会话只在首次 (或失效后) 查一次 study_profile，
+    侧边栏、打卡、设置保存与每次 AI 调用都复用这份数据。写操作请走 update_user_profile。
+    """
+    cache = st.session_state.setdefault('_profile_cache', {})
+    if not refresh and uid in cache:
+        return cache[uid]
     try:
         res = supabase.table("study_profile").select("*").eq("user_id", uid).execute()
         if not res.data:
             supabase.table("study_profile").insert({"user_id": uid}).execute()
-            return {}
-        return res.data[0]
+            profile = {"user_id": uid}
+        else:
+            profile = res.data[0]
     except:
-        return {}
+        return {}  # 查询失败不缓存，下次重试
+    cache[uid] = profile
+    return profile
+
+
+def invalidate_user_profile(uid=None):
+    """清掉会话中的档案缓存 (uid 为空时全部清掉)，下次读取会重新查询"""
+    cache = st.session_state.get('_profile_cache', {})
+    if uid is None:
+        cache.clear()
+    else:
+        cache.pop(uid, None)
+
+
+def update_user_profile(uid, fields):
+    """写入 study_profile 并同步到会话缓存 (写成功后直接合并，无需再查一次)"""
+    supabase.table("study_profile").update(fields).eq("user_id", uid).execute()
+    cache = st.session_state.get('_profile_cache', {})
+    if uid in cache:
+        cache[uid] = {**cache[uid], **fields}
 
 
 def update_settings(uid, settings_dict):
     """更新用户设置"""
     try:
-        curr = get_user_profile(uid).get('settings') or {}
+        curr = dict(get_user_profile(uid).get('settings') or {})
         curr.update(settings_dict)
-        supabase.table("study_profile").update({"settings": curr}).eq("user_id", uid).execute()
+        update_user_profile(uid, {"settings": curr})
     except:
-        pass
+        invalidate_user_profile(uid)
 
 
 def save_ai_pref():
@@ -422,13 +563,32 @@ def get_ai_client(provider, api_key, base_url=None):
     # 只有在使用 OpenAI SDK 的时候才初始化 Client
     if "DeepSeek" in provider or "OpenRouter" in provider or "Glama" in provider:
         try:
-            return OpenAI(api_key=api_key, base_url=base_url)
+            # 重试由 _call_ai_resolved 按错误类型统一处理 (含限流器与 Retry-After)，SDK 自带的重试要关掉
+            return OpenAI(api_key=api_key, base_url=base_url, max_retries=0)
         except Exception as e:
             print(f"Client Init Error: {e}")
             return None
     return None
 
 
+HTTP_POOL_CONNECTIONS = 8  # 缓存多少个不同主机的连接池
+HTTP_POOL_MAXSIZE = 32  # 每个主机最多保持的长连接数 (>= 各服务商并发上限)
+
+
+@st.cache_resource
+def get_http_session():
+    """
+    [性能优化] 进程级共享的 requests.Session：Gemini REST 与模型列表请求复用长连接 (keep-alive)，
+    省掉每次调用的 TCP + TLS 握手。requests 不支持 HTTP/2，这里只做连接池复用。
+    """
+    from requests.adapters import HTTPAdapter
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=HTTP_POOL_CONNECTIONS, pool_maxsize=HTTP_POOL_MAXSIZE, max_retries=0)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
 def clean_ai_json(text):
     """[鲁棒性] 清洗 AI 返回的 JSON，去除 Markdown 标记和不合法字符"""
     if not text: return ""
@@ -438,19 +598,735 @@ def clean_ai_json(text):
     return text.strip()
 
 
-def call_ai_universal(prompt, history=[], model_override=None, timeout_override=None, max_retries=1):
+# --- AI 响应缓存 (SQLite 持久化，跨会话/重启复用) ---
+LOCAL_DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".cache")
+AI_CACHE_DB_PATH = os.path.join(LOCAL_DATA_DIR, "ai_cache.sqlite")
+AI_CACHE_TTL = 7 * 24 * 3600  # 缓存有效期：7 天
+AI_CACHE_MAX_ENTRIES = 5000  # 超过上限按最近最少使用 (LRU) 淘汰
+AI_SYSTEM_PROMPT = "你是一位资深会计讲师。回答请使用 Markdown 格式。"
+
+
+class AIResponseCache:
+    """
+    [性能优化] 内容寻址的 AI 响应缓存
+    Key = hash(服务商, 模型, 系统提示词, 历史对话, 提示词)，相同请求直接返回，不再消耗 Token。
+    """
+
+    def __init__(self, db_path, ttl=AI_CACHE_TTL, max_entries=AI_CACHE_MAX_ENTRIES):
+        os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS ai_cache (
+                key TEXT PRIMARY KEY,
+                provider TEXT,
+                model TEXT,
+                response TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                last_access REAL NOT NULL
+            )
+        """)
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_ai_cache_access ON ai_cache(last_access)")
+        # 派生结果备忘 (如大纲分块考点)，按内容哈希存储；不参与 LRU 淘汰，过期时间与响应缓存相同
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS ai_memo (
+                namespace TEXT NOT NULL,
+                key TEXT NOT NULL,
+                value TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                PRIMARY KEY (namespace, key)
+            )
+        """)
+        self._conn.commit()
+
+    @staticmethod
+    def make_key(provider, model, system_prompt, history, prompt):
+        raw = json.dumps([provider, model, system_prompt, history or [], prompt], ensure_ascii=False, sort_keys=True)
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute("SELECT response, created_at FROM ai_cache WHERE key = ?", (key,)).fetchone()
+            if row and now - row[1] <= self.ttl:
+                self._conn.execute("UPDATE ai_cache SET last_access = ? WHERE key = ?", (now, key))
+                self._conn.commit()
+                self.hits += 1
+                return row[0]
+            if row:  # 已过期
+                self._conn.execute("DELETE FROM ai_cache WHERE key = ?", (key,))
+                self._conn.commit()
+            self.misses += 1
+            return None
+
+    def put(self, key, provider, model, response):
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO ai_cache (key, provider, model, response, created_at, last_access) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (key, provider, model, response, now, now))
+            # 容量控制：删掉最久未访问的条目
+            overflow = self._conn.execute("SELECT COUNT(*) FROM ai_cache").fetchone()[0] - self.max_entries
+            if overflow > 0:
+                self._conn.execute(
+                    "DELETE FROM ai_cache WHERE key IN "
+                    "(SELECT key FROM ai_cache ORDER BY last_access ASC LIMIT ?)", (overflow,))
+            self._conn.commit()
+
+    def get_memo(self, namespace, key):
+        with self._lock:
+            row = self._conn.execute("SELECT value, created_at FROM ai_memo WHERE namespace = ? AND key = ?",
+                                     (namespace, key)).fetchone()
+            if row and time.time() - row[1] > self.ttl:
+                self._conn.execute("DELETE FROM ai_memo WHERE namespace = ? AND key = ?", (namespace, key))
+                self._conn.commit()
+                return None
+        return json.loads(row[0]) if row else None
+
+    def put_memo(self, namespace, key, value):
+        with self._lock:
+            self._conn.execute("INSERT OR REPLACE INTO ai_memo (namespace, key, value, created_at) VALUES (?, ?, ?, ?)",
+                               (namespace, key, json.dumps(value, ensure_ascii=False), time.time()))
+            self._conn.commit()
+
+    def stats(self):
+        with self._lock:
+            entries = self._conn.execute("SELECT COUNT(*) FROM ai_cache").fetchone()[0]
+        return {"hits": self.hits, "misses": self.misses, "entries": entries}
+
+    def clear(self):
+        with self._lock:
+            self._conn.execute("DELETE FROM ai_cache")
+            self._conn.execute("DELETE FROM ai_memo")
+            self._conn.commit()
+            self.hits = 0
+            self.misses = 0
+
+
+@st.cache_resource
+def get_ai_response_cache():
+    """进程级单例，所有 Streamlit 会话共享同一个缓存库"""
+    try:
+        return AIResponseCache(AI_CACHE_DB_PATH)
+    except Exception as e:
+        print(f"AI Cache Init Error: {e}")
+        return None
+
+
+# --- AI 私教答案缓存：同一道题、同样的错解、相似的追问，直接复用讲解 ---
+TUTOR_SIMILARITY_THRESHOLD = 0.8  # 追问的字符 bigram 相似度达到该值视为同一个问题
+TUTOR_MAX_ANSWERS_PER_KEY = 50  # 每道题 + 错解下最多保留多少条追问答案
+
+
+def normalize_tutor_text(text):
+    """归一化：全半角统一、转小写、去掉空白与标点 (“为什么选A？” 与 “为什么选a” 视为相同)"""
+    text = unicodedata.normalize("NFKC", str(text or "")).lower()
+    return "".join(ch for ch in text if ch.isalnum())
+
+
+def _char_ngrams(text, n=2):
+    if len(text) < n: return {text} if text else set()
+    return {text[i:i + n] for i in range(len(text) - n + 1)}
+
+
+def _tutor_key_terms(text):
+    """决定问题含义的关键字：选项字母、数字、否定词，按出现顺序 (“为什么A而不是B” 与 “为什么B而不是A” 不同)"""
+    return re.findall(r'(?<![a-z])[a-h](?![a-z])|\d+|[不没非未]', text)
+
+
+def text_similarity(a, b):
+    """字符 n-gram 的 Jaccard 相似度，中文短句也适用"""
+    ga, gb = _char_ngrams(a), _char_ngrams(b)
+    if not ga and not gb: return 1.0
+    return len(ga & gb) / len(ga | gb)
+
+
+class TutorAnswerCache:
+    """
+    [性能优化] 私教讲解缓存：Key = (题目ID, 归一化错解, 归一化追问)，追问支持近似匹配。
+    复习时再次点开同一道错题，讲解秒出且不消耗 Token；“重新生成”会绕过并覆盖缓存。
+    """
+
+    def __init__(self, db_path):
+        os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS tutor_answers (
+                qid TEXT NOT NULL,
+                response_norm TEXT NOT NULL,
+                followup_norm TEXT NOT NULL,
+                answer TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                PRIMARY KEY (qid, response_norm, followup_norm)
+            )
+        """)
+        self._conn.commit()
+
+    def lookup(self, qid, user_response, followup="", threshold=TUTOR_SIMILARITY_THRESHOLD):
+        resp_norm, follow_norm = normalize_tutor_text(user_response), normalize_tutor_text(followup)
+        # 追问只剩标点/空白 (如“？？”) 时归一化为空，会撞上首次讲解的 Key，不走缓存
+        if (followup or "").strip() and not follow_norm: return None
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT followup_norm, answer FROM tutor_answers WHERE qid = ? AND response_norm = ?",
+                (str(qid), resp_norm)).fetchall()
+        best, best_score = None, 0.0
+        for cached_follow, answer in rows:
+            if cached_follow == follow_norm: return answer
+            # 首次讲解 (无追问) 只做精确匹配，不和追问混淆
+            if not cached_follow or not follow_norm: continue
+            # 字面相近但选项/数字/否定不同的追问问的是另一回事，不参与近似匹配
+            if _tutor_key_terms(cached_follow) != _tutor_key_terms(follow_norm): continue
+            score = text_similarity(cached_follow, follow_norm)
+            if score > best_score:
+                best, best_score = answer, score
+        return best if best_score >= threshold else None
+
+    def store(self, qid, user_response, followup, answer):
+        if (followup or "").strip() and not normalize_tutor_text(followup): return
+        resp_norm = normalize_tutor_text(user_response)
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO tutor_answers (qid, response_norm, followup_norm, answer, created_at) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (str(qid), resp_norm, normalize_tutor_text(followup), answer, time.time()))
+            # 单题追问过多时淘汰最旧的
+            self._conn.execute(
+                "DELETE FROM tutor_answers WHERE qid = ? AND response_norm = ? AND rowid NOT IN "
+                "(SELECT rowid FROM tutor_answers WHERE qid = ? AND response_norm = ? "
+                "ORDER BY created_at DESC LIMIT ?)",
+                (str(qid), resp_norm, str(qid), resp_norm, TUTOR_MAX_ANSWERS_PER_KEY))
+            self._conn.commit()
+
+    def count(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM tutor_answers").fetchone()[0]
+
+    def clear(self):
+        with self._lock:
+            self._conn.execute("DELETE FROM tutor_answers")
+            self._conn.commit()
+
+
+@st.cache_resource
+def get_tutor_answer_cache():
+    try:
+        return TutorAnswerCache(AI_CACHE_DB_PATH)
+    except Exception as e:
+        print(f"Tutor Cache Init Error: {e}")
+        return None
+
+
+# --- AI 调用遥测 (与响应缓存同库，ai_calls 表只追加不修改) ---
+AI_TELEMETRY_DAYS = 7  # 设置中心默认统计最近几天
+
+
+class AITelemetry:
+    """
+    [可观测性] 每次 AI 调用记录一行：功能标签、服务商/模型、Token 用量、耗时、重试次数、是否命中缓存。
+    设置中心据此按“功能 × 天”统计 p50/p95 耗时与 Token 消耗，用数据来调超时和选模型。
+    """
+
+    def __init__(self, db_path):
+        os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS ai_calls (
+                ts REAL NOT NULL,
+                day TEXT NOT NULL,
+                feature TEXT NOT NULL,
+                provider TEXT,
+                model TEXT,
+                prompt_tokens INTEGER DEFAULT 0,
+                completion_tokens INTEGER DEFAULT 0,
+                latency_ms INTEGER DEFAULT 0,
+                retries INTEGER DEFAULT 0,
+                cache_hit INTEGER DEFAULT 0,
+                ok INTEGER DEFAULT 1,
+                error_kind TEXT
+            )
+        """)
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_ai_calls_day ON ai_calls(day, feature)")
+        self._conn.commit()
+
+    def record(self, feature, provider, model, prompt_tokens=0, completion_tokens=0, latency=0.0, retries=0,
+               cache_hit=False, ok=True, error_kind=None):
+        now = time.time()
+        try:
+            with self._lock:
+                self._conn.execute(
+                    "INSERT INTO ai_calls (ts, day, feature, provider, model, prompt_tokens, completion_tokens, "
+                    "latency_ms, retries, cache_hit, ok, error_kind) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    (now, datetime.date.fromtimestamp(now).isoformat(), feature or "general", provider, model,
+                     int(prompt_tokens or 0), int(completion_tokens or 0), int(latency * 1000), retries,
+                     int(bool(cache_hit)), int(bool(ok)), error_kind))
+                self._conn.commit()
+        except sqlite3.Error as e:
+            print(f"AI Telemetry Error: {e}")  # 遥测失败不能影响业务
+
+    def model_stats(self, days=3, window=200):
+        """
+        最近每个模型 (及 功能 × 模型) 的滚动统计：样本数、成功调用的 p50 耗时、失败率。
+        每组只看最近 window 次真实请求 (不含缓存命中)。
+        """
+        since = time.time() - days * 86400
+        with self._lock:
+            df = pd.read_sql_query(
+                "SELECT feature, model, latency_ms, ok FROM ai_calls "
+                "WHERE ts >= ? AND cache_hit = 0 AND model IS NOT NULL ORDER BY ts DESC",
+                self._conn, params=(since,))
+
+        def _summarize(g):
+            g = g.head(window)
+            ok = g[g['ok'] == 1]
+            return {"n": len(g), "p50": ok['latency_ms'].median() / 1000 if len(ok) else None,
+                    "fail_rate": float(1 - g['ok'].mean())}
+
+        return {
+            "by_model": {m: _summarize(g) for m, g in df.groupby('model')},
+            "by_feature": {f"{f}|{m}": _summarize(g) for (f, m), g in df.groupby(['feature', 'model'])},
+        }
+
+    def load(self, days=AI_TELEMETRY_DAYS):
+        since = (datetime.date.today() - datetime.timedelta(days=days - 1)).isoformat()
+        with self._lock:
+            return pd.read_sql_query("SELECT * FROM ai_calls WHERE day >= ? ORDER BY ts", self._conn, params=(since,))
+
+
+@st.cache_resource
+def get_ai_telemetry():
+    try:
+        return AITelemetry(AI_CACHE_DB_PATH)
+    except Exception as e:
+        print(f"AI Telemetry Init Error: {e}")
+        return None
+
+
+def record_ai_call(feature, provider, model, **kwargs):
+    telemetry = get_ai_telemetry()
+    if telemetry: telemetry.record(feature, provider, model, **kwargs)
+
+
+def summarize_ai_calls(df):
+    """按 (天, 功能) 汇总：调用数、缓存命中率、失败数、p50/p95 耗时 (不含缓存命中)、Token 消耗"""
+    if df is None or df.empty: return pd.DataFrame()
+
+    # 模型目录里有价格的，顺便估算费用 (美元)
+    catalog = get_model_catalog()
+
+    def _cost(row):
+        meta = catalog.lookup(row['model']) or {}
+        return (row['prompt_tokens'] * (meta.get('prompt_price') or 0)
+                + row['completion_tokens'] * (meta.get('completion_price') or 0)) / 1_000_000
+
+    df = df.assign(cost=df.apply(_cost, axis=1))
+    rows = []
+    for (day, feature), g in df.groupby(['day', 'feature']):
+        live = g[g['cache_hit'] == 0]
+        rows.append({
+            "日期": day,
+            "功能": feature,
+            "调用数": len(g),
+            "缓存命中": f"{int(g['cache_hit'].mean() * 100)}%",
+            "失败": int((g['ok'] == 0).sum()),
+            "p50 耗时(秒)": round(live['latency_ms'].quantile(0.5) / 1000, 2) if len(live) else 0,
+            "p95 耗时(秒)": round(live['latency_ms'].quantile(0.95) / 1000, 2) if len(live) else 0,
+            "输入 Token": int(g['prompt_tokens'].sum()),
+            "输出 Token": int(g['completion_tokens'].sum()),
+            "平均重试": round(g['retries'].mean(), 2),
+            "估算费用($)": round(g['cost'].sum(), 4),
+        })
+    return pd.DataFrame(rows).sort_values(["日期", "功能"], ascending=[False, True])
+
+
+# --- AI 错误分类：不同错误类型采用不同的重试策略 ---
+class AIError(Exception):
+    """AI 调用错误基类；kind 决定重试策略 (见 _call_ai_resolved)"""
+    kind = "transient"
+
+    def __init__(self, message, retry_after=None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class AITransientError(AIError):
+    """超时、连接中断、5xx：指数退避 + 随机抖动后重试"""
+    kind = "transient"
+
+
+class AIRateLimitError(AIError):
+    """429 / 配额超限：按 Retry-After 暂停该模型，排队后重发；retry_after 可能为 None"""
+    kind = "rate_limited"
+
+
+class AIAuthError(AIError):
+    """401/403、密钥未配置：重试必然失败，直接放弃"""
+    kind = "auth"
+
+
+class AIBadRequestError(AIError):
+    """400/404/422 (参数错误、模型不存在)：不重试"""
+    kind = "bad_request"
+
+
+class AIContextTooLongError(AIBadRequestError):
+    """输入超出模型上下文窗口：裁剪提示词后重试"""
+    kind = "context_too_long"
+
+
+AI_ERROR_LABELS = {
+    "transient": "网络或服务暂时异常",
+    "rate_limited": "触发限流/配额",
+    "auth": "密钥无效或未配置",
+    "bad_request": "请求参数错误",
+    "context_too_long": "输入超出上下文长度",
+}
+AI_CONTEXT_TOO_LONG_PATTERNS = ("context_length_exceeded", "maximum context length", "context length",
+                                "too many tokens", "exceeds the maximum number of tokens", "input token count",
+                                "prompt is too long", "request too large")
+AI_AUTH_PATTERNS = ("api key not valid", "invalid api key", "incorrect api key", "permission_denied",
+                    "unauthorized")
+AI_RETRY_BACKOFF_BASE = 1.0  # 指数退避基数 (秒)
+AI_RETRY_BACKOFF_CAP = 30.0  # 单次退避上限 (秒)
+AI_CONTEXT_SHRINK_RATIO = 0.7  # 超长时每次保留的比例
+AI_CONTEXT_MAX_SHRINKS = 2
+
+
+def classify_ai_error(status_code, body="", headers=None):
+    """按 HTTP 状态码 + 错误信息归类为具体的 AIError"""
+    body = str(body or "")
+    low = body.lower()
+    msg = f"HTTP {status_code}: {body[:300]}"
+    if status_code == 429 or "resource_exhausted" in low or "quotafailure" in low:
+        return AIRateLimitError(msg, retry_after=parse_retry_after(headers, body))
+    if status_code == 413 or any(p in low for p in AI_CONTEXT_TOO_LONG_PATTERNS):
+        return AIContextTooLongError(msg)
+    if status_code in (401, 403) or any(p in low for p in AI_AUTH_PATTERNS):
+        return AIAuthError(msg)
+    if status_code in (400, 404, 422):
+        return AIBadRequestError(msg)
+    return AITransientError(msg)
+
+
+def _as_ai_error(e):
+    """把 requests / OpenAI SDK 抛出的任意异常归一化为 AIError"""
+    if isinstance(e, AIError): return e
+    status = getattr(e, 'status_code', None)
+    if status is not None:
+        err_resp = getattr(e, 'response', None)
+        return classify_ai_error(status, str(e), err_resp.headers if err_resp is not None else None)
+    # 超时、断连、返回结构异常等一律视为暂时性错误
+    return AITransientError(f"{type(e).__name__}: {e}")
+
+
+def _backoff_delay(attempt):
+    """指数退避 + 全量抖动：避免多个请求在同一时刻一起重试，把本就过载的服务商再次打满"""
+    return random.uniform(0, min(AI_RETRY_BACKOFF_CAP, AI_RETRY_BACKOFF_BASE * (2 ** attempt)))
+
+
+def _shrink_ai_input(prompt, history):
+    """
+    上下文超长时裁剪输入：优先丢弃较早的对话历史；其次只截短提示词里最长的几段 (教材/题目原文)，
+    开头的任务说明与结尾的答题要求、JSON 格式要求等短段落保持原样。
+    """
+    if history:
+        return prompt, history[len(history) // 2 + 1:]
+    parts = prompt.split("\n\n")
+    excess = len(prompt) - int(len(prompt) * AI_CONTEXT_SHRINK_RATIO)
+    # 找到最大的段长上限 limit，使超出 limit 的部分合计不少于 excess，只截超出的段
+    lo, hi = 0, max(len(p) for p in parts)
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if sum(max(0, len(p) - mid) for p in parts) >= excess:
+            lo = mid
+        else:
+            hi = mid - 1
+    parts = [p[:lo] + "\n……(内容过长，已自动截断)" if len(p) > lo else p for p in parts]
+    return "\n\n".join(parts), history
+
+
+class AIFailure(str):
+    """
+    AI 调用失败的返回值：仍是以 ❌ 开头的字符串 (老代码可直接展示)，
+    另外携带 kind / error，调用方可以按错误类型给出提示。
+    """
+
+    def __new__(cls, message, kind="transient", error=None):
+        obj = super().__new__(cls, message)
+        obj.kind = kind
+        obj.error = error
+        return obj
+
+    @classmethod
+    def from_error(cls, err, attempts=0):
+        label = AI_ERROR_LABELS.get(err.kind, err.kind)
+        return cls(f"❌ AI 调用失败 [{label}] (已重试{attempts}次): {err}", kind=err.kind, error=err)
+
+
+def is_ai_failure(text):
+    """判断 call_ai_universal 的返回是否为失败提示"""
+    if isinstance(text, AIFailure): return True
+    return not text or text.startswith("❌") or text == "AI Client 初始化失败"
+
+
+def _is_cacheable_reply(text):
+    """只缓存正常回答，错误提示不入库"""
+    return not is_ai_failure(text)
+
+
+# --- 并发调度：按服务商限制同时在途的请求数 ---
+AI_PROVIDER_MAX_IN_FLIGHT = {"Gemini": 4, "DeepSeek": 8, "OpenRouter": 4, "Glama": 4}
+
+
+@st.cache_resource
+def get_provider_slots():
+    """进程级信号量表 {服务商: BoundedSemaphore}，所有会话共享同一份并发额度"""
+    return {"lock": threading.Lock(), "slots": {}}
+
+
+def _provider_family(provider, model_override=None):
+    """归一化服务商名称 (实际请求的是哪个网关)"""
+    if model_override and "gemini" in model_override and "openrouter" in st.secrets:
+        return "OpenRouter"
+    for name in AI_PROVIDER_MAX_IN_FLIGHT:
+        if name in provider: return name
+    return provider
+
+
+def get_provider_max_in_flight(family):
+    """并发上限：secrets 中 [ai_concurrency] 可覆盖默认值"""
+    if "ai_concurrency" in st.secrets and family in st.secrets["ai_concurrency"]:
+        return max(1, int(st.secrets["ai_concurrency"][family]))
+    return AI_PROVIDER_MAX_IN_FLIGHT.get(family, 4)
+
+
+def _provider_slot(family):
+    registry = get_provider_slots()
+    with registry['lock']:
+        sem = registry['slots'].get(family)
+        if sem is None:
+            sem = threading.BoundedSemaphore(get_provider_max_in_flight(family))
+            registry['slots'][family] = sem
+    return sem
+
+
+# --- 限流：每个服务商/模型的令牌桶 (请求数/分钟 + Token/分钟) ---
+AI_RATE_LIMITS = {
+    "Gemini": {"rpm": 15, "tpm": 1000000},
+    "DeepSeek": {"rpm": 60, "tpm": 1000000},
+    "OpenRouter": {"rpm": 20, "tpm": 200000},
+    "Glama": {"rpm": 60, "tpm": 500000},
+}  # secrets 中 [ai_rate_limits.Gemini] rpm/tpm 可覆盖
+AI_RATE_LIMIT_MAX_WAIT = 300  # 单次请求在本地排队的最长时间 (秒)
+AI_RATE_LIMIT_MAX_429 = 5  # 被服务商限流后，按 Retry-After 等待重发的最多次数
+AI_EST_OUTPUT_TOKENS = 1500  # 发请求前无法知道输出长度，先按此预占，返回后按实际用量校正
+
+
+def estimate_tokens(text):
+    """粗估 Token 数：中日韩字符约 1 字 1 Token，其余字符约 4 个 1 Token"""
+    if not text: return 0
+    cjk = len(re.findall(r'[\u3000-\u303f\u3400-\u9fff\uf900-\ufaff\uff00-\uffef]', text))
+    return cjk + (len(text) - cjk) // 4 + 1
+
+
+def _parse_duration_seconds(value):
+    """解析限流头里的时间：'20' / '1.5s' / '6m0s' / '250ms' / 毫秒或秒级时间戳"""
+    if value is None: return None
+    value = str(value).strip()
+    try:
+        num = float(value)
+        if num > 1e12: return max(0.0, num / 1000 - time.time())  # 毫秒时间戳 (OpenRouter)
+        if num > 1e9: return max(0.0, num - time.time())  # 秒级时间戳
+        return max(0.0, num)
+    except ValueError:
+        pass
+    if value.endswith("ms") and value[:-2].replace(".", "", 1).isdigit():
+        return float(value[:-2]) / 1000
+    m = re.fullmatch(r'(?:(\d+)h)?(?:(\d+)m)?(?:([\d.]+)s)?', value)
+    if m and any(m.groups()):
+        h, mi, sec = m.groups()
+        return int(h or 0) * 3600 + int(mi or 0) * 60 + float(sec or 0)
+    try:
+        from email.utils import parsedate_to_datetime
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except Exception:
+        return None
+
+
+def parse_retry_after(headers, body=""):
+    """从 Retry-After 头或 Gemini 错误体里的 retryDelay 读出建议等待秒数"""
+    headers = headers or {}
+    for h in ("retry-after", "Retry-After", "x-ratelimit-reset-requests", "X-RateLimit-Reset"):
+        if headers.get(h):
+            secs = _parse_duration_seconds(headers.get(h))
+            if secs is not None: return secs
+    m = re.search(r'"retryDelay"\s*:\s*"([\d.]+)s"', body or "")
+    return float(m.group(1)) if m else None
+
+
+class AIRateLimiter:
+    """
+    [性能优化] 进程级令牌桶：按 (服务商, 模型) 分别限制每分钟请求数与 Token 数。
+    - 超额的调用在 acquire 中排队，而不是直接失败；批量任务因此能以可持续的最大速率跑完
+    - 服务商返回的限流头 / Retry-After 会同步到桶里，所有会话共享
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._buckets = {}
+
+    @staticmethod
+    def _limits(family):
+        limits = dict(AI_RATE_LIMITS.get(family, {"rpm": 60, "tpm": 1000000}))
+        if "ai_rate_limits" in st.secrets and family in st.secrets["ai_rate_limits"]:
+            limits.update({k: int(v) for k, v in dict(st.secrets["ai_rate_limits"][family]).items()})
+        return {"rpm": max(1, limits['rpm']), "tpm": max(1, limits['tpm'])}
+
+    def _bucket(self, family, model):
+        b = self._buckets.get((family, model))
+        if b is None:
+            lim = self._limits(family)
+            b = {"rpm": lim['rpm'], "tpm": lim['tpm'], "req": float(lim['rpm']), "tok": float(lim['tpm']),
+                 "ts": time.monotonic(), "blocked_until": 0.0, "server": {}}
+            self._buckets[(family, model)] = b
+        return b
+
+    @staticmethod
+    def _refill(b, now):
+        elapsed = now - b['ts']
+        b['req'] = min(b['rpm'], b['req'] + elapsed * b['rpm'] / 60.0)
+        b['tok'] = min(b['tpm'], b['tok'] + elapsed * b['tpm'] / 60.0)
+        b['ts'] = now
+
+    def acquire(self, family, model, tokens=0, max_wait=AI_RATE_LIMIT_MAX_WAIT):
+        """阻塞直到额度足够并扣减；排队超过 max_wait 返回 False"""
+        start = time.monotonic()
+        while True:
+            with self._lock:
+                b = self._bucket(family, model)
+                now = time.monotonic()
+                self._refill(b, now)
+                need = min(tokens, b['tpm'])  # 单个超大请求最多等一整桶，不会永远排不上
+                if now >= b['blocked_until'] and b['req'] >= 1 and b['tok'] >= need:
+                    b['req'] -= 1
+                    b['tok'] -= need
+                    return True
+                wait_s = max(b['blocked_until'] - now,
+                             (1 - b['req']) * 60.0 / b['rpm'],
+                             (need - b['tok']) * 60.0 / b['tpm'])
+            if time.monotonic() - start + wait_s > max_wait:
+                return False
+            time.sleep(min(max(wait_s, 0.05), 5))
+
+    def settle(self, family, model, reserved, actual):
+        """按实际 Token 用量校正预占额度"""
+        if not actual: return
+        with self._lock:
+            b = self._bucket(family, model)
+            b['tok'] = min(b['tpm'], b['tok'] + reserved - actual)
+
+    def penalize(self, family, model, retry_after=None):
+        """被服务商限流：在 retry_after 秒内暂停该模型的所有请求 (未给出时按 1 个请求间隔估算)"""
+        with self._lock:
+            b = self._bucket(family, model)
+            delay = retry_after if retry_after is not None else max(2.0, 60.0 / b['rpm'])
+            b['blocked_until'] = max(b['blocked_until'], time.monotonic() + delay)
+            b['req'] = min(b['req'], 0.0)
+
+    def update_from_headers(self, family, model, headers):
+        """读取 x-ratelimit-* 响应头：记录服务端余量，余量耗尽时暂停到重置时间"""
+        if not headers: return
+        info = {}
+        for src, dst in (("x-ratelimit-remaining-requests", "remaining_requests"),
+                         ("x-ratelimit-remaining", "remaining_requests"),
+                         ("x-ratelimit-remaining-tokens", "remaining_tokens"),
+                         ("x-ratelimit-limit-requests", "limit_requests"),
+                         ("x-ratelimit-limit", "limit_requests")):
+            val = headers.get(src)
+            if val is not None:
+                try:
+                    info[dst] = int(float(val))
+                except ValueError:
+                    pass
+        if not info: return
+        with self._lock:
+            b = self._bucket(family, model)
+            b['server'] = {**info, "at": time.time()}
+            if info.get('remaining_requests') == 0 or info.get('remaining_tokens') == 0:
+                reset = _parse_duration_seconds(headers.get("x-ratelimit-reset-requests")
+                                                or headers.get("x-ratelimit-reset-tokens")
+                                                or headers.get("x-ratelimit-reset"))
+                if reset:
+                    b['blocked_until'] = max(b['blocked_until'], time.monotonic() + reset)
+
+    def snapshot(self, family, model):
+        """侧边栏展示用：本地桶余量 + 服务端最近一次返回的余量"""
+        with self._lock:
+            b = self._bucket(family, model)
+            now = time.monotonic()
+            self._refill(b, now)
+            return {"rpm": b['rpm'], "tpm": b['tpm'], "req": int(b['req']), "tok": int(b['tok']),
+                    "blocked": max(0.0, b['blocked_until'] - now), "server": dict(b['server'])}
+
+
+@st.cache_resource
+def get_ai_rate_limiter():
+    return AIRateLimiter()
+
+
+def _openai_chat_create(client, family, target_model, **kwargs):
     """
-    [功能增强] 统一 AI 调用入口：支持重试、错误捕获、客户端复用
+    OpenAI 兼容接口调用：读取响应头同步限流状态，SDK 异常统一转换成 AIError。
+    stream=True 时返回流对象，否则返回完整响应。
     """
-    # 1. 确定超时设置
+    limiter = get_ai_rate_limiter()
+    try:
+        raw = client.chat.completions.with_raw_response.create(model=target_model, **kwargs)
+    except Exception as e:
+        raise _as_ai_error(e) from e
+    limiter.update_from_headers(family, target_model, raw.headers)
+    return raw.parse()
+
+
+# --- 本地模拟服务商：secrets 中配置 [mock_ai] base_url 后，所有 AI 请求改发到 mock_ai_server.py ---
+GEMINI_API_BASE = "https://generativelanguage.googleapis.com"
+
+
+def get_mock_ai_base():
+    """离线压测/调试用，例如 [mock_ai] base_url = "http://127.0.0.1:8765" """
+    if "mock_ai" in st.secrets and st.secrets["mock_ai"].get("base_url"):
+        return str(st.secrets["mock_ai"]["base_url"]).rstrip("/")
+    return None
+
+
+def _gemini_api_base():
+    return get_mock_ai_base() or GEMINI_API_BASE
+
+
+def _get_ai_user_settings():
+    profile = get_user_profile(st.session_state.get('user_id', 'test_user'))
+    return profile.get('settings') or {}
+
+
+def _resolve_ai_timeout(timeout_override=None):
+    """超时优先级：调用方指定 > 用户设置 > 默认 60 秒"""
     if timeout_override is not None:
-        current_timeout = timeout_override
-    else:
-        profile = get_user_profile(st.session_state.get('user_id', 'test_user'))
-        settings = profile.get('settings') or {}
-        current_timeout = settings.get('ai_timeout', 60)
+        return timeout_override
+    return _get_ai_user_settings().get('ai_timeout', 60)
 
-    # 2. 确定服务商与模型
+
+def _resolve_ai_target(model_override=None):
+    """确定服务商与模型，返回 (provider, target_model)"""
     provider = st.session_state.get('selected_provider', 'Gemini')
     target_model = None
 
@@ -458,99 +1334,628 @@ def call_ai_universal(prompt, history=[], model_override=None, timeout_override=
     if model_override:
         target_model = model_override
     elif "Gemini" in provider:
-        target_model = st.session_state.get('google_model_id', 'gemini-1.5-flash')
+        target_model = st.session_state.get('google_model_id', AI_PROVIDER_DEFAULT_MODELS["Gemini"])
     elif "DeepSeek" in provider:
-        target_model = st.session_state.get('deepseek_model_id', 'deepseek-chat')
+        target_model = st.session_state.get('deepseek_model_id', AI_PROVIDER_DEFAULT_MODELS["DeepSeek"])
     elif "OpenRouter" in provider:
-        target_model = st.session_state.get('openrouter_model_id', 'google/gemini-2.0-flash-exp:free')
+        target_model = st.session_state.get('openrouter_model_id', AI_PROVIDER_DEFAULT_MODELS["OpenRouter"])
     elif "Glama" in provider:
-        target_model = st.session_state.get('glama_model_id', 'openai/gpt-4o-mini')
+        target_model = st.session_state.get('glama_model_id', AI_PROVIDER_DEFAULT_MODELS["Glama"])
+
+    if not target_model: target_model = AI_PROVIDER_DEFAULT_MODELS["Gemini"]
+    return provider, target_model
+
+
+# --- 服务商容灾：备用链路 + 对冲请求 ---
+AI_PROVIDER_DEFAULT_MODELS = {
+    "Gemini": "gemini-1.5-flash",
+    "DeepSeek": "deepseek-chat",
+    "OpenRouter": "google/gemini-2.0-flash-exp:free",
+    "Glama": "openai/gpt-4o-mini",
+}
+AI_FALLBACK_CHAIN = ["Gemini", "DeepSeek", "OpenRouter"]  # secrets 中 [ai_fallback] chain 可覆盖
+AI_HEDGE_DEFAULT_DELAY = 8.0  # 延迟样本不足时，等待多少秒后发起对冲请求
+AI_LATENCY_SAMPLE_SIZE = 50
+
+
+@st.cache_resource
+def get_ai_latency_stats():
+    """进程级延迟样本 {服务商: deque[秒]}，用于估算对冲触发时间 (p90)"""
+    return {"lock": threading.Lock(), "samples": {}}
+
+
+def record_ai_latency(family, seconds):
+    stats = get_ai_latency_stats()
+    with stats['lock']:
+        stats['samples'].setdefault(family, collections.deque(maxlen=AI_LATENCY_SAMPLE_SIZE)).append(seconds)
+
+
+def get_ai_latency_p90(family):
+    stats = get_ai_latency_stats()
+    with stats['lock']:
+        samples = sorted(stats['samples'].get(family, []))
+    if len(samples) < 5: return AI_HEDGE_DEFAULT_DELAY
+    return samples[int(0.9 * (len(samples) - 1))]
+
+
+def _provider_configured(family):
+    if get_mock_ai_base(): return True  # 本地模拟服务商同时扮演所有服务商
+    if family == "Gemini": return bool(API_KEY)
+    return family.lower() in st.secrets
+
+
+def get_fallback_chain():
+    """备用服务商顺序 (只保留 secrets 中已配置密钥的)"""
+    chain = AI_FALLBACK_CHAIN
+    if "ai_fallback" in st.secrets and "chain" in st.secrets["ai_fallback"]:
+        chain = list(st.secrets["ai_fallback"]["chain"])
+    return [f for f in chain if f in AI_PROVIDER_DEFAULT_MODELS and _provider_configured(f)]
+
+
+def _resolve_ai_failover():
+    """用户设置中的容灾开关：自动切换默认开启，对冲请求默认关闭"""
+    settings = _get_ai_user_settings()
+    return {"failover": settings.get('ai_failover', True), "hedge": settings.get('ai_hedge', False)}
+
+
+def _build_ai_candidates(provider, target_model, model_override, failover):
+    """候选列表 [(provider, model, model_override)]：首选为当前选择，其余按备用链路补齐"""
+    candidates = [(provider, target_model, model_override)]
+    if failover:
+        primary = _provider_family(provider, model_override)
+        for family in get_fallback_chain():
+            if family != primary:
+                candidates.append((family, AI_PROVIDER_DEFAULT_MODELS[family], None))
+    return candidates
+
+
+# --- 按任务类型自动选模型：根据本应用实测的延迟/失败率路由 ---
+# 只对短小的结构化任务生效，且需用户主动开启；长文生成、答疑等始终使用侧边栏所选模型。
+# 候选取自本地模型目录 (服务商实际在线的模型)，并限定在所选服务商 (聚合平台则限定同一厂商) 之内。
+AI_FEATURE_POLICIES = {
+    "toc_parse": "fastest",
+    "grading": "fastest",
+    "outline_map": "fastest",
+    "exam_date": "cheapest",
+}
+AI_POLICY_QUALITY_FLOOR = {"fastest": 2, "cheapest": 1, "best": 3}
+AI_POLICY_LABELS = {"fastest": "⚡ 最快", "cheapest": "💰 最省", "best": "🏆 最好"}
+AI_ROUTE_MIN_SAMPLES = 5  # 样本不足时用先验延迟
+AI_ROUTE_MAX_FAIL_RATE = 0.5  # 近期失败率超过该值的模型暂不参与路由
+AI_ROUTE_TIER_PRIORS = {1: (2.0, 0.05), 2: (3.0, 0.10), 3: (8.0, 1.00)}  # 档位 -> (先验延迟秒, 兜底价格 美元/百万 Token)
+AI_ROUTE_EXCLUDE = ("embedding", "aqa", "tts", "image", "audio", "live", "vision", "-exp", "preview", "thinking")
+
+
+def _model_tier(model_id):
+    """按模型名粗略判断质量档位：1 轻量 / 2 常规 / 3 旗舰"""
+    words = set(re.split(r'[-/:._\s]+', model_id.lower()))  # 按词匹配，避免 "gemini" 命中 "mini"
+    if words & {"8b", "lite", "mini", "nano", "haiku", "small", "tiny"}: return 1
+    if words & {"pro", "opus", "sonnet", "large", "reasoner", "4o", "gpt4o"}: return 3
+    return 2
+
+
+def get_ai_route_pool(provider, target_model):
+    """路由候选：所选服务商目录里在线的对话模型 [(family, model, tier, price, prior_latency)]"""
+    family = _provider_family(provider, None)
+    if not _provider_configured(family): return []
+    vendor = target_model.split("/")[0] + "/" if target_model and "/" in target_model else ""
+    pool = []
+    for m in get_model_catalog().models(family):
+        mid = m['id']
+        if vendor and not mid.startswith(vendor): continue  # 聚合平台只在同一厂商内挑
+        if any(k in mid.lower() for k in AI_ROUTE_EXCLUDE): continue  # 非对话 / 实验性模型
+        tier = _model_tier(mid)
+        prior_latency, fallback_price = AI_ROUTE_TIER_PRIORS[tier]
+        price = m.get('prompt_price')
+        pool.append((family, mid, tier, fallback_price if price is None else price, prior_latency))
+    return pool
+
+
+@st.cache_data(ttl=60, show_spinner=False)
+def get_ai_model_stats():
+    telemetry = get_ai_telemetry()
+    return telemetry.model_stats() if telemetry else {"by_model": {}, "by_feature": {}}
+
+
+def route_ai_model(feature, provider=None, target_model=None):
+    """按功能策略选出 (服务商, 模型)；该功能没有策略或没有可用模型时返回 None"""
+    policy = AI_FEATURE_POLICIES.get(feature)
+    if not policy: return None
+    if provider is None:
+        provider, target_model = _resolve_ai_target()
+    stats = get_ai_model_stats()
+
+    options = []
+    for family, model, tier, price, prior_latency in get_ai_route_pool(provider, target_model):
+        if tier < AI_POLICY_QUALITY_FLOOR[policy]: continue
+        ms = stats['by_feature'].get(f"{feature}|{model}") or {}
+        if ms.get('n', 0) < AI_ROUTE_MIN_SAMPLES:
+            ms = stats['by_model'].get(model) or {}
+        enough = ms.get('n', 0) >= AI_ROUTE_MIN_SAMPLES
+        if enough and ms['fail_rate'] > AI_ROUTE_MAX_FAIL_RATE: continue
+        latency = ms['p50'] if enough and ms.get('p50') else prior_latency
+        latency *= 1 + 2 * (ms.get('fail_rate', 0) if enough else 0)  # 失败要重试，按期望耗时折算
+        options.append({"family": family, "model": model, "tier": tier, "latency": latency, "price": price})
+    if not options: return None
+
+    if policy == "fastest":
+        best = min(options, key=lambda o: (o['latency'], o['price']))
+    elif policy == "cheapest":
+        best = min(options, key=lambda o: (o['price'], o['latency']))
+    else:
+        best = min(options, key=lambda o: (-o['tier'], o['latency']))
+    return best['family'], best['model']
+
+
+def _script_ctx_initializer():
+    """线程池 initializer：把当前会话上下文挂到工作线程上"""
+    ctx = get_script_run_ctx() if get_script_run_ctx else None
 
-    if not target_model: target_model = "gemini-1.5-flash"
+    def _attach_ctx():
+        if ctx and add_script_run_ctx:
+            add_script_run_ctx(threading.current_thread(), ctx)
+
+    return _attach_ctx
+
+
+def _call_ai_hedged(attempt_fn, primary, backup):
+    """
+    对冲请求：主服务商超过其 p90 延迟仍未返回 (或已失败) 时，并行请求备用服务商，先成功者胜出。
+    落败的请求无法中途掐断 HTTP 连接，会在后台自然结束 (结果照常写入缓存)。
+    """
+    pool = ThreadPoolExecutor(max_workers=2, initializer=_script_ctx_initializer())
+    try:
+        futures = [pool.submit(attempt_fn, primary)]
+        done, _ = wait(futures, timeout=get_ai_latency_p90(_provider_family(primary[0], primary[2])))
+        if not done or is_ai_failure(futures[0].result()):
+            futures.append(pool.submit(attempt_fn, backup))
+
+        last = None
+        for fut in as_completed(futures):
+            res = fut.result()
+            if not is_ai_failure(res): return res
+            last = res
+        return last
+    finally:
+        pool.shutdown(wait=False, cancel_futures=True)
+
+
+def _call_ai_with_failover(prompt, history, candidates, current_timeout, max_retries, use_cache, hedge=False,
+                           feature="general"):
+    """按候选顺序依次尝试，返回第一个成功的回答；全部失败时返回最后一个错误提示"""
+
+    def _attempt(cand):
+        provider, target_model, model_override = cand
+        return _call_ai_resolved(prompt, history, provider, target_model, model_override, current_timeout,
+                                 max_retries, use_cache, feature=feature)
+
+    remaining = list(candidates)
+    last = AIFailure("❌ 没有可用的 AI 服务商", kind="auth")
+    if hedge and len(remaining) > 1:
+        res = _call_ai_hedged(_attempt, remaining[0], remaining[1])
+        if not is_ai_failure(res): return res
+        last = res
+        remaining = remaining[2:]
+
+    for cand in remaining:
+        res = _attempt(cand)
+        if not is_ai_failure(res): return res
+        last = res
+    return last
+
+
+def _use_gemini_rest(provider, model_override=None):
+    """Gemini 直连走 REST API (不依赖 OpenAI SDK)"""
+    return "Gemini" in provider and not model_override
+
+
+def _resolve_openai_endpoint(provider, model_override=None):
+    """OpenAI 兼容模式的凭证，返回 (api_key, base_url, error_msg)"""
+    api_key = ""
+    base_url = ""
+
+    mock_base = get_mock_ai_base()
+    if mock_base:
+        return "mock-key", f"{mock_base}/v1", None
+
+    if model_override and "gemini" in model_override and "openrouter" in st.secrets:
+        api_key = st.secrets["openrouter"]["api_key"]
+        base_url = st.secrets["openrouter"]["base_url"]
+    elif "DeepSeek" in provider:
+        api_key = st.secrets["deepseek"]["api_key"]
+        base_url = st.secrets["deepseek"]["base_url"]
+    elif "OpenRouter" in provider:
+        api_key = st.secrets["openrouter"]["api_key"]
+        base_url = st.secrets["openrouter"]["base_url"]
+    elif "Glama" in provider:
+        if "glama" in st.secrets:
+            base_url = st.secrets["glama"]["base_url"].strip().rstrip("/")
+            api_key = st.secrets["glama"]["api_key"]
+        else:
+            return None, None, "❌ Glama Secrets 未配置"
+    return api_key, base_url, None
+
+
+def _build_gemini_contents(history, prompt):
+    contents = []
+    for h in history:
+        role = "user" if h['role'] == 'user' else "model"
+        contents.append({"role": role, "parts": [{"text": h['content']}]})
+    contents.append({"role": "user", "parts": [{"text": prompt}]})
+    return contents
+
+
+def _build_openai_messages(system_prompt, history, prompt):
+    messages = [{"role": "system", "content": system_prompt}]
+    for h in history:
+        role = "assistant" if h['role'] == "model" else h['role']
+        messages.append({"role": role, "content": h['content']})
+    messages.append({"role": "user", "content": prompt})
+    return messages
+
+
+def _resolve_ai_plan(model_override=None, timeout_override=None, feature="general", failover=True):
+    """
+    在主线程一次性确定超时、候选服务商与对冲开关；工作线程只拿这份结果发请求。
+    用户主动开启自动路由时，短小任务首选路由出的模型，侧边栏所选模型作为第一备选；调用方指定模型时不路由。
+    failover=False 时只用侧边栏所选的服务商与模型 (连通性测试)，不切换、不对冲、不路由。
+    """
+    provider, target_model = _resolve_ai_target(model_override)
+    failover = _resolve_ai_failover() if failover else {"failover": False, "hedge": False}
+    candidates = _build_ai_candidates(provider, target_model, model_override, failover['failover'])
+
+    settings = _get_ai_user_settings()
+    routed = None
+    if model_override is None and failover['failover'] and settings.get('ai_auto_route', False):
+        routed = route_ai_model(feature, provider, target_model)
+    if routed:
+        candidates = [(routed[0], routed[1], None)] + [
+            c for c in candidates if (_provider_family(c[0], c[2]), c[1]) != routed]
+
+    return {
+        "timeout": _resolve_ai_timeout(timeout_override),
+        "candidates": candidates,
+        "hedge": failover['hedge'],
+        "family": _provider_family(candidates[0][0], candidates[0][2]),
+    }
+
+
+def resolve_ai_model(feature="general"):
+    """该功能实际会用到的首选模型 (用于按模型上下文打包提示词)"""
+    return _resolve_ai_plan(feature=feature)['candidates'][0][1]
+
+
+def call_ai_universal(prompt, history=[], model_override=None, timeout_override=None, max_retries=1,
+                      use_cache=True, feature="general", failover=True):
+    """
+    [功能增强] 统一 AI 调用入口：支持重试、错误捕获、客户端复用、响应缓存
+    :param use_cache: False 时跳过缓存直接请求 (用于“重新生成”等场景)，结果仍会写回缓存
+    :param feature: 功能标签 (如 grading / tutor_chat)，用于调用遥测统计
+    :param failover: False 时不切换备用服务商、不对冲 (用于连通性测试，只测所选服务商)
+    """
+    # 确定超时、服务商与模型 (含备用链路)
+    plan = _resolve_ai_plan(model_override, timeout_override, feature, failover=failover)
+    return _call_ai_with_failover(prompt, history, plan['candidates'], plan['timeout'], max_retries, use_cache,
+                                  hedge=plan['hedge'], feature=feature)
+
+
+def _call_ai_resolved(prompt, history, provider, target_model, model_override, current_timeout, max_retries,
+                      use_cache, feature="general"):
+    """
+    实际执行 AI 请求 (服务商/模型/超时均已确定)。
+    不读取 st.session_state，可在线程池中安全调用。
+    """
+    # Gemini 直连走 REST，不携带系统提示词
+    system_prompt = "" if _use_gemini_rest(provider, model_override) else AI_SYSTEM_PROMPT
+
+    # 缓存命中直接返回
+    ai_cache = get_ai_response_cache()
+    cache_key = AIResponseCache.make_key(provider, target_model, system_prompt, history, prompt)
+    if ai_cache and use_cache:
+        cached = ai_cache.get(cache_key)
+        if cached is not None:
+            record_ai_call(feature, provider, target_model, cache_hit=True)
+            return cached
 
     # --- 内部执行函数 (用于重试) ---
     def _execute_call():
         # A. Google Gemini (REST API 模式 - 不依赖 OpenAI SDK)
-        if "Gemini" in provider and not model_override:
-            url = f"https://generativelanguage.googleapis.com/v1beta/models/{target_model}:generateContent?key={API_KEY}"
+        if _use_gemini_rest(provider, model_override):
+            url = f"{_gemini_api_base()}/v1beta/models/{target_model}:generateContent?key={API_KEY}"
             headers = {'Content-Type': 'application/json'}
-            contents = []
-            for h in history:
-                role = "user" if h['role'] == 'user' else "model"
-                contents.append({"role": role, "parts": [{"text": h['content']}]})
-            contents.append({"role": "user", "parts": [{"text": prompt}]})
+            contents = _build_gemini_contents(history, prompt)
 
-            resp = requests.post(url, headers=headers, json={"contents": contents}, timeout=current_timeout)
+            resp = get_http_session().post(url, headers=headers, json={"contents": contents},
+                                           timeout=current_timeout)
+            limiter.update_from_headers(family, target_model, resp.headers)
             if resp.status_code == 200:
-                return resp.json()['candidates'][0]['content']['parts'][0]['text']
+                data = resp.json()
+                meta = data.get('usageMetadata', {})
+                usage['prompt'] = meta.get('promptTokenCount', 0)
+                usage['completion'] = meta.get('candidatesTokenCount', 0)
+                return data['candidates'][0]['content']['parts'][0]['text']
             else:
-                raise Exception(f"Gemini API Error {resp.status_code}: {resp.text}")
+                raise classify_ai_error(resp.status_code, resp.text, resp.headers)
 
         # B. OpenAI 兼容模式 (DeepSeek / OpenRouter / Glama)
         else:
-            # 准备参数
-            api_key = ""
-            base_url = ""
-
-            if model_override and "gemini" in model_override and "openrouter" in st.secrets:
-                api_key = st.secrets["openrouter"]["api_key"]
-                base_url = st.secrets["openrouter"]["base_url"]
-            elif "DeepSeek" in provider:
-                api_key = st.secrets["deepseek"]["api_key"]
-                base_url = st.secrets["deepseek"]["base_url"]
-            elif "OpenRouter" in provider:
-                api_key = st.secrets["openrouter"]["api_key"]
-                base_url = st.secrets["openrouter"]["base_url"]
-            elif "Glama" in provider:
-                if "glama" in st.secrets:
-                    base_url = st.secrets["glama"]["base_url"].strip().rstrip("/")
-                    api_key = st.secrets["glama"]["api_key"]
-                else:
-                    return "❌ Glama Secrets 未配置"
+            api_key, base_url, err = _resolve_openai_endpoint(provider, model_override)
+            if err: raise AIAuthError(err)
 
             # 获取或初始化客户端 (利用缓存)
             client = get_ai_client(provider, api_key, base_url)
-            if not client: return "AI Client 初始化失败"
-
-            # 构造消息
-            messages = [{"role": "system", "content": "你是一位资深会计讲师。回答请使用 Markdown 格式。"}]
-            for h in history:
-                role = "assistant" if h['role'] == "model" else h['role']
-                messages.append({"role": role, "content": h['content']})
-            messages.append({"role": "user", "content": prompt})
+            if not client: raise AIAuthError("AI Client 初始化失败")
 
             # 发起请求
-            resp = client.chat.completions.create(
-                model=target_model,
-                messages=messages,
+            resp = _openai_chat_create(
+                client, family, target_model,
+                messages=_build_openai_messages(system_prompt, history, prompt),
                 temperature=0.7,
                 timeout=current_timeout
             )
+            if getattr(resp, 'usage', None):
+                usage['prompt'] = resp.usage.prompt_tokens or 0
+                usage['completion'] = resp.usage.completion_tokens or 0
             return resp.choices[0].message.content
 
-    # --- 重试逻辑 ---
-    last_error = ""
-    for attempt in range(max_retries + 1):
+    # --- 重试逻辑 (先过限流桶，再占并发槽位) ---
+    family = _provider_family(provider, model_override)
+    slot = _provider_slot(family)
+    limiter = get_ai_rate_limiter()
+    reserved = estimate_tokens(prompt) + sum(estimate_tokens(h.get('content', '')) for h in history) \
+               + AI_EST_OUTPUT_TOKENS
+    usage = {"prompt": 0, "completion": 0}
+    last_error = None
+    attempt = throttled = shrinks = 0
+    started = time.time()
+    while True:
+        if not limiter.acquire(family, target_model, reserved):
+            last_error = AIRateLimitError(f"{family} 限流排队超过 {AI_RATE_LIMIT_MAX_WAIT} 秒")
+            break
         try:
-            return _execute_call()
+            with slot:
+                t0 = time.time()
+                res = _execute_call()
+                record_ai_latency(family, time.time() - t0)
+            limiter.settle(family, target_model, reserved, usage['prompt'] + usage['completion'])
+            if ai_cache and _is_cacheable_reply(res) and not shrinks:  # 裁剪过输入的回复不能记在完整输入名下
+                ai_cache.put(cache_key, provider, target_model, res)
+            # 服务商没返回 usage 时按字数估算
+            record_ai_call(feature, provider, target_model,
+                           prompt_tokens=usage['prompt'] or reserved - AI_EST_OUTPUT_TOKENS,
+                           completion_tokens=usage['completion'] or estimate_tokens(res),
+                           latency=time.time() - started, retries=attempt + throttled + shrinks)
+            return res
         except Exception as e:
-            last_error = str(e)
-            if attempt < max_retries:
-                time.sleep(1)  # 失败后暂停1秒再试
-                continue
+            last_error = _as_ai_error(e)
+
+        # 按错误类型决定是否重试
+        if isinstance(last_error, AIRateLimitError):
+            # 被限流不算失败：暂停该模型的桶，排队后重发 (不占用普通重试次数)
+            limiter.penalize(family, target_model, last_error.retry_after)
+            throttled += 1
+            if throttled > AI_RATE_LIMIT_MAX_429: break
+        elif isinstance(last_error, AIContextTooLongError):
+            shrinks += 1
+            if shrinks > AI_CONTEXT_MAX_SHRINKS: break
+            prompt, history = _shrink_ai_input(prompt, history)
+            reserved = estimate_tokens(prompt) + sum(estimate_tokens(h.get('content', '')) for h in history) \
+                       + AI_EST_OUTPUT_TOKENS
+        elif isinstance(last_error, (AIAuthError, AIBadRequestError)):
+            break  # 重试必然失败
+        else:
+            attempt += 1
+            if attempt > max_retries: break
+            time.sleep(_backoff_delay(attempt))
 
-    return f"❌ AI 调用失败 (已重试{max_retries}次): {last_error}"
+    record_ai_call(feature, provider, target_model, latency=time.time() - started,
+                   retries=attempt + throttled + shrinks, ok=False, error_kind=last_error.kind)
+    return AIFailure.from_error(last_error, attempts=attempt)
 
 
-def call_ai_json(prompt, model_override=None):
+def run_ai_jobs(job_fn, items, max_workers=4, on_progress=None):
     """
-    [新功能] 专门请求 JSON 数据，带自动清洗和解析，防止报错
+    [性能优化] 通用并发执行器：用线程池并发执行 job_fn(item)，结果按输入顺序返回。
+    单项抛异常不影响其他项，返回 [{"ok": bool, "value": ..., "error": str|None}, ...]
+    :param on_progress: on_progress(已完成数, 总数)，在主线程回调，可直接刷新进度条
     """
-    # 强制要求 JSON
-    json_prompt = prompt + "\n\n请务必只返回纯 JSON 格式，不要包含 ```json 等 Markdown 标记，也不要有多余的解释文字。"
+    items = list(items)
+    results = [None] * len(items)
+    if not items: return results
+
+    done = 0
+    workers = max(1, min(max_workers, len(items)))
+    with ThreadPoolExecutor(max_workers=workers, initializer=_script_ctx_initializer()) as pool:
+        futures = {pool.submit(job_fn, item): i for i, item in enumerate(items)}
+        for fut in as_completed(futures):
+            i = futures[fut]
+            try:
+                results[i] = {"ok": True, "value": fut.result(), "error": None}
+            except Exception as e:
+                results[i] = {"ok": False, "value": None, "error": str(e)}
+            done += 1
+            if on_progress: on_progress(done, len(items))
+    return results
 
-    res = call_ai_universal(json_prompt, model_override=model_override)
-    if not res or "Error" in res or "失败" in res:
+
+def call_ai_batch(prompts, history=[], model_override=None, timeout_override=None, max_retries=1,
+                  use_cache=True, max_workers=None, on_progress=None, feature="general"):
+    """
+    [性能优化] 批量并发调用 AI：总耗时约等于最慢的一次调用，而不是所有调用之和。
+    - 并发数受服务商在途上限约束 (见 AI_PROVIDER_MAX_IN_FLIGHT)
+    - 返回结果与 prompts 顺序一致：[{"ok": bool, "text": str, "error": str|None}, ...]
+    """
+    # 会话相关的配置在主线程一次性确定，工作线程只负责发请求
+    plan = _resolve_ai_plan(model_override, timeout_override, feature)
+    if max_workers is None:
+        max_workers = get_provider_max_in_flight(plan['family'])
+
+    def _job(p):
+        return _call_ai_with_failover(p, history, plan['candidates'], plan['timeout'], max_retries, use_cache,
+                                      hedge=plan['hedge'], feature=feature)
+
+    results = []
+    for r in run_ai_jobs(_job, prompts, max_workers=max_workers, on_progress=on_progress):
+        text = r['value'] or ""
+        if not r['ok']:
+            results.append({"ok": False, "text": "", "error": r['error']})
+        elif is_ai_failure(text):
+            results.append({"ok": False, "text": "", "error": text or "AI 返回为空"})
+        else:
+            results.append({"ok": True, "text": text, "error": None})
+    return results
+
+
+def call_ai_universal_stream(prompt, history=[], model_override=None, timeout_override=None, max_retries=1,
+                             use_cache=True, feature="general"):
+    """
+    [体验优化] call_ai_universal 的流式版本：逐段 yield 文本增量，可直接交给 st.write_stream。
+    - Gemini 走 streamGenerateContent (SSE)，OpenAI 兼容服务商走 stream=True
+    - 超时按“两段数据之间的最长间隔”计算，长篇生成不会因总耗时过长被掐断
+    - 首个 Token 到达前失败会自动重试；中途失败抛出异常 (已输出的部分不写缓存)
+    """
+    plan = _resolve_ai_plan(model_override, timeout_override, feature)
+    yield from _stream_ai_resolved(prompt, history, plan['candidates'], plan['timeout'], max_retries, use_cache,
+                                   feature=feature)
+
+
+def _stream_ai_resolved(prompt, history, candidates, current_timeout, max_retries, use_cache, feature="general"):
+    """流式请求的实际执行部分 (候选服务商/超时均已确定)，不读取 st.session_state，可在线程池中使用"""
+    provider, target_model = candidates[0][0], candidates[0][1]
+
+    def _cache_key(cand):
+        c_provider, c_model, c_override = cand
+        c_system = "" if _use_gemini_rest(c_provider, c_override) else AI_SYSTEM_PROMPT
+        return AIResponseCache.make_key(c_provider, c_model, c_system, history, prompt)
+
+    ai_cache = get_ai_response_cache()
+    if ai_cache and use_cache:
+        cached = ai_cache.get(_cache_key(candidates[0]))
+        if cached is not None:
+            record_ai_call(feature, provider, target_model, cache_hit=True)
+            yield cached
+            return
+
+    limiter = get_ai_rate_limiter()
+    # 缓存键按原始输入确定 (上下文超长时提示词会被裁剪)
+    cache_keys = {cand: _cache_key(cand) for cand in candidates}
+
+    def _iter_deltas(provider, target_model, model_override):
+        """与非流式调用一致：先过限流桶，再占并发槽位 (整个流式输出期间都占着)，结束后按实际输出校正预占额度"""
+        family = _provider_family(provider, model_override)
+        input_tokens = estimate_tokens(prompt) + sum(estimate_tokens(h.get('content', '')) for h in history)
+        reserved = input_tokens + AI_EST_OUTPUT_TOKENS
+        if not limiter.acquire(family, target_model, reserved):
+            raise AIRateLimitError(f"{family} 限流排队超过 {AI_RATE_LIMIT_MAX_WAIT} 秒")
+        produced = []
+        try:
+            with _provider_slot(family):
+                for delta in _raw_deltas(provider, target_model, model_override, family):
+                    produced.append(delta)
+                    yield delta
+        finally:
+            # 流式接口不返回 usage，输出 Token 按字数估算
+            limiter.settle(family, target_model, reserved, input_tokens + estimate_tokens("".join(produced)))
+
+    def _raw_deltas(provider, target_model, model_override, family):
+        # A. Gemini SSE
+        if _use_gemini_rest(provider, model_override):
+            url = (f"{_gemini_api_base()}/v1beta/models/{target_model}"
+                   f":streamGenerateContent?alt=sse&key={API_KEY}")
+            contents = _build_gemini_contents(history, prompt)
+            with get_http_session().post(url, json={"contents": contents}, stream=True,
+                                         timeout=(10, current_timeout)) as resp:
+                limiter.update_from_headers(family, target_model, resp.headers)
+                if resp.status_code != 200:
+                    raise classify_ai_error(resp.status_code, resp.text, resp.headers)
+                resp.encoding = "utf-8"
+                for line in resp.iter_lines(decode_unicode=True):
+                    if not line or not line.startswith("data:"): continue
+                    data = json.loads(line[5:].strip())
+                    for cand in data.get('candidates', [])[:1]:
+                        for part in cand.get('content', {}).get('parts', []):
+                            if part.get('text'): yield part['text']
+
+        # B. OpenAI 兼容模式
+        else:
+            api_key, base_url, err = _resolve_openai_endpoint(provider, model_override)
+            if err: raise AIAuthError(err)
+            client = get_ai_client(provider, api_key, base_url)
+            if not client: raise AIAuthError("AI Client 初始化失败")
+
+            stream = _openai_chat_create(
+                client, family, target_model,
+                messages=_build_openai_messages(AI_SYSTEM_PROMPT, history, prompt),
+                temperature=0.7,
+                timeout=current_timeout,
+                stream=True
+            )
+            for chunk in stream:
+                if chunk.choices and chunk.choices[0].delta.content:
+                    yield chunk.choices[0].delta.content
+
+    # 首个 Token 之前失败：先重试当前服务商，再按备用链路切换
+    pieces = []
+    last_error = None
+    started = time.time()
+    prompt_tokens = estimate_tokens(prompt) + sum(estimate_tokens(h.get('content', '')) for h in history)
+    shrunk = False
+    for cand in candidates:
+        attempt = throttled = shrinks = 0
+        while True:
+            try:
+                for delta in _iter_deltas(*cand):
+                    pieces.append(delta)
+                    yield delta
+                last_error = None
+                break
+            except Exception as e:
+                err = _as_ai_error(e)
+                # 已经输出过内容就不能重来，否则页面上会重复
+                if pieces:
+                    record_ai_call(feature, cand[0], cand[1], prompt_tokens=prompt_tokens,
+                                   completion_tokens=estimate_tokens("".join(pieces)), latency=time.time() - started,
+                                   retries=attempt + throttled + shrinks, ok=False, error_kind=err.kind)
+                    raise type(err)(f"AI 流式调用失败: {err}") from e
+                last_error = err
+
+            # 按错误类型决定是否重试 (策略与 _call_ai_resolved 一致)
+            if isinstance(last_error, AIRateLimitError):
+                limiter.penalize(_provider_family(cand[0], cand[2]), cand[1], last_error.retry_after)
+                throttled += 1
+                if throttled > AI_RATE_LIMIT_MAX_429: break
+            elif isinstance(last_error, AIContextTooLongError):
+                shrinks += 1
+                if shrinks > AI_CONTEXT_MAX_SHRINKS: break
+                prompt, history = _shrink_ai_input(prompt, history)
+                shrunk = True
+            elif isinstance(last_error, (AIAuthError, AIBadRequestError)):
+                break
+            else:
+                attempt += 1
+                if attempt > max_retries: break
+                time.sleep(_backoff_delay(attempt))
+        if last_error is None:
+            full_text = "".join(pieces)
+            if ai_cache and _is_cacheable_reply(full_text) and not shrunk:
+                ai_cache.put(cache_keys[cand], cand[0], cand[1], full_text)
+            # 流式接口不返回 usage，Token 按字数估算
+            record_ai_call(feature, cand[0], cand[1], prompt_tokens=prompt_tokens,
+                           completion_tokens=estimate_tokens(full_text), latency=time.time() - started,
+                           retries=attempt + throttled + shrinks)
+            return
+
+    record_ai_call(feature, provider, target_model, latency=time.time() - started, ok=False,
+                   error_kind=last_error.kind)
+    raise type(last_error)(f"AI 流式调用失败: {last_error}")
+
+
+JSON_ONLY_SUFFIX = "\n\n请务必只返回纯 JSON 格式，不要包含 ```json 等 Markdown 标记，也不要有多余的解释文字。"
+
+
+def parse_ai_json(res):
+    """从 AI 回复中截取并解析 JSON (对象或数组)，失败返回 None"""
+    if is_ai_failure(res):
         return None
 
     try:
@@ -574,16 +1979,342 @@ def call_ai_json(prompt, model_override=None):
         return None
 
 
-# --- 新增：主观题 AI 评分函数 ---
-def ai_grade_subjective(user_ans, std_ans, question_content):
+def call_ai_json(prompt, model_override=None, feature="general", use_cache=True):
+    """
+    [新功能] 专门请求 JSON 数据，带自动清洗和解析，防止报错
+    """
+    # 强制要求 JSON
+    res = call_ai_universal(prompt + JSON_ONLY_SUFFIX, model_override=model_override, feature=feature,
+                            use_cache=use_cache)
+    return parse_ai_json(res)
+
+
+def call_ai_json_batch(prompts, model_override=None, on_progress=None, feature="general", use_cache=True):
+    """call_ai_json 的并发版本，返回与 prompts 顺序一致的解析结果 (失败项为 None)"""
+    results = call_ai_batch([p + JSON_ONLY_SUFFIX for p in prompts], model_override=model_override,
+                            on_progress=on_progress, feature=feature, use_cache=use_cache)
+    return [parse_ai_json(r['text']) if r['ok'] else None for r in results]
+
+
+def ask_ai_tutor(qid, user_response, followup, prompt, history=None, use_cache=True):
+    """
+    AI 私教问答：先查私教答案缓存 (题目 + 错解 + 相似追问)，未命中再请求模型并写回。
+    :param use_cache: False 用于“重新生成”，跳过所有缓存并用新回答覆盖旧讲解
+    """
+    tutor_cache = get_tutor_answer_cache()
+    if use_cache and tutor_cache:
+        cached = tutor_cache.lookup(qid, user_response, followup)
+        if cached is not None:
+            record_ai_call("tutor_chat", "tutor_cache", None, cache_hit=True)
+            return cached
+
+    reply = call_ai_universal(prompt, history=history or [], use_cache=use_cache, feature="tutor_chat")
+    if tutor_cache and not is_ai_failure(reply):
+        tutor_cache.store(qid, user_response, followup, reply)
+    return reply
+
+
+# --- 上下文窗口感知的文本打包：按模型真实上限切分，而不是固定截断 ---
+AI_MODEL_LIMITS = [
+    # (模型名关键字, 上下文 Token, 最大输出 Token)；按顺序匹配，越具体越靠前
+    ("gemini-1.5-pro", 2097152, 8192),
+    ("gemini-1.5-flash", 1048576, 8192),
+    ("gemini", 1048576, 8192),
+    ("deepseek-reasoner", 65536, 8192),
+    ("deepseek", 65536, 8192),
+    ("gpt-4o", 128000, 16384),
+    ("claude-3", 200000, 8192),
+    ("llama-3.1", 131072, 4096),
+]
+AI_DEFAULT_MODEL_LIMITS = (32768, 4096)
+AI_CONTEXT_SAFETY_RATIO = 0.9  # Token 为估算值，只用上下文窗口的 90%
+EXTRACT_OUTPUT_RATIO = 1.2  # 抽题输出的 JSON 约为原文 Token 的 1.2 倍 (题干 + 选项 + 解析)
+
+
+def get_model_limits(model):
+    """返回 (上下文 Token, 最大输出 Token)：优先用模型目录里接口返回的真实值，其次查本地表"""
+    meta = get_model_catalog().lookup(model) if model else None
+    if meta and meta.get('context'):
+        return int(meta['context']), int(meta.get('max_output') or AI_DEFAULT_MODEL_LIMITS[1])
+    name = (model or "").lower()
+    for keyword, context, max_output in AI_MODEL_LIMITS:
+        if keyword in name: return context, max_output
+    return AI_DEFAULT_MODEL_LIMITS
+
+
+def get_input_budget(model, overhead_text="", output_ratio=None):
+    """
+    一次请求里还能放多少 Token 的原文：上下文 - 预留输出 - 指令本身。
+    output_ratio 不为空时，还要保证输出 (约为原文 × output_ratio) 不超过模型的最大输出。
+    """
+    context, max_output = get_model_limits(model)
+    budget = int(context * AI_CONTEXT_SAFETY_RATIO) - max_output - estimate_tokens(overhead_text)
+    if output_ratio:
+        budget = min(budget, int(max_output / output_ratio))
+    return max(1000, budget)
+
+
+def split_text_by_tokens(text, budget):
+    """把长文本切成尽量少的片段，每段不超过 budget Token；优先在换行处切，原文一个字都不丢"""
+    if estimate_tokens(text) <= budget: return [text]
+    chunks, cur, cur_tok = [], [], 0
+    for line in text.splitlines(keepends=True):
+        t = estimate_tokens(line)
+        # 严格小于才并入：逐行估算有取整误差，等于预算时合并后的整段可能多出 1 个 Token
+        if cur and cur_tok + t >= budget:
+            chunks.append("".join(cur))
+            cur, cur_tok = [], 0
+        while t >= budget:  # 单行就超限 (如无换行的长段落)，按比例硬切；中英混排密度不均时逐步收窄
+            step = max(1, len(line) * (budget - 1) // t)
+            while step > 1 and estimate_tokens(line[:step]) >= budget:
+                step = step * 9 // 10
+            chunks.append(line[:step])
+            line = line[step:]
+            t = estimate_tokens(line)
+        cur.append(line)
+        cur_tok += t
+    if cur: chunks.append("".join(cur))
+    return chunks
+
+
+def split_text_evenly(text, n):
+    """按行把文本大致均分成 n 段 (用于让答案区与题目分段对齐)"""
+    if n <= 1: return [text]
+    lines = text.splitlines(keepends=True)
+    target = estimate_tokens(text) / n
+    parts, cur, acc = [], [], 0
+    for line in lines:
+        cur.append(line)
+        acc += estimate_tokens(line)
+        if acc >= target * (len(parts) + 1) and len(parts) < n - 1:
+            parts.append("".join(cur))
+            cur = []
+    parts.append("".join(cur))
+    return parts
+
+
+def truncate_to_budget(text, budget):
+    """单次问答类场景：放得下就整段发送，放不下只保留开头能放下的部分"""
+    return split_text_by_tokens(text, budget)[0] if text else text
+
+
+def build_extract_prompts(instruction, question_text, answer_text="", model=None,
+                          answer_header="====== 答案区域 ======"):
+    """
+    按模型的上下文与输出上限，把一章拆成最少的抽题请求。
+    答案在文件末尾时：答案区较短就每段都附上完整答案区，较长则与题目按相同份数对齐切分。
+    """
+    budget = get_input_budget(model, instruction, output_ratio=EXTRACT_OUTPUT_RATIO)
+    if not answer_text:
+        return [f"{instruction}\n\n文本：\n{p}" for p in split_text_by_tokens(question_text, budget)]
+
+    ans_tok = estimate_tokens(answer_text)
+    if ans_tok <= budget // 2:
+        q_parts = split_text_by_tokens(question_text, budget - ans_tok)
+        a_parts = [answer_text] * len(q_parts)
+    else:
+        n = max(len(split_text_by_tokens(question_text, budget // 2)), math.ceil(ans_tok / (budget // 2)))
+        q_parts = split_text_evenly(question_text, n)
+        a_parts = split_text_evenly(answer_text, n)
+    return [f"{instruction}\n\n文本：\n{q}\n\n{answer_header}\n{a}" for q, a in zip(q_parts, a_parts)]
+
+
+# --- 题目抽取：流式解析 + 分批入库 + 截断续写 ---
+QUESTION_INSERT_BATCH = 20  # 每解析出多少道题写一次库
+EXTRACT_MAX_RESUMES = 3  # 输出被截断后最多续写几次
+
+
+class JSONArrayStreamParser:
+    """
+    增量解析 JSON 数组：每喂入一段文本，返回其中新完成的顶层对象。
+    容忍数组前后的 ```json 标记或说明文字 (说明文字里的 "[提取]" 之类不会被当成数组开头)；
+    输出中途被截断时，已完整的对象不受影响。
+    """
+
+    def __init__(self):
+        self.started = False  # 是否已遇到数组开头的 [
+        self.finished = False  # 是否已遇到数组结尾的 ]
+        self.count = 0
+        self._depth = 0
+        self._in_str = False
+        self._escape = False
+        self._buf = []
+        self._open_bracket = False  # 刚遇到 [，还要看后面 (跳过空白) 是不是 { 或 ]
+
+    def feed(self, text):
+        items = []
+        for ch in text:
+            if self.finished: break
+            if not self.started:
+                if self._open_bracket and not ch.isspace():
+                    self._open_bracket = False
+                    if ch == ']':  # 空数组：模型明确表示没有题目
+                        self.started = self.finished = True
+                        break
+                    if ch == '{':  # 真正的对象数组开头，这个 { 交给下面按正常元素处理
+                        self.started = True
+                        self._depth = 1
+                if not self.started:
+                    if ch == '[': self._open_bracket = True
+                    continue
+
+            if self._in_str:
+                self._buf.append(ch)
+                if self._escape:
+                    self._escape = False
+                elif ch == '\\':
+                    self._escape = True
+                elif ch == '"':
+                    self._in_str = False
+                continue
+
+            if ch == '"':
+                self._in_str = True
+                self._buf.append(ch)
+            elif ch in '{[':
+                if self._depth == 1: self._buf = []  # 新元素开始
+                self._depth += 1
+                self._buf.append(ch)
+            elif ch in '}]':
+                self._depth -= 1
+                if self._depth == 0:
+                    self.finished = True
+                    break
+                self._buf.append(ch)
+                if self._depth == 1:
+                    item = self._load("".join(self._buf))
+                    self._buf = []
+                    if isinstance(item, dict):
+                        self.count += 1
+                        items.append(item)
+            elif self._depth > 1:
+                self._buf.append(ch)
+        return items
+
+    @staticmethod
+    def _load(raw):
+        try:
+            return json.loads(raw, strict=False)  # 允许字符串里出现未转义的换行
+        except ValueError:
+            return None
+
+
+def normalize_extracted_question(q, chapter_id, user_id, batch_source="PDF-V8.5"):
+    """校验并清洗 AI 抽取出的一道题，转换成 question_bank 的行；不合格返回 None"""
+    if not isinstance(q, dict) or not str(q.get('question') or '').strip():
+        return None
+
+    raw_type = str(q.get('type') or 'single').lower()
+    final_type = 'single'
+    final_opts = q.get('options') or []
+    if not isinstance(final_opts, list): final_opts = [str(final_opts)]
+    final_ans = str(q.get('answer', '')).strip().upper()
+
+    if 'judgment' in raw_type or '判断' in raw_type:
+        final_type = 'judgment'
+        if not final_opts: final_opts = ["A. 正确", "B. 错误"]
+        if final_ans in ['T', 'TRUE', '√', '正确', '对']:
+            final_ans = 'A'
+        elif final_ans in ['F', 'FALSE', '×', '错误', '错']:
+            final_ans = 'B'
+    elif 'subjective' in raw_type or not final_opts or len(final_ans) > 10:
+        final_type = 'subjective'
+    elif len(final_ans) > 1 or 'multi' in raw_type:
+        final_type = 'multi'
+
+    return {
+        "chapter_id": chapter_id, "user_id": user_id,
+        "content": str(q['question']).strip(),
+        "options": final_opts,
+        "correct_answer": final_ans,
+        "explanation": q.get('explanation', ''),
+        "type": final_type,
+        "origin": "extract",
+        "batch_source": batch_source
+    }
+
+
+def _build_extract_resume_prompt(prompt, count, last_question):
+    return (f"{prompt}\n\n【续写说明】上一次的输出在第 {count} 题之后中断了。最后一道已完整输出的题目是："
+            f"『{last_question[:100]}』。请从这道题的下一题开始继续提取，不要重复已输出的题目，仍然只返回 JSON 数组。")
+
+
+def stream_extract_questions(prompt, chapter_id, user_id, plan, batch_source="PDF-V8.5", state=None):
     """
-    专门用于主观题评分
-    返回: {'score': 0-100, 'feedback': '...'}
+    [性能优化] 流式抽题：边接收 AI 输出边解析，每凑满 QUESTION_INSERT_BATCH 道题写一次库。
+    输出被截断或超时时，从最后一道已解析的题目之后续写，而不是整章重来。
+    state 由调用方为每个片段保留：重试同一片段时传回同一个 dict，会先补写上次没写成功的题，
+    再从已入库的题之后续写，不会重复插入。
+    不读取 st.session_state (plan 由 _resolve_ai_plan 在主线程生成)，可在线程池中运行。
+    返回 {"inserted": 入库题数 (含之前的尝试), "resumes": 续写次数, "error": 最后一次错误或 None}
     """
-    if not user_ans or len(user_ans.strip()) < 2:
-        return {'score': 0, 'feedback': '未检测到有效作答。'}
+    if state is None: state = {}
+    seen = state.setdefault('seen', set())
+    pending = state.setdefault('pending', [])
+    state.setdefault('inserted', 0)
+    resumes, error = 0, None
+
+    def _flush():
+        if pending:
+            supabase.table("question_bank").insert(list(pending)).execute()
+            state['inserted'] += len(pending)
+            pending.clear()
+
+    # 重试时：先补写上次残留的题，再从最后一道已解析的题之后续写
+    current_prompt = prompt
+    if state.get('last_question'):
+        current_prompt = _build_extract_resume_prompt(prompt, len(seen), state['last_question'])
+    while True:
+        parser = JSONArrayStreamParser()
+        error = None
+        try:
+            _flush()
+            # 不走响应缓存：截断/乱码的输出一旦被缓存，重试只会重放同一份坏结果
+            for delta in _stream_ai_resolved(current_prompt, [], plan['candidates'], plan['timeout'], 1, False,
+                                             feature="extract_questions"):
+                for q in parser.feed(delta):
+                    row = normalize_extracted_question(q, chapter_id, user_id, batch_source)
+                    if not row: continue
+                    sig = hashlib.md5(row['content'].encode("utf-8")).hexdigest()
+                    if sig in seen: continue  # 续写时 AI 偶尔会重复上一题
+                    seen.add(sig)
+                    pending.append(row)
+                    state['last_question'] = row['content']
+                    if len(pending) >= QUESTION_INSERT_BATCH: _flush()
+            _flush()
+        except Exception as e:
+            error = str(e)
+            if pending: break  # 写库失败：保留在 state 里，等调用方重试时补写
+
+        # 正常结束，或本轮一道题都没解析出来 (续写也无济于事)，就停止
+        truncated = parser.started and not parser.finished
+        if not truncated or parser.count == 0 or resumes >= EXTRACT_MAX_RESUMES:
+            break
+        resumes += 1
+        current_prompt = _build_extract_resume_prompt(prompt, len(seen), state['last_question'])
+
+    state['done'] = error is None and not pending and parser.finished
+    return {"inserted": state['inserted'], "resumes": resumes, "error": error}
+
+
+# --- 新增：主观题 AI 评分函数 ---
+GRADE_TIMEOUT = 45  # 评分通常较快，强制较短超时，避免卡死
+GRADE_PACK_CHAR_BUDGET = 12000  # 合并批改时单次请求的字数上限
+GRADE_PACK_MAX_ITEMS = 8  # 合并批改时单次请求最多包含的题数
+GRADE_PACK_MIN_ITEMS = 12  # 有效作答达到该题数才合并批改；题少时逐题并发更快，耗时只取决于最慢的一道
+GRADE_PACK_PROGRESS_SHARE = 0.8  # 合并批改阶段占进度条的比例，剩余部分留给兜底重判
+
+GRADE_RUBRIC = """
+    【评分标准】
+    1. 满分 100 分。
+    2. 核心会计分录、计算结果、关键术语正确即可得分，不纠结文字表述差异。
+    3. 如果分录借贷方向反了，直接 0 分。
+    4. 如果金额错误但逻辑正确，给 30-50% 分数。
+"""
+
 
-    prompt = f"""
+def _build_grade_prompt(user_ans, std_ans, question_content):
+    return f"""
     【角色】你是一位严谨的会计阅卷老师。
     【任务】请对考生的主观题答案进行评分。
 
@@ -595,136 +2326,749 @@ def ai_grade_subjective(user_ans, std_ans, question_content):
 
     【考生答案】
     {user_ans}
-
-    【评分标准】
-    1. 满分 100 分。
-    2. 核心会计分录、计算结果、关键术语正确即可得分，不纠结文字表述差异。
-    3. 如果分录借贷方向反了，直接 0 分。
-    4. 如果金额错误但逻辑正确，给 30-50% 分数。
-
+    {GRADE_RUBRIC}
     请以纯 JSON 格式返回：
     {{
         "score": 85,
         "feedback": "分录正确，但折旧计算金额有误（应为1000而非1200）。"
     }}
     """
+
+
+def _coerce_score(v):
+    """把模型给出的分数转成 0-100 的数字，如 "85"、"85分"；无法识别返回 None"""
+    if isinstance(v, bool): return None
+    if isinstance(v, str):
+        m = re.search(r'-?\d+(?:\.\d+)?', v)
+        v = m.group() if m else None
+    try:
+        score = float(v)
+    except (TypeError, ValueError):
+        return None
+    if score != score: return None  # NaN
+    return max(0.0, min(100.0, score))
+
+
+def _parse_grade_result(res):
     try:
-        # 强制较短超时，避免卡死，评分通常较快
-        res = call_ai_universal(prompt, timeout_override=45)
+        if is_ai_failure(res): raise Exception(res)
         clean = res.replace("```json", "").replace("```", "").strip()
         s = clean.find('{');
         e = clean.rfind('}') + 1
-        return json.loads(clean[s:e])
+        data = json.loads(clean[s:e])
+        score = _coerce_score(data.get('score'))
+        if score is None: raise ValueError(f"无效分数: {data.get('score')!r}")
+        data['score'] = score
+        return data
     except Exception as e:
         return {'score': 0, 'feedback': f"AI 阅卷失败: {e}"}
 
 
-# --- 动态获取模型列表函数 ---
-@st.cache_data(ttl=3600)
-def fetch_google_models(api_key):
+def _has_valid_answer(user_ans):
+    return bool(user_ans) and len(user_ans.strip()) >= 2
+
+
+def ai_grade_subjective(user_ans, std_ans, question_content):
+    """
+    专门用于主观题评分
+    返回: {'score': 0-100, 'feedback': '...'}
+    """
+    if not _has_valid_answer(user_ans):
+        return {'score': 0, 'feedback': '未检测到有效作答。'}
+
+    res = call_ai_universal(_build_grade_prompt(user_ans, std_ans, question_content), timeout_override=GRADE_TIMEOUT,
+                            feature="grading")
+    return _parse_grade_result(res)
+
+
+def _build_packed_grade_prompt(packed_items):
+    """多道题共用一份评分标准，packed_items: [(item_id, user_ans, std_ans, question_content), ...]"""
+    blocks = []
+    for item_id, u_ans, std_ans, q_content in packed_items:
+        blocks.append(f"""
+    ===== 题目编号：{item_id} =====
+    【题目】
+    {q_content}
+    【标准答案】
+    {std_ans}
+    【考生答案】
+    {u_ans}
+""")
+    return f"""
+    【角色】你是一位严谨的会计阅卷老师。
+    【任务】请分别对以下 {len(packed_items)} 道主观题的考生答案评分，每道题独立打分。
+    {GRADE_RUBRIC}
+    {"".join(blocks)}
+    请以纯 JSON 数组返回，每道题一个对象，id 必须与题目编号一致：
+    [
+        {{"id": "{packed_items[0][0]}", "score": 85, "feedback": "分录正确，但折旧计算金额有误。"}}
+    ]
+    """
+
+
+def _pack_grade_items(indexed_items, char_budget=GRADE_PACK_CHAR_BUDGET, max_items=GRADE_PACK_MAX_ITEMS):
+    """按字数预算把题目装箱，超出预算自动拆成多个请求"""
+    groups, current, current_len = [], [], 0
+    for entry in indexed_items:
+        entry_len = sum(len(str(x)) for x in entry[1:]) + 50
+        if current and (current_len + entry_len > char_budget or len(current) >= max_items):
+            groups.append(current)
+            current, current_len = [], 0
+        current.append(entry)
+        current_len += entry_len
+    if current: groups.append(current)
+    return groups
+
+
+def ai_grade_subjective_packed(items, on_progress=None):
+    """
+    [性能优化] 合并批改：把多道题打包进同一个请求，评分标准只发送一次，减少 Token 与请求数。
+    - 超过字数预算自动拆分为多个请求 (各请求之间并发)
+    - 返回结果中缺失的题目，自动回退为逐题批改
+    :param items: [(user_ans, std_ans, question_content), ...]
+    :return: 与 items 顺序一致的 [{'score': 0-100, 'feedback': '...'}, ...]
+    """
+    results = [None] * len(items)
+    to_grade = []
+    for i, (u_ans, std_ans, q_content) in enumerate(items):
+        if _has_valid_answer(u_ans):
+            to_grade.append((f"Q{i + 1}", u_ans, std_ans, q_content))
+        else:
+            results[i] = {'score': 0, 'feedback': '未检测到有效作答。'}
+
+    # 进度条分两段：合并批改占前 80%，兜底重判占剩余部分，不会从 100% 跳回去
+    share = GRADE_PACK_PROGRESS_SHARE
+
+    def scaled(lo, span):
+        if not on_progress: return None
+        return lambda d, t: on_progress(lo + span * d / t, 1)
+
+    groups = _pack_grade_items(to_grade)
+    # 不重试：合并请求失败时直接逐题重判，比整包再等一轮更快
+    batch = call_ai_batch([_build_packed_grade_prompt(g) for g in groups], timeout_override=GRADE_TIMEOUT * 2,
+                          max_retries=0, on_progress=scaled(0, share), feature="grading")
+
+    for group, r in zip(groups, batch):
+        parsed = parse_ai_json(r['text']) if r['ok'] else None
+        if not isinstance(parsed, list): continue
+        by_id = {str(x.get('id')).strip(): x for x in parsed if isinstance(x, dict)}
+        for item_id, _, _, _ in group:
+            hit = by_id.get(item_id)
+            score = _coerce_score(hit.get('score')) if hit is not None else None
+            if score is not None:
+                results[int(item_id[1:]) - 1] = {'score': score, 'feedback': hit.get('feedback', '')}
+
+    # 兜底：合并请求里没拿到结果或分数无效的题目逐题重判
+    missing = [i for i, res in enumerate(results) if res is None]
+    if missing:
+        fallback = ai_grade_subjective_batch([items[i] for i in missing], on_progress=scaled(share, 1 - share))
+        for i, res in zip(missing, fallback):
+            results[i] = res
+    elif on_progress:
+        on_progress(1, 1)
+    return results
+
+
+def ai_grade_subjective_auto(items, on_progress=None):
+    """默认逐题并发批改 (每题独立超时)；有效作答很多时改用合并批改，节省重复发送评分标准的 Token"""
+    if sum(1 for u_ans, _, _ in items if _has_valid_answer(u_ans)) >= GRADE_PACK_MIN_ITEMS:
+        return ai_grade_subjective_packed(items, on_progress=on_progress)
+    return ai_grade_subjective_batch(items, on_progress=on_progress)
+
+
+def ai_grade_subjective_batch(items, on_progress=None):
+    """
+    [性能优化] 主观题并发批改，总耗时约等于最慢的一道题
+    :param items: [(user_ans, std_ans, question_content), ...]
+    :return: 与 items 顺序一致的 [{'score': 0-100, 'feedback': '...'}, ...]
+    """
+    results = [None] * len(items)
+    ai_idx = []
+    for i, (u_ans, _, _) in enumerate(items):
+        if _has_valid_answer(u_ans):
+            ai_idx.append(i)
+        else:
+            results[i] = {'score': 0, 'feedback': '未检测到有效作答。'}
+
+    # 每道题独立超时、独立重试，互不拖累
+    batch = call_ai_batch([_build_grade_prompt(*items[i]) for i in ai_idx], timeout_override=GRADE_TIMEOUT,
+                          max_retries=1, on_progress=on_progress, feature="grading")
+    for i, r in zip(ai_idx, batch):
+        results[i] = _parse_grade_result(r['text']) if r['ok'] else {'score': 0, 'feedback': f"AI 阅卷失败: {r['error']}"}
+    return results
+
+
+# --- 模型目录：本地持久化 + 后台刷新，侧边栏不再等第三方接口 ---
+MODEL_CATALOG_PATH = os.path.join(LOCAL_DATA_DIR, "model_catalog.json")
+MODEL_CATALOG_TTL = 6 * 3600  # 目录超过该时长在后台刷新
+MODEL_CATALOG_RETRY_INTERVAL = 300  # 刷新失败后至少隔多久再试 (离线时避免每次重跑都请求)
+
+
+class ModelCatalog:
+    """
+    [性能优化] 各服务商的模型目录 (含上下文长度、最大输出、每百万 Token 价格)，持久化到本地 JSON。
+    读取总是立即返回上次的结果；过期时启动后台线程刷新，刷新完成后下一次重跑生效。
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._refreshing = set()
+        self._last_attempt = {}
+        try:
+            with open(path, encoding="utf-8") as f:
+                self._data = json.load(f)
+        except (OSError, ValueError):
+            self._data = {}
+        self._rebuild_index()
+
+    def _rebuild_index(self):
+        self._index = {m['id']: m for entry in self._data.values() for m in entry.get('models', [])}
+
+    def models(self, provider, fetch_fn=None):
+        """返回 provider 的模型列表 [{"id", "context", "max_output", "prompt_price", "completion_price", "is_free"}]"""
+        with self._lock:
+            entry = self._data.get(provider) or {}
+            stale = time.time() - entry.get('fetched_at', 0) > MODEL_CATALOG_TTL
+            backoff = time.time() - self._last_attempt.get(provider, 0) < MODEL_CATALOG_RETRY_INTERVAL
+        if stale and fetch_fn and not backoff:
+            self.refresh_async(provider, fetch_fn)
+        return list(entry.get('models', []))
+
+    def lookup(self, model_id):
+        with self._lock:
+            return self._index.get(model_id)
+
+    def fetched_at(self, provider):
+        with self._lock:
+            return (self._data.get(provider) or {}).get('fetched_at')
+
+    def is_refreshing(self, provider):
+        with self._lock:
+            return provider in self._refreshing
+
+    def refresh_async(self, provider, fetch_fn):
+        with self._lock:
+            if provider in self._refreshing: return
+            self._refreshing.add(provider)
+            self._last_attempt[provider] = time.time()
+        threading.Thread(target=self._refresh, args=(provider, fetch_fn), daemon=True,
+                         name=f"model-catalog-{provider}").start()
+
+    def _refresh(self, provider, fetch_fn):
+        try:
+            models = fetch_fn()
+            if not models: return  # 拉取失败保留旧目录
+            with self._lock:
+                self._data[provider] = {"fetched_at": time.time(), "models": models}
+                self._rebuild_index()
+                snapshot = json.dumps(self._data, ensure_ascii=False)
+            # 先写临时文件再替换，避免进程中途退出留下半个 JSON
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                f.write(snapshot)
+            os.replace(tmp_path, self.path)
+        except Exception as e:
+            print(f"Model Catalog Refresh Error ({provider}): {e}")
+        finally:
+            with self._lock:
+                self._refreshing.discard(provider)
+
+
+@st.cache_resource
+def get_model_catalog():
+    return ModelCatalog(MODEL_CATALOG_PATH)
+
+
+def _per_million(price):
     try:
-        url = f"https://generativelanguage.googleapis.com/v1beta/models?key={api_key}"
-        data = requests.get(url, timeout=10).json()
-        return [m['name'].replace("models/", "") for m in data.get('models', []) if
-                "generateContent" in m.get('supportedGenerationMethods', [])]
-    except:
+        return float(price) * 1_000_000
+    except (TypeError, ValueError):
+        return None
+
+
+# 以下 _fetch_* 在后台线程里运行：不访问 st.*，HTTP 会话由调用方传入
+def _fetch_google_catalog(api_key, session, api_base=GEMINI_API_BASE):
+    url = f"{api_base}/v1beta/models?key={api_key}"
+    data = session.get(url, timeout=10).json()
+    return [{"id": m['name'].replace("models/", ""), "context": m.get('inputTokenLimit'),
+             "max_output": m.get('outputTokenLimit'), "prompt_price": None, "completion_price": None,
+             "is_free": False}
+            for m in data.get('models', []) if "generateContent" in m.get('supportedGenerationMethods', [])]
+
+
+def _fetch_openrouter_catalog(api_key, session):
+    url = "https://openrouter.ai/api/v1/models"
+    resp = session.get(url, headers={"Authorization": f"Bearer {api_key}"}, timeout=10)
+    if resp.status_code != 200: return []
+    models = []
+    for m in resp.json().get('data', []):
+        pricing = m.get('pricing') or {}
+        prompt_price = _per_million(pricing.get('prompt'))
+        models.append({
+            "id": m['id'], "context": m.get('context_length'),
+            "max_output": (m.get('top_provider') or {}).get('max_completion_tokens'),
+            "prompt_price": prompt_price, "completion_price": _per_million(pricing.get('completion')),
+            "is_free": prompt_price == 0 or ':free' in m['id'],
+        })
+    return sorted(models, key=lambda x: x['id'])
+
+
+def _fetch_glama_catalog(api_key, base_url, session):
+    # Glama 的标准 Base URL 通常是 https://glama.ai/api/gateway/openai/v1，获取 models 时只需 base_url + /models
+    target_url = base_url.rstrip("/") + "/models"
+    headers = {"Authorization": f"Bearer {api_key}", "Content-Type": "application/json"}
+    resp = session.get(target_url, headers=headers, timeout=10)
+    if resp.status_code != 200:
+        print(f"Glama Fetch Error: {resp.status_code} - {resp.text}")
         return []
+    return sorted([{"id": m['id'], "context": m.get('context_length'), "max_output": None, "prompt_price": None,
+                    "completion_price": None, "is_free": False} for m in resp.json().get('data', [])],
+                  key=lambda x: x['id'])
+
+
+# --- 动态获取模型列表函数 (立即返回本地目录，过期时后台刷新) ---
+def fetch_google_models(api_key):
+    session, api_base = get_http_session(), _gemini_api_base()
+    models = get_model_catalog().models("Gemini", lambda: _fetch_google_catalog(api_key, session, api_base))
+    return [m['id'] for m in models]
 
 
-@st.cache_data(ttl=3600)
 def fetch_openrouter_models(api_key):
-    try:
-        url = "https://openrouter.ai/api/v1/models"
-        resp = requests.get(url, headers={"Authorization": f"Bearer {api_key}"}, timeout=10)
-        if resp.status_code == 200:
-            data = resp.json().get('data', [])
-            return sorted([
-                {'id': m['id'], 'is_free': (float(m.get('pricing', {}).get('prompt', 0)) == 0) or ':free' in m['id']}
-                for m in data
-            ], key=lambda x: x['id'])
-        return []
-    except:
-        return []
+    session = get_http_session()
+    models = get_model_catalog().models("OpenRouter", lambda: _fetch_openrouter_catalog(api_key, session))
+    return [{'id': m['id'], 'is_free': m.get('is_free', False)} for m in models]
 
 
-# --- 新增：动态获取 Glama 模型列表 ---
-@st.cache_data(ttl=3600)
 def fetch_glama_models(api_key, base_url):
     """
     从 Glama 获取可用模型列表
     """
-    try:
-        # 自动修正 Base URL (防止用户填错)
-        # Glama 的标准 Base URL 通常是 https://glama.ai/api/gateway/openai/v1
-        # 但获取 models 时只需 base_url + /models
-        target_url = base_url.rstrip("/") + "/models"
-
-        headers = {
-            "Authorization": f"Bearer {api_key}",
-            "Content-Type": "application/json"
-        }
+    session = get_http_session()
+    models = get_model_catalog().models("Glama", lambda: _fetch_glama_catalog(api_key, base_url, session))
+    return [m['id'] for m in models]
 
-        resp = requests.get(target_url, headers=headers, timeout=10)
 
-        if resp.status_code == 200:
-            data = resp.json().get('data', [])
-            # 提取模型 ID 并排序
-            return sorted([m['id'] for m in data], key=lambda x: x)
-        else:
-            print(f"Glama Fetch Error: {resp.status_code} - {resp.text}")
-            return []
+# --- 数据库 CRUD Helper ---
+# 科目→书籍→章节树：每个会话只查一次 (嵌套关联一次取回)，之后各页面的三级选择器都直接读缓存。
+# 通过 App 新建/删除/修改书籍或新建章节后必须调用 invalidate_hierarchy()。
+HIERARCHY_CACHE_KEY = '_hierarchy_cache'
+HIERARCHY_CHAPTER_COLUMNS = "id, book_id, title, start_page, end_page, user_id"  # 不含 outline，大纲另行按需读取
+
+
+def _load_hierarchy_flat(uid):
+    """降级方案：嵌套查询不可用时用三次平铺查询拼出同样的树"""
+    subjects = supabase.table("subjects").select("*").execute().data or []
+    books = supabase.table("books").select("*").eq("user_id", uid).execute().data or []
+    chapters = []
+    if books:
+        chapters = supabase.table("chapters").select(HIERARCHY_CHAPTER_COLUMNS).in_(
+            "book_id", [b['id'] for b in books]).execute().data or []
+    for b in books:
+        b['chapters'] = [c for c in chapters if c['book_id'] == b['id']]
+    for s in subjects:
+        s['books'] = [b for b in books if b.get('subject_id') == s['id']]
+    return subjects
+
+
+def _load_hierarchy(uid):
+    """[性能优化] 一次查询取回 科目 + 本人书籍 + 章节，并整理成按 ID 索引的结构"""
+    try:
+        subjects = supabase.table("subjects").select(
+            f"*, books(*, chapters({HIERARCHY_CHAPTER_COLUMNS}))").eq("books.user_id", uid).execute().data or []
     except Exception as e:
-        print(f"Glama Fetch Exception: {e}")
-        return []
+        print(f"Hierarchy embed query failed, falling back: {e}")
+        subjects = _load_hierarchy_flat(uid)
+
+    tree = {"uid": uid, "subjects": [], "books": {}, "chapters": {}}
+    for s in subjects:
+        books = s.pop('books', None) or []
+        tree['subjects'].append(s)
+        tree['books'][s['id']] = []
+        for b in books:
+            chapters = b.pop('chapters', None) or []
+            tree['books'][s['id']].append(b)
+            tree['chapters'][b['id']] = sorted(chapters, key=lambda c: c.get('start_page') or 0)
+    return tree
+
+
+def get_hierarchy():
+    tree = st.session_state.get(HIERARCHY_CACHE_KEY)
+    if tree is None or tree['uid'] != user_id:
+        tree = _load_hierarchy(user_id)
+        st.session_state[HIERARCHY_CACHE_KEY] = tree
+    return tree
+
+
+def invalidate_hierarchy():
+    """书籍/章节有增删改后调用，下次读取时重新加载整棵树"""
+    st.session_state.pop(HIERARCHY_CACHE_KEY, None)
+
+
+def _embedded_count(rows):
+    """嵌套聚合 related(count) 返回形如 [{"count": n}]"""
+    return (rows[0].get('count') or 0) if rows else 0
+
+
+def _load_chapter_counts_flat(book_id):
+    """降级方案：聚合查询不可用时，按本书章节 ID 各拉一次 chapter_id 列在本地计数"""
+    c_ids = [c['id'] for c in get_chapters(book_id)]
+    counts = {cid: [0, 0] for cid in c_ids}
+    if c_ids:
+        for idx, table in enumerate(("question_bank", "materials")):
+            for r in supabase.table(table).select("chapter_id").in_("chapter_id", c_ids).execute().data or []:
+                counts[r['chapter_id']][idx] += 1
+    return {cid: tuple(v) for cid, v in counts.items()}
+
+
+def get_chapter_counts(book_id):
+    """
+    [性能优化] 一次聚合查询取回本书每个章节的 (题目数, 教材片段数)，随章节树一起缓存。
+    题目/教材有增删后调用 invalidate_chapter_counts()。
+    """
+    counts = get_hierarchy().setdefault('counts', {})
+    if book_id not in counts:
+        try:
+            rows = supabase.table("chapters").select("id, question_bank(count), materials(count)").eq(
+                "book_id", book_id).execute().data or []
+            counts[book_id] = {r['id']: (_embedded_count(r.get('question_bank')), _embedded_count(r.get('materials')))
+                               for r in rows}
+        except Exception as e:
+            print(f"Chapter count query failed, falling back: {e}")
+            try:
+                counts[book_id] = _load_chapter_counts_flat(book_id)
+            except Exception:
+                return {}
+    return counts[book_id]
+
+
+def invalidate_chapter_counts():
+    tree = st.session_state.get(HIERARCHY_CACHE_KEY)
+    if tree: tree.pop('counts', None)
 
 
-# --- 数据库 CRUD Helper ---
 def get_subjects():
-    return supabase.table("subjects").select("*").execute().data
+    return list(get_hierarchy()['subjects'])
 
 
 def get_books(sid):
-    return supabase.table("books").select("*").eq("subject_id", sid).eq("user_id", user_id).execute().data
+    return list(get_hierarchy()['books'].get(sid, []))
 
 
 def get_chapters(book_id):
-    return supabase.table("chapters").select("*").eq("book_id", book_id).order("start_page", desc=False).execute().data
+    chapters = get_hierarchy()['chapters'].get(book_id)
+    if chapters is None:  # 不在树中 (非本人书籍等)，直接查询
+        return supabase.table("chapters").select(HIERARCHY_CHAPTER_COLUMNS).eq("book_id", book_id).order(
+            "start_page", desc=False).execute().data
+    return list(chapters)
 
 
 def save_material_v3(chapter_id, content, uid):
     supabase.table("materials").insert({
         "chapter_id": chapter_id, "content": content, "user_id": uid
     }).execute()
+    invalidate_chapter_counts()
+
+# --- 答题记录后台写入队列 ---
+ANSWER_SPOOL_PATH = os.path.join(LOCAL_DATA_DIR, "answer_spool.sqlite")
+ANSWER_FLUSH_INTERVAL = 3  # 秒
+ANSWER_FLUSH_BATCH = 50
+ANSWER_RETRY_CAP = 300  # 退避上限 (秒)
+# 只有数据本身有问题的错误才移入死信表：22 数据异常 / 23 约束冲突 / 42 列不存在或无权限 / PGRST1xx-2xx 请求格式
+# 断网、超时、5xx 没有错误码或错误码不在此列，按退避无限重试，服务恢复后自动补写
+ANSWER_PERMANENT_ERROR_PREFIXES = ("22", "23", "42", "PGRST1", "PGRST2")
+
+
+class AnswerWriteQueue:
+    """
+    [性能优化] user_answers 的后写队列：提交答案时只写本地 SQLite 暂存文件 (毫秒级)，
+    后台线程按间隔批量插入 Supabase，失败按指数退避重试。进程崩溃或断网时记录留在暂存文件里，重启后继续补写。
+    每条记录带客户端生成的 client_event_id，按它 upsert，响应丢失后重试也不会写出重复行 (见 sql/user_answers_idempotency.sql)。
+    数据错误 (如约束冲突) 的记录移入死信表，不再阻塞其它记录；设置中心可查看并重新提交。
+    """
+
+    def __init__(self, db_path, flush_interval=ANSWER_FLUSH_INTERVAL, batch_size=ANSWER_FLUSH_BATCH):
+        os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._passes = threading.Condition()
+        self._requested = self._completed = 0  # flush 请求序号 / 已完成的写入轮次对应的序号
+        self._idempotent = True  # 库里没有 client_event_id 列或唯一约束时退回普通插入
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS answer_spool (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                payload TEXT NOT NULL,
+                attempts INTEGER DEFAULT 0,
+                next_try REAL DEFAULT 0,
+                last_error TEXT
+            )
+        """)
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS answer_dead_letter (
+                id INTEGER PRIMARY KEY,
+                payload TEXT NOT NULL,
+                attempts INTEGER,
+                last_error TEXT,
+                failed_at REAL
+            )
+        """)
+        self._conn.commit()
+        threading.Thread(target=self._run, daemon=True, name="answer-writer").start()
+
+    def enqueue(self, payload):
+        """立即返回；created_at 取提交时刻，延迟写入也不影响统计"""
+        payload = {**payload, "created_at": payload.get('created_at') or datetime.datetime.now().isoformat(),
+                   "client_event_id": payload.get('client_event_id') or str(uuid.uuid4())}
+        with self._lock:
+            self._conn.execute("INSERT INTO answer_spool (payload) VALUES (?)",
+                               (json.dumps(payload, ensure_ascii=False),))
+            self._conn.commit()
+        self._wake.set()
+
+    def pending_count(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM answer_spool").fetchone()[0]
+
+    def dead_count(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM answer_dead_letter").fetchone()[0]
+
+    def dead_letters(self, limit=20):
+        with self._lock:
+            return self._conn.execute(
+                "SELECT id, payload, attempts, last_error, failed_at FROM answer_dead_letter ORDER BY id LIMIT ?",
+                (limit,)).fetchall()
+
+    def retry_dead_letters(self):
+        """把死信记录放回待写队列 (如修好表结构之后)，返回放回的条数"""
+        with self._lock:
+            n = self._conn.execute(
+                "INSERT OR REPLACE INTO answer_spool (id, payload) SELECT id, payload FROM answer_dead_letter").rowcount
+            self._conn.execute("DELETE FROM answer_dead_letter")
+            self._conn.commit()
+        self._wake.set()
+        return n
+
+    def flush(self, timeout=5.0):
+        """跳过退避立即重写一轮，最多等待 timeout 秒，返回是否已全部写完 (练习结束时调用)"""
+        with self._lock:
+            self._conn.execute("UPDATE answer_spool SET next_try = 0")
+            self._conn.commit()
+        with self._passes:
+            self._requested += 1
+            ticket = self._requested
+            self._wake.set()
+            self._passes.wait_for(lambda: self._completed >= ticket, timeout)
+        return self.pending_count() == 0
+
+    def _due_batch(self):
+        with self._lock:
+            return self._conn.execute(
+                "SELECT id, payload, attempts FROM answer_spool WHERE next_try <= ? ORDER BY id LIMIT ?",
+                (time.time(), self.batch_size)).fetchall()
+
+    def _done(self, ids):
+        with self._lock:
+            self._conn.executemany("DELETE FROM answer_spool WHERE id = ?", [(i,) for i in ids])
+            self._conn.commit()
+
+    @staticmethod
+    def _is_permanent(error):
+        """PostgREST 返回的数据类错误重试必然失败；网络错误、超时、5xx 网关错误都没有这类错误码"""
+        code = str(getattr(error, 'code', '') or '')
+        return code.startswith(ANSWER_PERMANENT_ERROR_PREFIXES)
+
+    def _failed(self, row_id, attempts, error):
+        with self._lock:
+            if self._is_permanent(error):
+                # 数据本身有问题：移入死信表保留现场，不再重试
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO answer_dead_letter (id, payload, attempts, last_error, failed_at) "
+                    "SELECT id, payload, ?, ?, ? FROM answer_spool WHERE id = ?",
+                    (attempts + 1, str(error)[:500], time.time(), row_id))
+                self._conn.execute("DELETE FROM answer_spool WHERE id = ?", (row_id,))
+                self._conn.commit()
+                print(f"Answer dead-lettered: {error}")
+                return
+            self._conn.execute("UPDATE answer_spool SET attempts = ?, next_try = ?, last_error = ? WHERE id = ?",
+                               (attempts + 1, time.time() + random.uniform(0, min(ANSWER_RETRY_CAP, 2 ** attempts)),
+                                str(error)[:500], row_id))
+            self._conn.commit()
+
+    def _insert(self, payloads):
+        table = supabase.table("user_answers")
+        if self._idempotent:
+            try:
+                table.upsert(payloads, on_conflict="client_event_id", ignore_duplicates=True).execute()
+                return
+            except Exception as e:
+                # 只有缺列/缺唯一约束才降级；网络错误照常抛出重试，避免请求其实已写入时再插一遍
+                msg = str(e)
+                if not any(k in msg for k in ("client_event_id", "42P10", "ON CONFLICT")): raise
+                print(f"Answer upsert unavailable, falling back to insert: {e}")
+                self._idempotent = False
+        table.insert([{k: v for k, v in p.items() if k != "client_event_id"} for p in payloads]).execute()
+
+    def _write(self, rows):
+        try:
+            self._insert([json.loads(r[1]) for r in rows])
+            self._done([r[0] for r in rows])
+            return
+        except Exception as e:
+            if len(rows) == 1 or not self._is_permanent(e):
+                # 断网/超时时逐条重写只会多发请求：整批按退避稍后重试
+                for row in rows:
+                    self._failed(row[0], row[2], e)
+                print(f"Answer Write Error: {e}")
+                return
+        # 整批因数据错误失败时逐条重写，避免一条坏数据拖住整批
+        for row in rows:
+            self._write([row])
+
+    def _run(self):
+        while True:
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            with self._passes:
+                ticket = self._requested
+            try:
+                while True:
+                    rows = self._due_batch()
+                    if not rows: break
+                    self._write(rows)
+                    if len(rows) < self.batch_size: break
+            except Exception as e:
+                print(f"Answer Queue Error: {e}")
+            with self._passes:
+                self._completed = ticket
+                self._passes.notify_all()
+
+
+@st.cache_resource
+def get_answer_queue():
+    try:
+        return AnswerWriteQueue(ANSWER_SPOOL_PATH)
+    except Exception as e:
+        print(f"Answer Queue Init Error: {e}")
+        return None
+
+
+def record_user_answer(payload):
+    """提交答案：进入后写队列，永不等待数据库；队列不可用时退回同步写入"""
+    queue = get_answer_queue()
+    if queue:
+        queue.enqueue(payload)
+    else:
+        supabase.table("user_answers").insert(payload).execute()
+
+
+# --- 章节掌握度 (sql/chapter_mastery.sql 中的 RPC) ---
+def _chapter_mastered_ids_fallback(uid, cid):
+    """RPC 未部署时的降级方案：只在本章题目范围内查答对记录，不再拉取全部历史"""
+    q_ids = [q['id'] for q in supabase.table("question_bank").select("id").eq("chapter_id", cid).execute().data]
+    if not q_ids: return [], set()
+    correct = supabase.table("user_answers").select("question_id").eq("user_id", uid).eq(
+        "is_correct", True).in_("question_id", q_ids).execute().data
+    return q_ids, {a['question_id'] for a in correct}
+
+
+def get_chapter_mastery(uid, cid):
+    """返回 (本章题目数, 已掌握题目数)"""
+    try:
+        rows = supabase.rpc("chapter_mastery_stats", {"p_user_id": uid, "p_chapter_id": cid}).execute().data
+        if rows:
+            return int(rows[0]['total_count'] or 0), int(rows[0]['mastered_count'] or 0)
+    except Exception as e:
+        print(f"Mastery RPC failed, falling back: {e}")
+    q_ids, mastered = _chapter_mastered_ids_fallback(uid, cid)
+    return len(q_ids), len(mastered)
+
+
+def sample_unmastered_questions(uid, cid, limit=10):
+    """随机抽取本章 limit 道未掌握的题目 (数据库内反连接 + 随机抽样，一次查询)"""
+    try:
+        return supabase.rpc("sample_unmastered_questions",
+                            {"p_user_id": uid, "p_chapter_id": cid, "p_limit": limit}).execute().data or []
+    except Exception as e:
+        print(f"Sample RPC failed, falling back: {e}")
+    q_ids, mastered = _chapter_mastered_ids_fallback(uid, cid)
+    todo = [i for i in q_ids if i not in mastered]
+    if not todo: return []
+    picked = random.sample(todo, min(limit, len(todo)))
+    qs = supabase.table("question_bank").select("*").in_("id", picked).execute().data
+    random.shuffle(qs)
+    return qs
+
 
 # --- 收藏/标记功能辅助函数 ---
+# [性能优化] 本人已标记的题目 ID 每个会话只查一次，放在内存集合里；切换标记时先改集合再同步数据库。
+MARKED_QIDS_KEY = '_marked_qids'
+
+
+def get_marked_qids(uid):
+    """返回已标记题目 ID 的集合 (会话缓存)；查询失败时返回空集合且不缓存"""
+    marked = st.session_state.get(MARKED_QIDS_KEY)
+    if marked is None or marked['uid'] != uid:
+        try:
+            res = supabase.table("question_marks").select("question_id").eq("user_id", uid).execute()
+        except Exception as e:
+            print(f"Mark Load Error: {e}")
+            return set()
+        marked = {"uid": uid, "qids": {int(r['question_id']) for r in res.data}}
+        st.session_state[MARKED_QIDS_KEY] = marked
+    return marked['qids']
+
+
+def set_marked_qids(uid, qids):
+    """已经拉取了全部标记 (如重点本页) 时顺手刷新缓存"""
+    st.session_state[MARKED_QIDS_KEY] = {"uid": uid, "qids": {int(q) for q in qids}}
+
+
+def invalidate_marked_qids():
+    st.session_state.pop(MARKED_QIDS_KEY, None)
+
+
 def toggle_mark_status(uid, qid):
     """切换收藏状态，返回 (success, is_marked, error_msg)"""
     try:
         qid = int(qid)  # 确保是整数
+        marked = get_marked_qids(uid)
+        new_state = qid not in marked
 
-        # 1. 检查是否存在
-        existing = supabase.table("question_marks").select("id").eq("user_id", uid).eq("question_id", qid).execute()
+        # 1. 乐观更新：先改内存集合
+        if new_state:
+            marked.add(qid)
+        else:
+            marked.discard(qid)
 
-        if existing.data:
-            # 2. 存在 -> 删除
-            supabase.table("question_marks").delete().eq("user_id", uid).eq("question_id", qid).execute()
-            return True, False, None  # 操作成功，当前状态：未收藏
+        # 2. 再用一次写操作同步 (不再先查询是否存在)
+        if new_state:
+            try:
+                supabase.table("question_marks").upsert({"user_id": uid, "question_id": qid},
+                                                        on_conflict="user_id,question_id",
+                                                        ignore_duplicates=True).execute()
+            except Exception as e:
+                print(f"Mark upsert failed, falling back: {e}")  # 表上没有唯一约束时退回普通插入
+                supabase.table("question_marks").insert({"user_id": uid, "question_id": qid}).execute()
         else:
-            # 3. 不存在 -> 插入
-            supabase.table("question_marks").insert({"user_id": uid, "question_id": qid}).execute()
-            return True, True, None  # 操作成功，当前状态：已收藏
+            supabase.table("question_marks").delete().eq("user_id", uid).eq("question_id", qid).execute()
+        return True, new_state, None
 
     except Exception as e:
+        invalidate_marked_qids()  # 同步失败：丢掉乐观状态，下次重新加载
         # 返回详细错误信息
         return False, False, str(e)
 
 def get_mark_status(uid, qid):
-    """查询题目是否已收藏"""
+    """查询题目是否已收藏 (读会话缓存，不发请求)"""
     try:
         # 强制转换 qid 为 int，防止类型不匹配
-        qid = int(qid)
-        res = supabase.table("question_marks").select("id").eq("user_id", uid).eq("question_id", qid).execute()
-        return len(res.data) > 0
+        return int(qid) in get_marked_qids(uid)
     except Exception as e:
         # 静默失败，默认未收藏
         return False
@@ -997,12 +3341,16 @@ def semantic_chunking(text, max_chunk_size=15000):
     return chunks
 
 
+OUTLINE_MAP_VERSION = "outline-map-v15:"  # Map 提示词变更时修改此版本号，使分块缓存失效
+
+
 @st.cache_data(show_spinner=False, ttl=3600)
-def get_cached_outline_v2(chapter_id, text_content, uid):
+def get_cached_outline_v2(chapter_id, text_content, uid, reset_token=None):
     """
     [V15.0 防压缩版] 全文扫描大纲生成
     核心修复：解决 AI 将数百个考点归纳为几个章节标题的问题。
     新增策略：如果 AI 汇总后数量骤减，强制使用 Map 阶段的原始列表。
+    reset_token：用户“销毁大纲并重置”后传入 (同时作为缓存键)，跳过分块备忘与 AI 响应缓存，整章重新分析。
     """
     import json
     import math
@@ -1034,15 +3382,9 @@ def get_cached_outline_v2(chapter_id, text_content, uid):
 
     # A. 语义分块
     chunks = semantic_chunking(text_content, max_chunk_size=10000)  # 稍微切小一点，提高精度
-    all_sub_points = []
-
-    # B. Map 阶段 (分块挖掘)
-    progress_text = st.empty()
-
-    for i, chunk in enumerate(chunks):
-        progress_text.caption(f"🤖 AI 正在挖掘第 {i + 1}/{len(chunks)} 部分的考点（清单模式）...")
 
-        map_prompt = f"""
+    def build_map_prompt(chunk):
+        return f"""
         【任务】从这段教材中提取所有具体的“必背法条”或“核心考点”。
         {domain_knowledge}
         【片段内容】...{chunk[:12000]}...
@@ -1051,14 +3393,41 @@ def get_cached_outline_v2(chapter_id, text_content, uid):
         2. 如果遇到列举项（1,2,3...），请拆分成独立的知识点。
         3. 仅返回 JSON 字符串数组。
         """
-        try:
-            chunk_res = call_ai_json(map_prompt)
+
+    # B. Map 阶段 (分块挖掘)
+    # 每个分块的结果按“模型 + 内容哈希”持久化：改了一个错别字，只有那个分块需要重新调用 AI
+    progress_text = st.empty()
+    memo = get_ai_response_cache()
+    map_model = resolve_ai_model("outline_map")
+    use_cache = not reset_token
+    chunk_points = [None] * len(chunks)
+    pending = []  # [(分块序号, 内容哈希, 分块文本)]
+    for i, chunk in enumerate(chunks):
+        chunk_key = hashlib.sha256(f"{OUTLINE_MAP_VERSION}{map_model}:{chunk}".encode("utf-8")).hexdigest()
+        cached_pts = memo.get_memo("outline_chunk", chunk_key) if memo and use_cache else None
+        if cached_pts is not None:
+            chunk_points[i] = cached_pts
+        else:
+            pending.append((i, chunk_key, chunk))
+
+    if pending:
+        hit_cnt = len(chunks) - len(pending)
+        progress_text.caption(f"🤖 {hit_cnt} 个片段命中缓存，AI 正在并发挖掘其余 {len(pending)} 个片段的考点（清单模式）...")
+        map_res = call_ai_json_batch(
+            [build_map_prompt(chunk) for _, _, chunk in pending],
+            on_progress=lambda d, t: progress_text.caption(f"🤖 AI 正在挖掘考点：已完成 {d}/{t} 个片段..."),
+            feature="outline_map", use_cache=use_cache)
+
+        for (i, chunk_key, _), chunk_res in zip(pending, map_res):
             if isinstance(chunk_res, list):
                 # 简单的清洗：去掉过短的条目（如“前言”）
                 valid_items = [str(x).strip() for x in chunk_res if len(str(x)) > 4]
-                all_sub_points.extend(valid_items)
-        except:
-            continue
+                chunk_points[i] = valid_items
+                if memo and valid_items:
+                    memo.put_memo("outline_chunk", chunk_key, valid_items)
+
+    # 按分块原顺序汇总
+    all_sub_points = [pt for pts in chunk_points if pts for pt in pts]
 
     progress_text.empty()
 
@@ -1094,7 +3463,7 @@ def get_cached_outline_v2(chapter_id, text_content, uid):
         4. 返回纯 JSON 字符串数组。
         """
         try:
-            ai_res = call_ai_json(reduce_prompt)
+            ai_res = call_ai_json(reduce_prompt, feature="outline_reduce", use_cache=use_cache)
             if isinstance(ai_res, list) and len(ai_res) > 5:
                 final_outline = ai_res
             else:
@@ -1188,6 +3557,7 @@ def check_if_finished_v2(curr_pos, total_len, outline_coverage):
 # ==============================================================================
 # 4. 侧边栏与导航 (修复版：统一菜单名称)
 # ==============================================================================
+check_and_update_streak(user_id)  # 需在档案 Helper 定义之后调用
 profile = get_user_profile(user_id)
 settings = profile.get('settings') or {}
 
@@ -1211,6 +3581,7 @@ with st.sidebar:
     # 1. Gemini
     if "Gemini" in prov:
         opts = fetch_google_models(st.secrets["GOOGLE_API_KEY"]) or ["gemini-1.5-flash"]
+        if get_model_catalog().is_refreshing("Gemini"): st.caption("🔄 模型列表后台更新中...")
         idx_m = opts.index(saved_m) if saved_m in opts else 0
         st.session_state.google_model_id = st.selectbox("🔌 模型", opts, index=idx_m, key="gl_model_select",
                                                         on_change=save_ai_pref)
@@ -1280,6 +3651,26 @@ with st.sidebar:
             )
             st.caption("提示：可在 Glama 后台查看完整的 Model ID")
 
+    # 按任务自动路由 (默认关闭：所有功能都用上面所选的模型)
+    auto_route = st.checkbox("🧭 短小任务自动换用更快/更省的模型", value=settings.get('ai_auto_route', False),
+                             help="只影响阅卷、目录解析等短小任务，且只在所选服务商的在线模型中挑选 (可在设置中心查看)")
+    if auto_route != settings.get('ai_auto_route', False):
+        update_settings(user_id, {"ai_auto_route": auto_route})
+
+    # --- 当前模型的剩余额度 (本地令牌桶 + 服务端限流头) ---
+    try:
+        q_provider, q_model = _resolve_ai_target()
+        q_family = _provider_family(q_provider)
+        quota = get_ai_rate_limiter().snapshot(q_family, q_model)
+        q_msg = f"⏱️ 额度：{quota['req']}/{quota['rpm']} 次/分 · Token {quota['tok'] * 100 // quota['tpm']}%"
+        if quota['server'].get('remaining_requests') is not None:
+            q_msg += f" · 服务端剩余 {quota['server']['remaining_requests']} 次"
+        if quota['blocked'] > 0:
+            q_msg += f" · 限流冷却 {int(quota['blocked'])} 秒"
+        st.caption(q_msg)
+    except Exception:
+        pass
+
     # --- 导航菜单 (关键修改点：名字与下方主逻辑严格一致) ---
     # 定义菜单列表
     MENU_OPTIONS = [
@@ -1297,6 +3688,11 @@ with st.sidebar:
 
     menu = st.radio("功能导航", MENU_OPTIONS, label_visibility="collapsed")
 
+    # 切换页面时把讲义阅读进度的缓冲区写回；停留在本页则按防抖间隔写回
+    flush_lecture_progress(user_id, force=st.session_state.get('_last_menu') != menu)
+    st.session_state['_last_menu'] = menu
+    _lecture_flush_timer(user_id)
+
     # --- 倒计时 ---
     if profile.get('exam_date'):
         try:
@@ -1635,14 +4031,21 @@ elif menu == "📂 智能拆书 & 资料":
                                             if not toc_txt.strip():
                                                 st.error("⚠️ 未能从指定页码提取到文字，可能是图片扫描件？")
                                             else:
-                                                full_p = f"{user_toc_prompt}\n\n目录文本：\n{toc_txt[:10000]}"
-                                                res = call_ai_universal(full_p)
-
-                                                if res and "Error" not in res:
-                                                    clean = res.replace("```json", "").replace("```", "").strip()
-                                                    s = clean.find('[');
-                                                    e = clean.rfind(']') + 1
-                                                    data = json.loads(clean[s:e])
+                                                # 目录超出模型上下文时拆成多次请求，结果按顺序拼接
+                                                toc_budget = get_input_budget(resolve_ai_model("toc_parse"), user_toc_prompt)
+                                                toc_res = call_ai_batch(
+                                                    [f"{user_toc_prompt}\n\n目录文本：\n{part}"
+                                                     for part in split_text_by_tokens(toc_txt, toc_budget)],
+                                                    feature="toc_parse")
+                                                res = next((r['error'] for r in toc_res if not r['ok']), None)
+
+                                                if res is None:
+                                                    data = []
+                                                    for r in toc_res:
+                                                        clean = r['text'].replace("```json", "").replace("```", "").strip()
+                                                        s = clean.find('[');
+                                                        e = clean.rfind(']') + 1
+                                                        data.extend(json.loads(clean[s:e]))
 
                                                     # 补全字段
                                                     for row in data:
@@ -1762,24 +4165,25 @@ elif menu == "📂 智能拆书 & 资料":
                                     q_text = extract_pdf(up_file, p_s, p_e)
 
                                     # 提取答案文本
+                                    a_text = ""
                                     if "文件末尾" in cached_ans_mode:
                                         a_s = int(float(row['ans_start_page']))
                                         a_e = min(a_s + 3 + page_buffer, int(float(row['ans_end_page'])))
                                         up_file.seek(0)
                                         a_text = extract_pdf(up_file, a_s, a_e)
-                                        q_text += f"\n\n====== 答案区域 (缓冲 {page_buffer} 页) ======\n{a_text}"
 
-                                    full_p = f"{user_extract_prompt}\n\n待提取文本：\n{q_text[:25000]}"
+                                    # 预览只需要一次请求：取按当前模型上限打包后的第一段
+                                    full_p = build_extract_prompts(
+                                        user_extract_prompt, q_text, a_text, model=resolve_ai_model("extract_questions"),
+                                        answer_header=f"====== 答案区域 (缓冲 {page_buffer} 页) ======")[0]
 
                                     with st.spinner("AI 正在提取..."):
-                                        res = call_ai_universal(full_p)
-                                        if "QuotaFailure" in str(res):
-                                            st.error("⚠️ API 配额超限。")
+                                        res = call_ai_universal(full_p, feature="extract_questions")
+                                        if is_ai_failure(res):
+                                            st.error(f"⚠️ 提取失败：{res}")
                                         elif res:
-                                            cln = res.replace("```json", "").replace("```", "").strip()
-                                            s = cln.find('[');
-                                            e = cln.rfind(']') + 1
-                                            st.session_state.preview_data = json.loads(cln[s:e])
+                                            # 逐个对象解析：即使输出被截断，已完整的题目也能预览
+                                            st.session_state.preview_data = JSONArrayStreamParser().feed(res)
                                 except Exception as e:
                                     st.error(f"测试失败: {e}")
 
@@ -1799,9 +4203,15 @@ elif menu == "📂 智能拆书 & 资料":
                                         "user_id": user_id, "subject_id": sid,
                                         "title": up_file.name.replace(".pdf", ""), "total_pages": total_pages
                                     }).execute()
+                                    invalidate_hierarchy()
                                     bid = b_res.data[0]['id']
 
                                     try:
+                                        # 阶段 1：建章节 + 读取 PDF 文本 (本地操作，顺序执行)
+                                        # 每章按模型上限拆成最少的请求：[(章节ID, 提示词, 章节序号)]
+                                        extract_jobs = []
+                                        plan = _resolve_ai_plan(timeout_override=300, feature="extract_questions")
+                                        active_model = plan['candidates'][0][1]
                                         for i, row in enumerate(edited_df):
                                             st_text.text(f"正在处理：{row['title']}...")
                                             c_s = int(float(row['start_page']));
@@ -1811,12 +4221,14 @@ elif menu == "📂 智能拆书 & 资料":
                                                 "book_id": bid, "title": row['title'], "start_page": c_s,
                                                 "end_page": c_e, "user_id": user_id
                                             }).execute()
+                                            invalidate_hierarchy()
                                             cid = c_res.data[0]['id']
 
                                             # 提取内容
                                             up_file.seek(0)
                                             txt = extract_pdf(up_file, c_s, c_e)
 
+                                            a_text = ""
                                             if "文件末尾" in cached_ans_mode:
                                                 a_s = int(float(row['ans_start_page']))
                                                 a_e_original = int(float(row['ans_end_page']))
@@ -1824,61 +4236,47 @@ elif menu == "📂 智能拆书 & 资料":
                                                 if a_s > 0:
                                                     up_file.seek(0)
                                                     a_text = extract_pdf(up_file, a_s, a_e_safe)
-                                                    txt += f"\n\n====== 答案区域 ======\n{a_text}"
-
-                                            # 调用 AI
-                                            final_p = f"{user_extract_prompt}\n\n文本：\n{txt[:200000]}"
-                                            r = call_ai_universal(final_p, timeout_override=300)
-
-                                            if r and "QuotaFailure" not in str(r):
-                                                try:
-                                                    cln = r.replace("```json", "").replace("```", "").strip()
-                                                    s = cln.find('[');
-                                                    e = cln.rfind(']') + 1
-                                                    qs = json.loads(cln[s:e])
-
-                                                    db_data = []
-                                                    for q in qs:
-                                                        # === 入库清洗逻辑 ===
-                                                        raw_type = q.get('type', 'single').lower()
-                                                        final_type = 'single'
-                                                        final_opts = q.get('options', [])
-                                                        final_ans = str(q.get('answer', '')).strip().upper()
-
-                                                        if 'judgment' in raw_type or '判断' in raw_type:
-                                                            final_type = 'judgment'
-                                                            if not final_opts: final_opts = ["A. 正确", "B. 错误"]
-                                                            if final_ans in ['T', 'TRUE', '√', '正确', '对']:
-                                                                final_ans = 'A'
-                                                            elif final_ans in ['F', 'FALSE', '×', '错误', '错']:
-                                                                final_ans = 'B'
-
-                                                        elif 'subjective' in raw_type or not final_opts or len(
-                                                                final_ans) > 10:
-                                                            final_type = 'subjective'
-                                                        elif len(final_ans) > 1 or 'multi' in raw_type:
-                                                            final_type = 'multi'
-
-                                                        db_data.append({
-                                                            "chapter_id": cid, "user_id": user_id,
-                                                            "content": q['question'],
-                                                            "options": final_opts,
-                                                            "correct_answer": final_ans,
-                                                            "explanation": q.get('explanation', ''),
-                                                            "type": final_type,
-                                                            "origin": "extract",
-                                                            "batch_source": "PDF-V8.5"
-                                                        })
-                                                    if db_data:
-                                                        supabase.table("question_bank").insert(db_data).execute()
-                                                except:
-                                                    pass
-
-                                            progress_bar.progress((i + 1) / len(edited_df))
 
+                                            for final_p in build_extract_prompts(user_extract_prompt, txt, a_text,
+                                                                                 model=active_model):
+                                                extract_jobs.append((cid, final_p, i, {}))  # 最后一项为重试续写状态
+                                            progress_bar.progress((i + 1) / len(edited_df) * 0.3)
+
+                                        # 阶段 2：所有章节并发流式提取，边解析边分批入库
+                                        st_text.text(f"AI 正在并发提取 {len(edited_df)} 个章节 ({len(extract_jobs)} 个片段) 的题目...")
+
+                                        def _extract_job(job):
+                                            return stream_extract_questions(job[1], job[0], user_id, plan, state=job[3])
+
+                                        job_res = run_ai_jobs(
+                                            _extract_job, extract_jobs,
+                                            max_workers=get_provider_max_in_flight(plan['family']),
+                                            on_progress=lambda d, t: progress_bar.progress(0.3 + 0.7 * d / t))
+
+                                        # 出错、没拿到题或没读完的片段 (多半是配额/限流) 逐个补跑一次，限流器会自动排队；
+                                        # 已入库的题不会重复写，续写从上次停下的地方开始
+                                        failed_idx = [i for i, jr in enumerate(job_res)
+                                                      if not jr['ok'] or not jr['value']['inserted']
+                                                      or not extract_jobs[i][3].get('done')]
+                                        if failed_idx:
+                                            st_text.text(f"有 {len(failed_idx)} 个片段首轮未完整提取，正在排队重试...")
+                                            retry_res = run_ai_jobs(_extract_job, [extract_jobs[i] for i in failed_idx],
+                                                                    max_workers=1)
+                                            for i, jr in zip(failed_idx, retry_res):
+                                                job_res[i] = jr
+
+                                        invalidate_chapter_counts()  # 工作线程写入了题目，回到主线程后再失效
                                         progress_bar.progress(100)
                                         st.balloons()
-                                        st.success(f"🎉 入库完成！书籍《{up_file.name}》已保存。")
+                                        total_q = sum(jr['value']['inserted'] for jr in job_res if jr['ok'])
+                                        st.success(f"🎉 入库完成！书籍《{up_file.name}》已保存，共 {total_q} 道题。")
+                                        chapter_q = collections.Counter()
+                                        for job, jr in zip(extract_jobs, job_res):
+                                            chapter_q[job[2]] += jr['value']['inserted'] if jr['ok'] else 0
+                                        lost = [row['title'] for i, row in enumerate(edited_df) if not chapter_q[i]]
+                                        if lost:
+                                            st.warning(f"以下 {len(lost)} 个章节未能提取题目 (章节已创建，可稍后单独补录)："
+                                                       f"{'、'.join(lost)}")
 
                                         st.markdown("---")
                                         if st.button("🔄 继续上传新资料", type="primary", key="btn_continue_pdf"):
@@ -1902,6 +4300,7 @@ elif menu == "📂 智能拆书 & 资料":
                                         "user_id": user_id, "subject_id": sid,
                                         "title": up_file.name.replace(".pdf", ""), "total_pages": total_pages
                                     }).execute()
+                                    invalidate_hierarchy()
                                     bid = b_res.data[0]['id']
 
                                     bar = st.progress(0)
@@ -1918,6 +4317,7 @@ elif menu == "📂 智能拆书 & 资料":
                                             "book_id": bid, "title": chap_title,
                                             "start_page": c_s, "end_page": c_e, "user_id": user_id
                                         }).execute()
+                                        invalidate_hierarchy()
 
                                         up_file.seek(0)
                                         txt = extract_pdf(up_file, c_s, c_e)
@@ -1985,6 +4385,7 @@ elif menu == "📂 智能拆书 & 资料":
                             b_res = supabase.table("books").insert({
                                 "user_id": user_id, "subject_id": sid, "title": book_name_input, "total_pages": 0
                             }).execute()
+                            invalidate_hierarchy()
                             bid = b_res.data[0]['id']
 
                             total_rows = len(df)
@@ -1997,6 +4398,7 @@ elif menu == "📂 智能拆书 & 资料":
                                     "book_id": bid, "title": chap_title, "start_page": 0, "end_page": 0,
                                     "user_id": user_id
                                 }).execute()
+                                invalidate_hierarchy()
                                 cid = c_res.data[0]['id']
                                 save_material_v3(cid, content, user_id)
                                 bar.progress((i + 1) / total_rows)
@@ -2067,6 +4469,7 @@ elif menu == "📂 智能拆书 & 资料":
                                 b_res = supabase.table("books").insert({
                                     "user_id": user_id, "subject_id": sid, "title": book_name_q, "total_pages": 0
                                 }).execute()
+                                invalidate_hierarchy()
                                 bid = b_res.data[0]['id']
                                 st.toast(f"🆕 创建新书《{book_name_q}》...")
 
@@ -2091,6 +4494,7 @@ elif menu == "📂 智能拆书 & 资料":
                                         "book_id": bid, "title": c_title, "start_page": 0, "end_page": 0,
                                         "user_id": user_id
                                     }).execute()
+                                    invalidate_hierarchy()
                                     new_cid = c_res.data[0]['id']
                                     chapter_cache[c_title] = new_cid
 
@@ -2131,6 +4535,7 @@ elif menu == "📂 智能拆书 & 资料":
                             # 写入剩余的
                             if batch_data:
                                 supabase.table("question_bank").insert(batch_data).execute()
+                            invalidate_chapter_counts()
 
                             bar.progress(100)
                             st.balloons()
@@ -2160,6 +4565,7 @@ elif menu == "📂 智能拆书 & 资料":
                 if st.button("🗑️ 删除本书", type="primary"):
                     try:
                         supabase.table("books").delete().eq("id", bid).execute()
+                        invalidate_hierarchy()
                         st.toast("书籍已删除")
                         time.sleep(1)
                         st.rerun()
@@ -2188,6 +4594,7 @@ elif menu == "📂 智能拆书 & 资料":
                             supabase.table("books").update({
                                 "title": new_title, "subject_id": target_sid
                             }).eq("id", bid).execute()
+                            invalidate_hierarchy()
                             st.success("✅ 更新成功！")
                             time.sleep(1)
                             st.rerun()
@@ -2202,19 +4609,10 @@ elif menu == "📂 智能拆书 & 资料":
                 st.info("本书暂无章节，请去上方重新拆分或导入。")
             else:
                 st.write(f"📚 共找到 {len(chapters)} 个章节：")
+                chap_counts = get_chapter_counts(bid)  # 整本书一次聚合查询
 
                 for chap in chapters:
-                    # 统计数据查询
-                    try:
-                        q_cnt = supabase.table("question_bank").select("id", count="exact").eq("chapter_id", chap[
-                            'id']).execute().count
-                    except:
-                        q_cnt = 0
-                    try:
-                        m_cnt = supabase.table("materials").select("id", count="exact").eq("chapter_id",
-                                                                                           chap['id']).execute().count
-                    except:
-                        m_cnt = 0
+                    q_cnt, m_cnt = chap_counts.get(chap['id'], (0, 0))
 
                     # 章节卡片
                     with st.expander(f"📑 {chap['title']} (题库: {q_cnt} | 教材片段: {m_cnt})"):
@@ -2225,6 +4623,7 @@ elif menu == "📂 智能拆书 & 资料":
                                          help="删除该章节下的所有题目和教材内容"):
                                 supabase.table("materials").delete().eq("chapter_id", chap['id']).execute()
                                 supabase.table("question_bank").delete().eq("chapter_id", chap['id']).execute()
+                                invalidate_chapter_counts()
                                 st.toast("已清空该章节数据")
                                 time.sleep(1)
                                 st.rerun()
@@ -2318,9 +4717,21 @@ elif menu == "🎓 AI 课堂 (讲义)":
         if not lessons:
             st.info("📭 本章节暂无讲义，请去“生成工作台”创建一个吧！")
         else:
+            # [性能优化] 本章所有讲义的阅读进度一次查回
+            prefetch_lecture_progress(user_id, [les['id'] for les in lessons])
+            seg_counts = st.session_state.get('_lecture_seg_counts', {})
+
             for les in lessons:
                 les_id = les['id']
+                n_read, n_star = lecture_progress_summary(user_id, les_id)
+                seg_total = seg_counts.get(int(les_id))
+                if seg_total:
+                    summary = f"已读 {min(100, round(n_read * 100 / seg_total))}% · ⭐ {n_star}"
+                else:
+                    summary = f"已读 {n_read} 段 · ⭐ {n_star}"
+                # 标题保持不变：标题随进度变化会让 Streamlit 当成新组件，点完按钮后展开器又折叠回去
                 with st.expander(f"📝 {les['title']}", expanded=False):
+                    st.caption(summary)
                     # 标题修改
                     c_edit_t, c_save_t = st.columns([4, 1])
                     with c_edit_t:
@@ -2351,90 +4762,96 @@ elif menu == "🎓 AI 课堂 (讲义)":
                     lid = les['id']
                     full_content = les['content']
 
-                    # 1. 阅读模式筛选器
-                    st.markdown("##### 📖 沉浸阅读")
-                    # 使用 session_state 记住筛选状态，防止刷新重置
-                    mode_key = f"read_mode_{lid}"
-                    filter_mode = st.radio("筛选显示",
-                                           ["👁️ 阅读全部", "⚡ 只读未读", "✅ 回看已读", "⭐ 回看重点"],
-                                           horizontal=True,
-                                           key=mode_key,
-                                           label_visibility="collapsed")
-
-                    st.divider()
-
-                    # === 2. 内容切片与状态加载 ===
-                    # 使用智能分段算法，每段大约 300-500 字，或者是独立的标题章节
-                    segments = smart_lecture_segmentation(full_content, max_chars=1000)
-
-                    # 获取当前数据库里的状态
-                    prog_map = get_lecture_progress(user_id, lid)
-
-                    visible_count = 0
-
-                    # 3. 循环渲染每一段
-                    for idx, seg_text in enumerate(segments):
-                        if not seg_text.strip(): continue  # 跳过空行
+                    # [性能优化] 阅读器按需打开：折叠/未打开的讲义不做分段、不渲染段落
+                    if st.checkbox("📖 打开阅读器", key=f"open_reader_{lid}"):
+                        # 1. 阅读模式筛选器
+                        st.markdown("##### 📖 沉浸阅读")
+                        # 使用 session_state 记住筛选状态，防止刷新重置
+                        mode_key = f"read_mode_{lid}"
+                        filter_mode = st.radio("筛选显示",
+                                               ["👁️ 阅读全部", "⚡ 只读未读", "✅ 回看已读", "⭐ 回看重点"],
+                                               horizontal=True,
+                                               key=mode_key,
+                                               label_visibility="collapsed")
 
-                        # 获取该段状态
-                        status = prog_map.get(idx, {'read': False, 'star': False})
-                        is_read = status['read']
-                        is_star = status['star']
-
-                        # --- 筛选逻辑 ---
-                        if filter_mode == "⚡ 只读未读" and is_read: continue
-                        if filter_mode == "✅ 回看已读" and not is_read: continue
-                        if filter_mode == "⭐ 回看重点" and not is_star: continue
+                        st.divider()
 
-                        visible_count += 1
+                        # === 2. 内容切片与状态加载 ===
+                        # 使用智能分段算法，每段大约 300-500 字，或者是独立的标题章节 (按内容缓存，点击按钮重跑时不再重切)
+                        segments = get_lecture_segments(full_content)
+                        st.session_state.setdefault('_lecture_seg_counts', {})[lid] = sum(1 for t in segments if t.strip())
+
+                        # 获取当前状态 (已在列表顶部批量预取)
+                        prog_map = get_lecture_progress(user_id, lid)
+
+                        visible_count = 0
+
+                        # 3. 循环渲染每一段
+                        for idx, seg_text in enumerate(segments):
+                            if not seg_text.strip(): continue  # 跳过空行
+
+                            # 获取该段状态
+                            status = prog_map.get(idx, {'read': False, 'star': False})
+                            is_read = status['read']
+                            is_star = status['star']
+
+                            # --- 筛选逻辑 ---
+                            if filter_mode == "⚡ 只读未读" and is_read: continue
+                            if filter_mode == "✅ 回看已读" and not is_read: continue
+                            if filter_mode == "⭐ 回看重点" and not is_star: continue
+
+                            visible_count += 1
+
+                            # --- 样式定义 ---
+                            if is_star:
+                                border_color = "#ffc107"  # 金色 (重点)
+                                bg_color = "rgba(255, 193, 7, 0.08)"
+                                text_color = "#222"
+                            elif is_read:
+                                border_color = "#e0e0e0"  # 灰色 (已读)
+                                bg_color = "rgba(0,0,0,0.01)"
+                                text_color = "#888"
+                            else:
+                                border_color = "#00C090"  # 绿色 (未读)
+                                bg_color = "white"
+                                text_color = "#222"
+
+                            # --- 渲染卡片 ---
+                            with st.container():
+                                # 自定义 HTML 容器
+                                html_card = f"""<div style="border-left: 5px solid {border_color}; padding: 15px 20px; background: {bg_color}; border-radius: 4px; margin-bottom: 12px; box-shadow: 0 1px 3px rgba(0,0,0,0.05);"><div style="font-size:1.05rem; line-height:1.8; color: {text_color}; white-space: pre-wrap;">{seg_text}</div></div>"""
+                                st.markdown(html_card, unsafe_allow_html=True)
+
+                                # --- 按钮操作栏 (on_click 回调：点击后直接带着新状态重跑，无需再 st.rerun) ---
+                                c_act1, c_act2, c_act3, c_void = st.columns([1.5, 1.5, 1.8, 4.2])
+                                btn_suffix = f"{lid}_{idx}"  # 唯一ID
+
+                                with c_act1:
+                                    if is_read:
+                                        st.button("↩️ 设为未读", key=f"ur_{btn_suffix}", on_click=update_segment_status,
+                                                  args=(user_id, lid, idx, "is_read", False))
+                                    else:
+                                        st.button("✅ 标记已读", key=f"rd_{btn_suffix}", type="primary",
+                                                  on_click=update_segment_status, args=(user_id, lid, idx, "is_read", True))
 
-                        # --- 样式定义 ---
-                        if is_star:
-                            border_color = "#ffc107"  # 金色 (重点)
-                            bg_color = "rgba(255, 193, 7, 0.08)"
-                        elif is_read:
-                            border_color = "#e0e0e0"  # 灰色 (已读)
-                            bg_color = "rgba(0,0,0,0.01)"
-                            text_color = "#888"
-                        else:
-                            border_color = "#00C090"  # 绿色 (未读)
-                            bg_color = "white"
-                            text_color = "#222"
-
-                        # --- 渲染卡片 ---
-                        with st.container():
-                            # 自定义 HTML 容器
-                            html_card = f"""<div style="border-left: 5px solid {border_color}; padding: 15px 20px; background: {bg_color}; border-radius: 4px; margin-bottom: 12px; box-shadow: 0 1px 3px rgba(0,0,0,0.05);"><div style="font-size:1.05rem; line-height:1.8; color: {text_color}; white-space: pre-wrap;">{seg_text}</div></div>"""
-                            st.markdown(html_card, unsafe_allow_html=True)
-
-                            # --- 按钮操作栏 ---
-                            c_act1, c_act2, c_void = st.columns([1.5, 1.5, 6])
-                            btn_suffix = f"{lid}_{idx}"  # 唯一ID
-
-                            with c_act1:
-                                if is_read:
-                                    if st.button("↩️ 设为未读", key=f"ur_{btn_suffix}"):
-                                        update_segment_status(user_id, lid, idx, "is_read", False)
-                                        st.rerun()
-                                else:
-                                    if st.button("✅ 标记已读", key=f"rd_{btn_suffix}", type="primary"):
-                                        update_segment_status(user_id, lid, idx, "is_read", True)
-                                        st.rerun()
+                                with c_act2:
+                                    if is_star:
+                                        st.button("🚫 取消重点", key=f"us_{btn_suffix}", on_click=update_segment_status,
+                                                  args=(user_id, lid, idx, "is_star", False))
+                                    else:
+                                        st.button("⭐ 标记重点", key=f"st_{btn_suffix}", on_click=update_segment_status,
+                                                  args=(user_id, lid, idx, "is_star", True))
 
-                            with c_act2:
-                                if is_star:
-                                    if st.button("🚫 取消重点", key=f"us_{btn_suffix}"):
-                                        update_segment_status(user_id, lid, idx, "is_star", False)
-                                        st.rerun()
-                                else:
-                                    if st.button("⭐ 标记重点", key=f"st_{btn_suffix}"):
-                                        update_segment_status(user_id, lid, idx, "is_star", True)
-                                        st.rerun()
+                                with c_act3:
+                                    if not is_read:
+                                        above = [i for i in range(idx + 1) if segments[i].strip()]
+                                        st.button("⏫ 以上全部已读", key=f"ra_{btn_suffix}", on_click=mark_segments_read_until,
+                                                  args=(user_id, lid, above))
 
-                    if visible_count == 0:
-                        st.info(f"📭 当前模式【{filter_mode}】下没有内容。")
-                        if filter_mode == "⚡ 只读未读":
-                            st.success("🎉 太棒了！本节讲义已全部读完！")
+                        if visible_count == 0:
+                            st.info(f"📭 当前模式【{filter_mode}】下没有内容。")
+                            if filter_mode == "⚡ 只读未读":
+                                st.success("🎉 太棒了！本节讲义已全部读完！")
 
                     st.markdown("---")
                     # ==========================================
@@ -2452,8 +4869,9 @@ elif menu == "🎓 AI 课堂 (讲义)":
                     if q_in:
                         history = st.session_state[f"chat_{les_id}"]
                         history.append({"role": "user", "content": q_in})
-                        prompt = f"【讲义内容】\n{les['content'][:10000]}\n\n【用户问题】{q_in}"
-                        ans = call_ai_universal(prompt)
+                        les_budget = get_input_budget(resolve_ai_model("lecture_chat"), q_in)
+                        prompt = f"【讲义内容】\n{truncate_to_budget(les['content'], les_budget)}\n\n【用户问题】{q_in}"
+                        ans = call_ai_universal(prompt, feature="lecture_chat")
                         history.append({"role": "assistant", "content": ans})
                         supabase.table("ai_lessons").update({"chat_history": history}).eq("id", les_id).execute()
                         st.rerun()
@@ -2508,7 +4926,8 @@ elif menu == "🎓 AI 课堂 (讲义)":
                         st.info("💡 系统将扫描教材生成核心考点地图。")
                         if st.button("🔍 分析本章考点", type="primary"):
                             with st.spinner("AI 正在构建知识地图 (Map-Reduce)..."):
-                                res = get_cached_outline_v2(cid, full_text, user_id)
+                                res = get_cached_outline_v2(cid, full_text, user_id,
+                                                            reset_token=st.session_state.pop(f"outline_reset_{cid}", None))
                                 st.session_state[OUTLINE_KEY] = res
                                 st.rerun()
                 else:
@@ -2517,6 +4936,7 @@ elif menu == "🎓 AI 课堂 (讲义)":
                             st.session_state[OUTLINE_KEY] = []
                             st.session_state[OUTLINE_OVERRIDES_KEY] = {}  # 清空手动状态
                             supabase.table("chapters").update({"outline": None}).eq("id", cid).execute()
+                            st.session_state[f"outline_reset_{cid}"] = time.time()  # 下次分析跳过分块备忘与缓存
                             st.rerun()
 
                 # --- 3. 覆盖率计算 (融合手动覆写) ---
@@ -2591,15 +5011,19 @@ elif menu == "🎓 AI 课堂 (讲义)":
                                 st.session_state[GEN_LOCK_KEY] = True
                                 bar = st.progress(0)
                                 try:
-                                    for i, m_item in enumerate(missing_items):
-                                        patch_prompt = f"【任务】补充知识点：{m_item['title']}。风格幽默，带Emoji，直接输出正文。"
-                                        res = call_ai_universal(patch_prompt)
-                                        if res:
-                                            st.session_state[DRAFT_KEY] += f"\n\n### ✨ 补充：{m_item['title']}\n{res}"
+                                    # 所有红圈并发补全，结果按大纲顺序拼接
+                                    patch_prompts = [
+                                        f"【任务】补充知识点：{m_item['title']}。风格幽默，带Emoji，直接输出正文。"
+                                        for m_item in missing_items]
+                                    patch_res = call_ai_batch(patch_prompts, use_cache=False,  # 每次补全都应重新生成
+                                                              on_progress=lambda d, t: bar.progress(d / t),
+                                                              feature="lecture_patch")
+                                    for m_item, r in zip(missing_items, patch_res):
+                                        if r['ok']:
+                                            st.session_state[DRAFT_KEY] += f"\n\n### ✨ 补充：{m_item['title']}\n{r['text']}"
                                             st.session_state[EDITOR_KEY] = st.session_state[DRAFT_KEY]
                                             # 🟢 补全后自动标记为已覆盖
                                             st.session_state[OUTLINE_OVERRIDES_KEY][m_item['title']] = True
-                                        bar.progress((i + 1) / len(missing_items))
 
                                     st.session_state[CURSOR_KEY] = total_len  # 视为读完
 
@@ -2794,35 +5218,37 @@ elif menu == "🎓 AI 课堂 (讲义)":
                                         ...
                                         """
 
-                                        with st.spinner("AI 备课中..."):
-                                            res = call_ai_universal(prompt)
-                                            if res:
-                                                sep = "\n\n---\n\n" if start_idx > 0 else ""
-                                                new_full = st.session_state[DRAFT_KEY] + sep + res
-                                                st.session_state[DRAFT_KEY] = new_full
-                                                st.session_state[EDITOR_KEY] = new_full
-
-                                                next_pos = min(max(end_idx - 200, start_idx + 100), total_len)
-                                                st.session_state[CURSOR_KEY] = next_pos
-
-                                                # 🟢 自动保存 (多版本适配)
-                                                upsert_data = {
-                                                    "user_id": user_id, "chapter_id": cid, "title": lesson_title,
-                                                    "content": new_full, "ai_model": style,
-                                                    "current_cursor": next_pos, "updated_at": "now()"
-                                                }
-                                                active_id = st.session_state[ACTIVE_ID_KEY]
-
-                                                if active_id and active_id != "new":
-                                                    supabase.table("ai_lessons").update(upsert_data).eq("id",
-                                                                                                        active_id).execute()
-                                                    st.toast(f"💾 已更新存档")
-                                                else:
-                                                    new_res = supabase.table("ai_lessons").insert(upsert_data).execute()
-                                                    st.session_state[ACTIVE_ID_KEY] = new_res.data[0]['id']
-                                                    st.toast(f"💾 新存档已建立")
+                                        # 流式输出：边生成边显示，首字约 1 秒可见；不走缓存，撤销后重新生成要拿到新内容
+                                        with st.container(border=True):
+                                            res = st.write_stream(call_ai_universal_stream(prompt, use_cache=False,
+                                                                                           feature="lecture_chunk"))
+                                        if res:
+                                            sep = "\n\n---\n\n" if start_idx > 0 else ""
+                                            new_full = st.session_state[DRAFT_KEY] + sep + res
+                                            st.session_state[DRAFT_KEY] = new_full
+                                            st.session_state[EDITOR_KEY] = new_full
+
+                                            next_pos = min(max(end_idx - 200, start_idx + 100), total_len)
+                                            st.session_state[CURSOR_KEY] = next_pos
+
+                                            # 🟢 自动保存 (多版本适配)
+                                            upsert_data = {
+                                                "user_id": user_id, "chapter_id": cid, "title": lesson_title,
+                                                "content": new_full, "ai_model": style,
+                                                "current_cursor": next_pos, "updated_at": "now()"
+                                            }
+                                            active_id = st.session_state[ACTIVE_ID_KEY]
+
+                                            if active_id and active_id != "new":
+                                                supabase.table("ai_lessons").update(upsert_data).eq("id",
+                                                                                                active_id).execute()
+                                                st.toast(f"💾 已更新存档")
+                                            else:
+                                                new_res = supabase.table("ai_lessons").insert(upsert_data).execute()
+                                                st.session_state[ACTIVE_ID_KEY] = new_res.data[0]['id']
+                                                st.toast(f"💾 新存档已建立")
 
-                                                st.rerun()
+                                            st.rerun()
                                     except Exception as e:
                                         st.error(str(e))
                                     finally:
@@ -2926,19 +5352,8 @@ elif menu == "📝 章节特训":
 
                 # === 📊 智能进度看板 ===
                 try:
-                    q_res = supabase.table("question_bank").select("id").eq("chapter_id", cid).execute().data
-                    total_q = len(q_res)
-
-                    mastered_count = 0
-                    done_ids = []
-                    if total_q > 0:
-                        user_correct = supabase.table("user_answers").select("question_id").eq("user_id", user_id).eq(
-                            "is_correct", True).execute().data
-                        chapter_q_ids = set([q['id'] for q in q_res])
-                        user_correct_ids = set([a['question_id'] for a in user_correct])
-                        mastered_ids = user_correct_ids.intersection(chapter_q_ids)
-                        mastered_count = len(mastered_ids)
-                        done_ids = list(mastered_ids)
+                    # [性能优化] 数据库内统计，不再拉取用户全部历史答对记录
+                    total_q, mastered_count = get_chapter_mastery(user_id, cid)
 
                     prog = mastered_count / total_q if total_q > 0 else 0
                     st.caption(f"📈 掌握进度：{mastered_count} / {total_q} 题")
@@ -2946,7 +5361,7 @@ elif menu == "📝 章节特训":
 
                 except:
                     total_q = 0;
-                    done_ids = []
+                    mastered_count = 0
 
                 st.divider()
 
@@ -2981,20 +5396,11 @@ elif menu == "📝 章节特训":
                             st.success("🎉 本章题目已全部掌握！")
                         else:
                             try:
-                                if done_ids:
-                                    ids_str = f"({','.join(map(str, done_ids))})"
-                                    qs = supabase.table("question_bank").select("*").eq("chapter_id", cid).filter("id",
-                                                                                                                  "not.in",
-                                                                                                                  ids_str).limit(
-                                        20).execute().data
-                                else:
-                                    qs = supabase.table("question_bank").select("*").eq("chapter_id", cid).limit(
-                                        20).execute().data
+                                qs = sample_unmastered_questions(user_id, cid, limit=10)
                             except:
                                 qs = []
 
                             if qs:
-                                random.shuffle(qs)
                                 st.session_state.quiz_data = qs[:10]
                                 st.session_state.q_idx = 0
                                 st.session_state.quiz_active = True
@@ -3028,13 +5434,15 @@ elif menu == "📝 章节特训":
                             with st.spinner("🤖 AI 正在研读教材并出题..."):
                                 prompt = f"""
                                 请基于以下教材内容，生成 3 道选择题（含单选/多选）。
-                                教材片段：{full_text[:10000]}
+                                教材片段：{truncate_to_budget(full_text, get_input_budget(resolve_ai_model("quiz_gen")))}
                                 必须返回纯 JSON 列表格式... (此处省略，同原逻辑)
                                 """
                                 # ... (原 AI 出题逻辑) ...
                                 # 简化展示，实际代码保持原逻辑
-                                res = call_ai_universal(prompt)
-                                if res:
+                                res = call_ai_universal(prompt, use_cache=False, feature="quiz_gen")  # 每次出不同的题
+                                if is_ai_failure(res):
+                                    st.error(res)
+                                else:
                                     try:
                                         clean = res.replace("```json", "").replace("```", "").strip()
                                         s = clean.find('[');
@@ -3254,7 +5662,7 @@ elif menu == "📝 章节特训":
                             "ai_feedback": final_feedback,
                             "exam_id": None
                         }
-                        supabase.table("user_answers").insert(payload).execute()
+                        record_user_answer(payload)
                         st.session_state[save_key] = True
                 except Exception as e:
                     print(f"存库失败: {e}")
@@ -3280,6 +5688,11 @@ elif menu == "📝 章节特训":
                 if st.button("🏁 完成练习", type="primary", use_container_width=True):
                     st.balloons()
                     st.success("🎉 本轮练习全部完成！")
+                    answer_queue = get_answer_queue()
+                    if answer_queue and not answer_queue.flush(timeout=5):
+                        st.toast("部分答题记录暂存在本地，联网后会自动补写")
+                    if answer_queue and answer_queue.dead_count():
+                        st.toast("⚠️ 有答题记录被数据库拒绝，可在设置中心「答题记录同步」查看并重新提交")
                     cleanup_quiz_session()
                     st.session_state.quiz_active = False
                     st.rerun()
@@ -3308,6 +5721,7 @@ elif menu == "⭐ 重点/易错本":
 
     try:
         raw_data = query.execute().data
+        set_marked_qids(user_id, [r['question_id'] for r in raw_data])  # 全量拉取过了，顺便刷新标记缓存
     except Exception as e:
         st.error(f"数据加载失败: {e}")
         raw_data = []
@@ -3366,6 +5780,7 @@ elif menu == "⭐ 重点/易错本":
                 with c_act2:
                     if st.button("✅ 已掌握，移除", key=f"btn_rm_{mark_id}"):
                         supabase.table("question_marks").delete().eq("id", mark_id).execute()
+                        get_marked_qids(user_id).discard(int(item['question_id']))
                         st.toast("已从重点本移除")
                         time.sleep(0.5)
                         st.rerun()
@@ -3383,11 +5798,35 @@ elif menu == "⭐ 重点/易错本":
                     # 读取历史
                     chat_history = item.get('chat_history') or []
 
+                    def build_mark_prompt(question_text):
+                        return f"""
+                        【当前题目】{q['content']}
+                        【选项】{q.get('options', '无')}
+                        【正确答案】{q['correct_answer']}
+                        【解析】{q.get('explanation', '无')}
+                        【用户问题】{question_text}
+                        请作为会计私教，解答用户的问题。如果用户问为什么选A不选B，请详细分析。
+                        """
+
                     # 展示历史
                     for i, msg in enumerate(chat_history):
                         role = "user" if msg['role'] == "user" else "assistant"
                         with st.chat_message(role):
                             st.write(msg['content'])
+                            # 🔄 重新生成：缓存里近似匹配到的讲解不对题时，绕过缓存重答并覆盖
+                            if role == "assistant" and i > 0 and chat_history[i - 1]['role'] == "user":
+                                if st.button("🔄", key=f"mark_reg_{mark_id}_{i}", help="对该回答不满意？重新生成"):
+                                    prev_q = chat_history[i - 1]['content']
+                                    with st.spinner("🔄 AI 正在重写..."):
+                                        new_reply = ask_ai_tutor(q['id'], "", prev_q, build_mark_prompt(prev_q),
+                                                                 use_cache=False)
+                                    if is_ai_failure(new_reply):
+                                        st.error(new_reply)
+                                    else:
+                                        chat_history[i] = {"role": "assistant", "content": new_reply}
+                                        supabase.table("question_marks").update({"chat_history": chat_history}).eq(
+                                            "id", mark_id).execute()
+                                        st.rerun()
 
                     # 提问框
                     user_input = st.chat_input(f"关于这道题的疑问...", key=f"chat_in_{mark_id}")
@@ -3397,26 +5836,22 @@ elif menu == "⭐ 重点/易错本":
 
                         # 2. 调用 AI
                         # 构建上下文 Prompt
-                        context_prompt = f"""
-                        【当前题目】{q['content']}
-                        【选项】{q.get('options', '无')}
-                        【正确答案】{q['correct_answer']}
-                        【解析】{q.get('explanation', '无')}
-                        【用户问题】{user_input}
-                        请作为会计私教，解答用户的问题。如果用户问为什么选A不选B，请详细分析。
-                        """
+                        context_prompt = build_mark_prompt(user_input)
 
                         # 简单的一问一答模式，如果需要连续对话，可以把 chat_history 传进去
                         # 这里为了简化，我们只传 context_prompt，或者你可以复用 call_ai_universal 的 history 参数
                         with st.spinner("AI 正在思考..."):
-                            ai_reply = call_ai_universal(context_prompt)  # 也可以传入 history=chat_history[:-1]
+                            ai_reply = ask_ai_tutor(q['id'], "", user_input, context_prompt)
 
-                        chat_history.append({"role": "assistant", "content": ai_reply})
+                        if is_ai_failure(ai_reply):
+                            st.error(ai_reply)
+                        else:
+                            chat_history.append({"role": "assistant", "content": ai_reply})
 
-                        # 3. 保存回 question_marks 表 (注意是存到 question_marks，不是 user_answers)
-                        supabase.table("question_marks").update({"chat_history": chat_history}).eq("id",
-                                                                                                   mark_id).execute()
-                        st.rerun()
+                            # 3. 保存回 question_marks 表 (注意是存到 question_marks，不是 user_answers)
+                            supabase.table("question_marks").update({"chat_history": chat_history}).eq("id",
+                                                                                                       mark_id).execute()
+                            st.rerun()
 
 # =========================================================
 # ⚔️ 全真模考 (V6.0: 混合题型 + 批量 AI 阅卷)
@@ -3500,9 +5935,16 @@ elif menu == "⚔️ 全真模考":
             detail_report = []
 
             # 创建进度条
-            st.info("🤖 AI 正在逐题批改主观题，请稍候...")
+            st.info("🤖 AI 正在并发批改主观题，请稍候...")
             bar = st.progress(0)
 
+            # 主观题一次性并发提交，进度条随完成数推进
+            subj_idx = [i for i, q in enumerate(paper) if q.get('type', 'single') == 'subjective']
+            subj_grades = ai_grade_subjective_auto(
+                [(user_ans_map.get(i, ""), paper[i].get('correct_answer', ''), paper[i]['content']) for i in subj_idx],
+                on_progress=lambda d, t: bar.progress(d / t))
+            grade_map = dict(zip(subj_idx, subj_grades))
+
             for idx, q in enumerate(paper):
                 u_ans = user_ans_map.get(idx, "")
                 q_type = q.get('type', 'single')
@@ -3514,7 +5956,7 @@ elif menu == "⚔️ 全真模考":
 
                 # 分支 A: 主观题 (调用 AI)
                 if q_type == 'subjective':
-                    res = ai_grade_subjective(u_ans, std_ans, q['content'])
+                    res = grade_map[idx]
                     # 假设每题权重平均，换算成百分制
                     # 比如试卷共10题，每题10分。AI给的 res['score'] 是0-100。
                     # 得分 = (res['score'] / 100) * (100 / len(paper))
@@ -3539,7 +5981,8 @@ elif menu == "⚔️ 全真模考":
                     "q": q, "u_ans": u_ans, "score": item_score,
                     "is_correct": is_correct, "feedback": feedback
                 })
-                bar.progress((idx + 1) / len(paper))
+
+            bar.progress(1.0)
 
             session['report_data'] = detail_report
 
@@ -3746,7 +6189,7 @@ elif menu == "❌ 错题本":
                                         3. 🍎 生活举例：必须举生活例子类比。
                                         """
                                         # 调用 AI (不带历史，因为这是第一条)
-                                        new_reply = call_ai_universal(prompt, history=[])
+                                        new_reply = ask_ai_tutor(qid, e['user_response'], "", prompt, use_cache=False)
 
                                     else:
                                         # 情况 B: 这是后续追问的回答。
@@ -3755,10 +6198,13 @@ elif menu == "❌ 错题本":
                                         # 调用 AI (带上之前的历史作为上下文)
                                         # 注意：history 参数应该是 idx-1 之前的所有内容
                                         context_history = chat_history[:idx - 1]
-                                        new_reply = call_ai_universal(prev_user_msg, history=context_history)
+                                        new_reply = ask_ai_tutor(qid, e['user_response'], prev_user_msg, prev_user_msg,
+                                                                 history=context_history, use_cache=False)
 
                                     # 3. 存入新回答
-                                    if new_reply:
+                                    if is_ai_failure(new_reply):
+                                        st.error(new_reply)
+                                    else:
                                         chat_history.insert(idx, {"role": "model", "content": new_reply})
                                         supabase.table("user_answers").update({"ai_chat_history": chat_history}).eq(
                                             "id", e['id']).execute()
@@ -3806,13 +6252,15 @@ elif menu == "❌ 错题本":
                             2. 💡 原理解析。
                             3. 🍎 生活举例（必选）。
                             """
-                            reply = call_ai_universal(prompt, history=[])
+                            reply = ask_ai_tutor(qid, e['user_response'], "", prompt)
                         else:  # 追问
                             last_q = chat_history[-1]['content']
                             # 传入除最后一条（也就是当前问题）之外的历史
-                            reply = call_ai_universal(last_q, history=chat_history[:-1])
+                            reply = ask_ai_tutor(qid, e['user_response'], last_q, last_q, history=chat_history[:-1])
 
-                        if reply:
+                        if is_ai_failure(reply):
+                            st.error(reply)
+                        else:
                             chat_history.append({"role": "model", "content": reply})
                             supabase.table("user_answers").update({"ai_chat_history": chat_history}).eq("id", e[
                                 'id']).execute()
@@ -3896,9 +6344,8 @@ elif menu == "🛠️ 数据管理 & 补录":
                     # A. 拿到所有书的 ID
                     b_ids = [b['id'] for b in all_books]
 
-                    # B. 查出这些书的所有章节
-                    chaps_res = supabase.table("chapters").select("id, book_id").in_("book_id", b_ids).execute()
-                    all_chaps = chaps_res.data
+                    # B. 这些书的所有章节 (直接取自缓存的章节树)
+                    all_chaps = [c for b_id in b_ids for c in get_chapters(b_id)]
 
                     if all_chaps:
                         c_ids = [c['id'] for c in all_chaps]
@@ -4022,6 +6469,7 @@ elif menu == "🛠️ 数据管理 & 补录":
                             else:
                                 if row['content']: supabase.table("question_bank").insert(payload).execute()
                             changes_count += 1
+                        invalidate_chapter_counts()
                         st.success(f"成功更新 {changes_count} 条记录！")
                         time.sleep(1);
                         st.rerun()
@@ -4049,6 +6497,7 @@ elif menu == "🛠️ 数据管理 & 补录":
                             "注意：这将删除本章节上传的所有 PDF/Word 原文片段！\n如果您已经生成了满意的讲义(AI Lessons)，可以删除原文以释放空间。但删除后无法再次生成新讲义。")
                         if st.button("我已生成好讲义，确认清空原文", type="primary"):
                             supabase.table("materials").delete().eq("chapter_id", cid_m).execute()
+                            invalidate_chapter_counts()
                             st.success("原文已清理！")
                             time.sleep(1);
                             st.rerun()
@@ -4076,8 +6525,10 @@ elif menu == "🛠️ 数据管理 & 补录":
                         if ai_fix:
                             with st.spinner("AI 正在根据会计语境修复 OCR 错误..."):
                                 fix_p = f"请修复以下会计教材文本中的OCR错误（如'固走'->'固定'，'1,000'空格问题等），保持原意：\n\n{content_val}"
-                                fixed = call_ai_universal(fix_p)
-                                if fixed:
+                                fixed = call_ai_universal(fix_p, feature="ocr_fix")
+                                if is_ai_failure(fixed):
+                                    st.error(fixed)
+                                else:
                                     supabase.table("materials").update({"content": fixed}).eq("id", target_mat[
                                         'id']).execute()
                                     st.success("修复完成！请刷新。")
@@ -4096,6 +6547,7 @@ elif menu == "🛠️ 数据管理 & 补录":
 
                         if delete_btn:
                             supabase.table("materials").delete().eq("id", target_mat['id']).execute()
+                            invalidate_chapter_counts()
                             st.rerun()
             except Exception as e:
                 st.error(f"加载失败: {e}")
@@ -4195,12 +6647,14 @@ elif menu == "🛠️ 数据管理 & 补录":
                                 "user_id": user_id, "subject_id": sel_sid,
                                 "title": new_book_title, "total_pages": 0
                             }).execute()
+                            invalidate_hierarchy()
                             new_bid = b_res.data[0]['id']
                             # 2. 建章
                             c_res = supabase.table("chapters").insert({
                                 "user_id": user_id, "book_id": new_bid,
                                 "title": new_chap_title, "start_page": 0, "end_page": 0
                             }).execute()
+                            invalidate_hierarchy()
                             final_cid = c_res.data[0]['id']
                             final_c_name = new_chap_title
 
@@ -4235,6 +6689,7 @@ elif menu == "🛠️ 数据管理 & 补录":
                             bar.progress((i + 1) / len(df_new))
 
                         if batch_data: supabase.table("question_bank").insert(batch_data).execute()
+                        invalidate_chapter_counts()
 
                         st.balloons()
                         st.success(f"🎉 成功导入 {len(df_new)} 道题目至：{final_c_name}")
@@ -4262,11 +6717,13 @@ elif menu == "🛠️ 数据管理 & 补录":
                                 "user_id": user_id, "subject_id": sel_sid,
                                 "title": new_book_title, "total_pages": 0
                             }).execute()
+                            invalidate_hierarchy()
                             new_bid = b_res.data[0]['id']
                             c_res = supabase.table("chapters").insert({
                                 "user_id": user_id, "book_id": new_bid,
                                 "title": new_chap_title, "start_page": 0, "end_page": 0
                             }).execute()
+                            invalidate_hierarchy()
                             final_cid = c_res.data[0]['id']
                             final_c_name = new_chap_title
 
@@ -4316,14 +6773,19 @@ elif menu == "⚙️ 设置中心":
         # 连通性测试功能
         if st.button("📡 测试 AI 连通性"):
             with st.spinner("发送 Hello World..."):
+                probe_provider, probe_model = _resolve_ai_target()
                 start_t = time.time()
-                res = call_ai_universal("Say 'OK' in one word.", timeout_override=10)
+                # 连通性测试必须真实请求，不能读缓存；也不能切到备用服务商，否则所选服务商挂了也显示通畅
+                res = call_ai_universal("Say 'OK' in one word.", timeout_override=10, use_cache=False,
+                                        feature="connectivity_test", failover=False)
                 cost_t = time.time() - start_t
 
-                if "Error" in res or "异常" in res:
-                    st.error(f"❌ 失败: {res}")
+                if is_ai_failure(res):
+                    st.error(f"❌ {probe_provider} / {probe_model} 失败: {res}")
+                    if getattr(res, 'kind', None) == "auth":
+                        st.caption("💡 请检查 secrets 中对应服务商的 API Key 是否正确")
                 else:
-                    st.success(f"✅ 通畅! 耗时 {cost_t:.2f}s")
+                    st.success(f"✅ {probe_provider} / {probe_model} 通畅! 耗时 {cost_t:.2f}s")
                     st.caption(f"回复: {res}")
 
     with col_set:
@@ -4345,6 +6807,108 @@ elif menu == "⚙️ 设置中心":
             else:
                 st.info("配置未变更")
 
+    # 容灾设置：备用服务商 + 对冲请求
+    with st.expander("🛟 容灾与加速 (备用服务商)", expanded=False):
+        chain = get_fallback_chain()
+        st.caption(f"备用链路：{' → '.join(chain) if chain else '未配置'}（可在 secrets 的 [ai_fallback] chain 中调整）")
+        c_fo1, c_fo2 = st.columns(2)
+        with c_fo1:
+            new_failover = st.checkbox("失败自动切换备用服务商", value=current_settings.get('ai_failover', True))
+        with c_fo2:
+            new_hedge = st.checkbox("慢响应时并行请求备用服务商 (对冲)", value=current_settings.get('ai_hedge', False),
+                                  help="首选服务商超过其 p90 延迟仍未返回时，同时请求下一个服务商，谁先回来用谁。会额外消耗少量 Token。")
+        if new_failover != current_settings.get('ai_failover', True) or \
+                new_hedge != current_settings.get('ai_hedge', False):
+            update_settings(user_id, {"ai_failover": new_failover, "ai_hedge": new_hedge})
+            st.toast("容灾设置已保存")
+
+        p90_rows = [{"服务商": f, "p90 延迟 (秒)": round(get_ai_latency_p90(f), 2)} for f in chain]
+        if p90_rows: st.dataframe(pd.DataFrame(p90_rows), hide_index=True, use_container_width=True)
+
+    # 按任务自动选模型
+    with st.expander("🧭 按任务自动选模型", expanded=False):
+        new_route = st.checkbox("开启自动路由", value=current_settings.get('ai_auto_route', False),
+                                help="按功能策略 (最快/最省) 结合本应用实测的延迟与失败率，在所选服务商的在线模型中挑选；"
+                                     "只影响下表列出的短小任务")
+        if new_route != current_settings.get('ai_auto_route', False):
+            update_settings(user_id, {"ai_auto_route": new_route})
+            st.toast("路由设置已保存")
+        if not current_settings.get('ai_auto_route', False):
+            st.caption("📌 未开启：当前所有功能都使用侧边栏所选模型。")
+
+        model_stats = get_ai_model_stats()['by_model']
+        route_rows = []
+        for feat, policy in AI_FEATURE_POLICIES.items():
+            routed = route_ai_model(feat)
+            ms = model_stats.get(routed[1], {}) if routed else {}
+            route_rows.append({
+                "功能": feat, "策略": AI_POLICY_LABELS[policy],
+                "当前路由": f"{routed[0]} / {routed[1]}" if routed else "(侧边栏所选)",
+                "p50 耗时(秒)": round(ms['p50'], 2) if ms.get('p50') else None,
+                "失败率": f"{int(ms['fail_rate'] * 100)}%" if ms else "-",
+                "样本": ms.get('n', 0),
+            })
+        st.dataframe(pd.DataFrame(route_rows), hide_index=True, use_container_width=True)
+
+    # AI 响应缓存状态
+    ai_cache = get_ai_response_cache()
+    if ai_cache:
+        with st.expander("🗄️ AI 响应缓存", expanded=False):
+            c_stat = ai_cache.stats()
+            total_req = c_stat['hits'] + c_stat['misses']
+            hit_rate = int(c_stat['hits'] / total_req * 100) if total_req else 0
+            c_h1, c_h2, c_h3 = st.columns(3)
+            c_h1.metric("命中", c_stat['hits'])
+            c_h2.metric("未命中", c_stat['misses'])
+            c_h3.metric("已缓存条目", c_stat['entries'], delta=f"命中率 {hit_rate}%", delta_color="off")
+            st.caption(f"相同的提示词在 {AI_CACHE_TTL // 86400} 天内直接复用结果，不重复消耗 Token。")
+            tutor_cache = get_tutor_answer_cache()
+            if tutor_cache:
+                st.caption(f"👩‍🏫 私教讲解缓存：{tutor_cache.count()} 条 (同一错题 + 相似追问直接复用)")
+            if st.button("🧹 清空 AI 缓存"):
+                ai_cache.clear()
+                if tutor_cache: tutor_cache.clear()
+                st.toast("AI 缓存已清空")
+                st.rerun()
+
+    # 答题记录后写队列：待写 / 写入失败 (死信) 的记录
+    answer_queue = get_answer_queue()
+    if answer_queue:
+        n_dead = answer_queue.dead_count()
+        with st.expander(f"📤 答题记录同步{' ⚠️' if n_dead else ''}", expanded=bool(n_dead)):
+            q_c1, q_c2 = st.columns(2)
+            q_c1.metric("等待写入", answer_queue.pending_count())
+            q_c2.metric("写入失败", n_dead)
+            st.caption("断网或服务异常时记录暂存在本地，恢复后自动补写；只有数据本身被数据库拒绝的记录才会列为写入失败。")
+            if n_dead:
+                st.dataframe(pd.DataFrame([{
+                    "题目ID": json.loads(payload).get('question_id'), "尝试次数": attempts, "错误": last_error,
+                    "时间": datetime.datetime.fromtimestamp(failed_at).strftime('%m-%d %H:%M') if failed_at else "",
+                } for _, payload, attempts, last_error, failed_at in answer_queue.dead_letters()]),
+                    hide_index=True, use_container_width=True)
+                if st.button("🔁 重新提交失败记录"):
+                    n_retry = answer_queue.retry_dead_letters()
+                    st.toast(f"已重新提交 {n_retry} 条记录")
+                    st.rerun()
+
+    # AI 调用遥测：各功能每天的耗时分位数与 Token 消耗
+    telemetry = get_ai_telemetry()
+    if telemetry:
+        with st.expander("📈 AI 调用统计 (耗时 / Token)", expanded=False):
+            tel_days = st.selectbox("统计范围", [1, 7, 30], index=1, format_func=lambda d: f"最近 {d} 天")
+            tel_df = telemetry.load(days=tel_days)
+            if tel_df.empty:
+                st.caption("暂无调用记录。")
+            else:
+                summary_df = summarize_ai_calls(tel_df)
+                t_c1, t_c2, t_c3 = st.columns(3)
+                t_c1.metric("调用次数", len(tel_df))
+                t_c2.metric("Token 总量", int(tel_df['prompt_tokens'].sum() + tel_df['completion_tokens'].sum()))
+                t_c3.metric("失败次数", int((tel_df['ok'] == 0).sum()))
+                st.dataframe(summary_df, hide_index=True, use_container_width=True)
+                st.caption("耗时分位数不含缓存命中；服务商未返回用量时 Token 为按字数估算；"
+                           "费用只对模型目录中带价格的模型 (如 OpenRouter) 估算。")
+
     st.divider()
 
     # --- B. 考试时间设置 (保留联网功能) ---
@@ -4355,13 +6919,13 @@ elif menu == "⚙️ 设置中心":
         with st.spinner("正在分析历史考情..."):
             # 模拟 AI 决策
             p = f"根据中国会计资格评价中心惯例，推测 {datetime.date.today().year} 年中级会计考试日期。仅返回 YYYY-MM-DD 格式。"
-            ai_date = call_ai_universal(p)
+            ai_date = call_ai_universal(p, feature="exam_date")
             try:
                 clean_d = ai_date.strip()[:10]
                 # 简单校验格式
                 datetime.datetime.strptime(clean_d, '%Y-%m-%d')
 
-                supabase.table("study_profile").update({"exam_date": clean_d}).eq("user_id", user_id).execute()
+                update_user_profile(user_id, {"exam_date": clean_d})
                 st.success(f"已更新为: {clean_d}")
                 time.sleep(1)
                 st.rerun()
@@ -4378,7 +6942,7 @@ elif menu == "⚙️ 设置中心":
 
     set_date = st.date_input("手动设定目标日期", curr_date)
     if set_date != curr_date:
-        supabase.table("study_profile").update({"exam_date": str(set_date)}).eq("user_id", user_id).execute()
+        update_user_profile(user_id, {"exam_date": str(set_date)})
         st.toast("日期已更新")
         time.sleep(1)
         st.rerun()
@@ -4396,6 +6960,7 @@ elif menu == "⚙️ 设置中心":
         with c_del2:
             if st.button("清空所有书籍资料"):
                 supabase.table("books").delete().eq("user_id", user_id).execute()
+                invalidate_hierarchy()
                 # 因为设置了级联删除(Cascade)，章节、题目、内容会自动删除
                 st.success("资料库已格式化")
 
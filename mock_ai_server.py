@@ -0,0 +1,394 @@
+"""
+本地模拟 AI 服务商 (离线压测 / 调试用，只依赖标准库)
+
+同时实现两种接口形态：
+- Gemini REST：POST /v1beta/models/{model}:generateContent、:streamGenerateContent?alt=sse，GET /v1beta/models
+- OpenAI 兼容：POST /v1/chat/completions (含 stream=true)，GET /v1/models
+
+支持可配置的延迟分布与错误注入 (429 / 5xx / 超时 / 截断的 JSON)，
+并对大纲、抽题、阅卷、目录解析等提示词返回确定性的模拟结果 (同一提示词结果永远相同)。
+
+用法：
+    python mock_ai_server.py --port 8765 --latency 1.5 --jitter 0.4 --rate-429 0.05 --rate-truncate 0.05
+
+然后在 .streamlit/secrets.toml 中加入 (删掉即恢复真实服务商)：
+    [mock_ai]
+    base_url = "http://127.0.0.1:8765"
+
+GET /stats 返回累计请求数与各类注入错误的次数，便于对比导入/大纲流水线的吞吐。
+"""
+import argparse
+import hashlib
+import json
+import math
+import random
+import re
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
+
+MOCK_MODELS = [
+    # (模型 ID, 上下文 Token, 最大输出 Token)
+    ("gemini-1.5-flash", 1048576, 8192),
+    ("gemini-1.5-flash-8b", 1048576, 8192),
+    ("gemini-2.0-flash", 1048576, 8192),
+    ("gemini-1.5-pro", 2097152, 8192),
+    ("deepseek-chat", 65536, 8192),
+    ("google/gemini-2.0-flash-exp:free", 1048576, 8192),
+    ("openai/gpt-4o-mini", 128000, 16384),
+]
+RATE_LIMIT_RPM = 60  # 模拟的服务端限流窗口 (只用于生成 x-ratelimit-* 响应头)
+STREAM_CHUNK_CHARS = 24
+
+
+# --- 确定性的模拟输出 ---
+def _rng(prompt):
+    return random.Random(int(hashlib.sha256(prompt.encode("utf-8")).hexdigest()[:16], 16))
+
+
+def estimate_tokens(text):
+    cjk = len(re.findall(r'[　-〿㐀-鿿豈-﫿＀-￯]', text or ""))
+    return cjk + (len(text or "") - cjk) // 4 + 1
+
+
+def classify_prompt(prompt):
+    """按提示词里的固定字样判断是哪类任务 (与 app.py 中的提示词模板对应)"""
+    if "Say 'OK'" in prompt: return "ok"
+    if "阅卷" in prompt and "题目编号：" in prompt: return "grade_packed"
+    if "阅卷" in prompt: return "grade"
+    if "整理以下会计考点列表" in prompt: return "outline_reduce"
+    if "必背法条" in prompt or "核心考点" in prompt: return "outline_map"
+    if "提取题目" in prompt or "【续写说明】" in prompt: return "extract"
+    if "目录" in prompt and "start_page" in prompt: return "toc"
+    if "YYYY-MM-DD" in prompt: return "date"
+    return "text"
+
+
+def _mock_grade(rng, item_id=None):
+    score = rng.choice([0, 30, 45, 60, 75, 85, 90, 100])
+    result = {"score": score, "feedback": f"[模拟阅卷] 得分 {score}：分录方向正确，金额计算请再核对。"}
+    if item_id is not None: result = {"id": item_id, **result}
+    return result
+
+
+def _mock_questions(rng, prompt):
+    # 续写请求从中断处继续编号，并只补剩下的一部分
+    start = 1
+    m = re.search(r"上一次的输出在第 (\d+) 题之后中断", prompt)
+    if m: start = int(m.group(1)) + 1
+    total = max(3, min(40, len(prompt) // 800))
+    count = max(1, (total - start + 1) if m else total)
+
+    questions = []
+    for n in range(start, start + count):
+        kind = rng.choice(["single", "single", "multi", "judgment", "subjective"])
+        if kind == "judgment":
+            questions.append({"question": f"{n}. [判断] 模拟判断题 {n}：企业应当按月计提折旧。", "type": "judgment",
+                              "options": [], "answer": rng.choice(["A", "B"]), "explanation": "模拟解析。"})
+        elif kind == "subjective":
+            questions.append({"question": f"{n}. 【计算分析题】甲公司 2024 年发生如下业务 (模拟第 {n} 题)...(1) 编制分录；(2) 计算净利润。",
+                              "type": "subjective", "options": [], "answer": "借：银行存款 100\n  贷：主营业务收入 100",
+                              "explanation": "模拟参考答案。"})
+        else:
+            answer = "".join(sorted(rng.sample("ABCD", 2))) if kind == "multi" else rng.choice("ABCD")
+            questions.append({"question": f"{n}. 模拟{'多' if kind == 'multi' else '单'}选题 {n}：下列说法正确的是？",
+                              "type": kind, "options": ["A. 选项一", "B. 选项二", "C. 选项三", "D. 选项四"],
+                              "answer": answer, "explanation": "模拟解析。"})
+    return questions
+
+
+def _mock_toc(rng, prompt):
+    m = re.search(r"总页数：(\d+)", prompt)
+    total_pages = int(m.group(1)) if m else 200
+    s = re.search(r"第 (\d+) 页", prompt)
+    start = int(s.group(1)) if s else 1
+    chapters = rng.randint(5, 10)
+    step = max(1, (total_pages - start) // chapters)
+    return [{"title": f"第{i + 1}章 模拟章节 {i + 1}", "start_page": start + i * step,
+             "end_page": min(total_pages, start + (i + 1) * step - 1)} for i in range(chapters)]
+
+
+def build_canned_output(prompt):
+    rng = _rng(prompt)
+    kind = classify_prompt(prompt)
+    if kind == "ok":
+        return kind, "OK"
+    if kind == "grade":
+        return kind, json.dumps(_mock_grade(rng), ensure_ascii=False)
+    if kind == "grade_packed":
+        ids = re.findall(r"题目编号：(\S+)", prompt)
+        return kind, json.dumps([_mock_grade(rng, i) for i in ids], ensure_ascii=False)
+    if kind == "outline_map":
+        points = [f"模拟考点 {rng.randint(1, 9999)}：{w}" for w in
+                  rng.sample(["收入确认五步法", "固定资产折旧方法", "存货跌价准备", "长期股权投资权益法",
+                              "借款费用资本化条件", "或有事项确认", "所得税暂时性差异", "债务重组损益",
+                              "非货币性资产交换", "租赁负债初始计量", "政府补助总额法", "金融资产分类",
+                              "企业合并商誉", "外币折算汇率", "会计政策变更追溯调整", "资产减值迹象",
+                              "投资性房地产转换", "职工薪酬辞退福利"], 16)]
+        return kind, json.dumps(points, ensure_ascii=False)
+    if kind == "outline_reduce":
+        m = re.search(r"【原始列表】(\[.*?\])\s*【要求】", prompt, re.S)
+        try:
+            points = list(dict.fromkeys(json.loads(m.group(1)))) if m else []
+        except ValueError:
+            points = []
+        return kind, json.dumps(points or [f"模拟考点 {i}" for i in range(1, 21)], ensure_ascii=False)
+    if kind == "extract":
+        return kind, json.dumps(_mock_questions(rng, prompt), ensure_ascii=False, indent=1)
+    if kind == "toc":
+        return kind, json.dumps(_mock_toc(rng, prompt), ensure_ascii=False)
+    if kind == "date":
+        return kind, f"{time.localtime().tm_year}-09-06"
+
+    paragraphs = rng.randint(2, 5)
+    body = "\n\n".join(f"**要点 {i + 1}**：" + "这是模拟讲解段落，用于离线测试渲染与吞吐。" * rng.randint(1, 3)
+                       for i in range(paragraphs))
+    return kind, f"### 📘 模拟回答\n\n{body}"
+
+
+# --- 服务端 ---
+class MockStats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters = {}
+        self.window = []
+
+    def incr(self, key):
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + 1
+
+    def remaining_requests(self):
+        """滑动一分钟窗口，生成逼真的 x-ratelimit-remaining-requests"""
+        now = time.time()
+        with self._lock:
+            self.window = [t for t in self.window if now - t < 60] + [now]
+            return max(0, RATE_LIMIT_RPM - len(self.window))
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self.counters)
+
+
+class MockAIHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # 支持 keep-alive，便于测试连接池
+    config = None
+    stats = None
+
+    def log_message(self, fmt, *args):
+        if self.config.verbose:
+            super().log_message(fmt, *args)
+
+    # --- 工具方法 ---
+    def _sample_latency(self):
+        """对数正态分布：均值约为 --latency，--jitter 越大长尾越明显"""
+        mean, sigma = self.config.latency, self.config.jitter
+        if mean <= 0: return 0.0
+        mu = math.log(mean) - sigma ** 2 / 2
+        return random.lognormvariate(mu, sigma) if sigma > 0 else mean
+
+    def _send_json(self, status, payload, headers=None):
+        body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _rate_headers(self):
+        return {"x-ratelimit-limit-requests": str(RATE_LIMIT_RPM),
+                "x-ratelimit-remaining-requests": str(self.stats.remaining_requests()),
+                "x-ratelimit-reset-requests": "1s"}
+
+    def _inject_error(self, gemini):
+        """按配置的概率注入错误；返回 "truncate" 表示需要截断输出，True 表示已经返回了错误"""
+        roll = random.random()
+        cfg = self.config
+        if roll < cfg.rate_429:
+            self.stats.incr("injected_429")
+            retry_after = str(random.randint(1, 5))
+            if gemini:
+                body = {"error": {"code": 429, "status": "RESOURCE_EXHAUSTED", "message": "Mock quota exceeded",
+                                  "details": [{"@type": "type.googleapis.com/google.rpc.RetryInfo",
+                                               "retryDelay": f"{retry_after}s"}]}}
+            else:
+                body = {"error": {"message": "Mock rate limit reached", "type": "rate_limit_exceeded"}}
+            self._send_json(429, body, {"Retry-After": retry_after, **self._rate_headers()})
+            return True
+        roll -= cfg.rate_429
+        if roll < cfg.rate_5xx:
+            self.stats.incr("injected_5xx")
+            self._send_json(503, {"error": {"code": 503, "message": "Mock service unavailable"}})
+            return True
+        roll -= cfg.rate_5xx
+        if roll < cfg.rate_timeout:
+            # 挂起超过客户端超时时间，再关闭连接
+            self.stats.incr("injected_timeout")
+            time.sleep(cfg.timeout_sleep)
+            self.close_connection = True
+            return True
+        roll -= cfg.rate_timeout
+        if roll < cfg.rate_truncate:
+            self.stats.incr("injected_truncate")
+            return "truncate"
+        return False
+
+    @staticmethod
+    def _truncate(text):
+        return text[:max(1, int(len(text) * random.uniform(0.5, 0.9)))]
+
+    def _read_body(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        raw = self.rfile.read(length) if length else b"{}"
+        try:
+            return json.loads(raw.decode("utf-8"))
+        except ValueError:
+            return {}
+
+    def _write_chunk(self, data):
+        """HTTP/1.1 chunked 编码写出一段流式数据"""
+        self.wfile.write(f"{len(data):X}\r\n".encode("ascii") + data + b"\r\n")
+        self.wfile.flush()
+
+    def _stream(self, pieces, make_event, done_event=None):
+        latency = self._sample_latency()
+        time.sleep(latency * 0.3)  # 首 Token 延迟
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream; charset=utf-8")
+        self.send_header("Transfer-Encoding", "chunked")
+        for k, v in self._rate_headers().items():
+            self.send_header(k, v)
+        self.end_headers()
+        per_chunk = latency * 0.7 / max(1, len(pieces))
+        try:
+            for piece in pieces:
+                self._write_chunk(f"data: {json.dumps(make_event(piece), ensure_ascii=False)}\r\n\r\n".encode("utf-8"))
+                time.sleep(per_chunk)
+            if done_event:
+                self._write_chunk(done_event.encode("utf-8"))
+            self._write_chunk(b"")
+        except (BrokenPipeError, ConnectionResetError):
+            self.close_connection = True
+
+    # --- 路由 ---
+    def do_GET(self):
+        path = urlparse(self.path).path
+        if path == "/stats":
+            self._send_json(200, self.stats.snapshot())
+        elif path == "/v1beta/models":
+            self._send_json(200, {"models": [
+                {"name": f"models/{m}", "inputTokenLimit": ctx, "outputTokenLimit": out,
+                 "supportedGenerationMethods": ["generateContent", "streamGenerateContent"]}
+                for m, ctx, out in MOCK_MODELS if m.startswith("gemini")]})
+        elif path in ("/v1/models", "/v1/models/"):
+            self._send_json(200, {"data": [
+                {"id": m, "context_length": ctx, "top_provider": {"max_completion_tokens": out},
+                 "pricing": {"prompt": "0", "completion": "0"}} for m, ctx, out in MOCK_MODELS]})
+        else:
+            self._send_json(404, {"error": {"message": f"Unknown path {path}"}})
+
+    def do_POST(self):
+        path = urlparse(self.path).path
+        body = self._read_body()
+        self.stats.incr("requests")
+        m = re.match(r"^/v1beta/models/([^:]+):(generateContent|streamGenerateContent)$", path)
+        if m:
+            self._handle_gemini(m.group(1), m.group(2) == "streamGenerateContent", body)
+        elif path.rstrip("/") == "/v1/chat/completions":
+            self._handle_openai(body)
+        else:
+            self._send_json(404, {"error": {"message": f"Unknown path {path}"}})
+
+    def _handle_gemini(self, model, stream, body):
+        contents = body.get('contents') or [{}]
+        prompt = "".join(p.get('text', '') for p in (contents[-1].get('parts') or []))
+        kind, text = build_canned_output(prompt)
+        self.stats.incr(f"kind_{kind}")
+
+        injected = self._inject_error(gemini=True)
+        if injected is True: return
+        if injected == "truncate": text = self._truncate(text)
+        usage = {"promptTokenCount": sum(estimate_tokens(p.get('text', '')) for c in contents
+                                         for p in c.get('parts') or []),
+                 "candidatesTokenCount": estimate_tokens(text)}
+        usage["totalTokenCount"] = usage["promptTokenCount"] + usage["candidatesTokenCount"]
+
+        if stream:
+            pieces = [text[i:i + STREAM_CHUNK_CHARS] for i in range(0, len(text), STREAM_CHUNK_CHARS)] or [""]
+            self._stream(pieces, lambda piece: {
+                "candidates": [{"content": {"parts": [{"text": piece}], "role": "model"}}],
+                "modelVersion": model})
+        else:
+            time.sleep(self._sample_latency())
+            self._send_json(200, {
+                "candidates": [{"content": {"parts": [{"text": text}], "role": "model"},
+                                "finishReason": "MAX_TOKENS" if injected == "truncate" else "STOP"}],
+                "usageMetadata": usage, "modelVersion": model}, self._rate_headers())
+
+    def _handle_openai(self, body):
+        messages = body.get('messages') or [{}]
+        prompt = str(messages[-1].get('content') or "")
+        model = body.get('model', 'mock-model')
+        kind, text = build_canned_output(prompt)
+        self.stats.incr(f"kind_{kind}")
+
+        injected = self._inject_error(gemini=False)
+        if injected is True: return
+        if injected == "truncate": text = self._truncate(text)
+        finish = "length" if injected == "truncate" else "stop"
+        completion_id = f"chatcmpl-mock-{uuid.uuid4().hex[:12]}"
+        created = int(time.time())
+
+        if body.get('stream'):
+            pieces = [text[i:i + STREAM_CHUNK_CHARS] for i in range(0, len(text), STREAM_CHUNK_CHARS)] or [""]
+            self._stream(pieces, lambda piece: {
+                "id": completion_id, "object": "chat.completion.chunk", "created": created, "model": model,
+                "choices": [{"index": 0, "delta": {"role": "assistant", "content": piece}, "finish_reason": None}]},
+                         done_event="data: " + json.dumps({
+                             "id": completion_id, "object": "chat.completion.chunk", "created": created,
+                             "model": model, "choices": [{"index": 0, "delta": {}, "finish_reason": finish}]})
+                                    + "\r\n\r\ndata: [DONE]\r\n\r\n")
+        else:
+            time.sleep(self._sample_latency())
+            prompt_tokens = sum(estimate_tokens(str(m.get('content') or "")) for m in messages)
+            self._send_json(200, {
+                "id": completion_id, "object": "chat.completion", "created": created, "model": model,
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": text}, "finish_reason": finish}],
+                "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": estimate_tokens(text),
+                          "total_tokens": prompt_tokens + estimate_tokens(text)}}, self._rate_headers())
+
+
+def main():
+    parser = argparse.ArgumentParser(description="本地模拟 AI 服务商 (Gemini + OpenAI 兼容接口)")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency", type=float, default=1.0, help="平均响应耗时 (秒)，0 表示不延迟")
+    parser.add_argument("--jitter", type=float, default=0.3, help="对数正态分布的 sigma，越大长尾越明显")
+    parser.add_argument("--rate-429", type=float, default=0.0, help="返回 429 的概率")
+    parser.add_argument("--rate-5xx", type=float, default=0.0, help="返回 503 的概率")
+    parser.add_argument("--rate-timeout", type=float, default=0.0, help="挂起不响应 (模拟超时) 的概率")
+    parser.add_argument("--timeout-sleep", type=float, default=120.0, help="模拟超时时挂起的秒数")
+    parser.add_argument("--rate-truncate", type=float, default=0.0, help="输出被截断 (半截 JSON) 的概率")
+    parser.add_argument("--seed", type=int, default=None, help="错误注入与延迟的随机种子 (输出内容本身总是确定的)")
+    parser.add_argument("--verbose", action="store_true", help="打印每个请求")
+    args = parser.parse_args()
+
+    if args.seed is not None: random.seed(args.seed)
+    MockAIHandler.config = args
+    MockAIHandler.stats = MockStats()
+    server = ThreadingHTTPServer((args.host, args.port), MockAIHandler)
+    server.daemon_threads = True
+    print(f"Mock AI server listening on http://{args.host}:{args.port}  (GET /stats 查看统计)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
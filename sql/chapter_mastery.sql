@@ -0,0 +1,38 @@
+-- 章节掌握度 RPC：在数据库内做 user_answers 与 question_bank 的反连接，
+-- 避免把用户全部历史答对记录拉到客户端再拼成超长的 not.in.(...) 过滤串。
+-- 在 Supabase SQL Editor 中执行一次即可；未部署时 app.py 会自动退回按章节范围的客户端计算。
+
+-- 按 (user_id, question_id) 查“是否答对过”的部分索引
+create index if not exists idx_user_answers_correct
+    on user_answers (user_id, question_id)
+    where is_correct;
+
+-- 本章题目总数与已掌握 (至少答对过一次) 的题目数
+create or replace function chapter_mastery_stats(p_user_id text, p_chapter_id bigint)
+returns table (total_count bigint, mastered_count bigint)
+language sql stable
+as $$
+    select count(*) as total_count,
+           count(*) filter (where exists (
+               select 1 from user_answers a
+               where a.user_id = p_user_id and a.question_id = q.id and a.is_correct
+           )) as mastered_count
+    from question_bank q
+    where q.chapter_id = p_chapter_id;
+$$;
+
+-- 随机抽取本章 p_limit 道未掌握的题目 (完整题目行)
+create or replace function sample_unmastered_questions(p_user_id text, p_chapter_id bigint, p_limit int default 10)
+returns setof question_bank
+language sql volatile
+as $$
+    select q.*
+    from question_bank q
+    where q.chapter_id = p_chapter_id
+      and not exists (
+          select 1 from user_answers a
+          where a.user_id = p_user_id and a.question_id = q.id and a.is_correct
+      )
+    order by random()
+    limit p_limit;
+$$;
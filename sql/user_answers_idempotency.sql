@@ -0,0 +1,9 @@
+-- 答题记录幂等写入：app.py 的后写队列为每条记录生成 client_event_id，并按它 upsert。
+-- 写入请求已成功但响应丢失时，重试不会再插入一行重复记录。
+-- 在 Supabase SQL Editor 中执行一次即可；未部署时 app.py 会自动退回普通插入 (不带该列)。
+
+alter table user_answers add column if not exists client_event_id text;
+
+-- 旧记录该列为空，唯一约束对 null 不生效，不影响历史数据
+create unique index if not exists uq_user_answers_client_event_id
+    on user_answers (client_event_id);